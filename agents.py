@@ -17,12 +17,18 @@ Environment ## An environment holds objects, runs simulations
         VacuumEnvironment
         WumpusEnvironment
 
+BatchWumpusEnvironment ## Many wumpus worlds, stepped together with NumPy
+
 EnvFrame ## A graphical representation of the Environment
 
 """
 TIME_DELAY = 0.5
 
-import random, copy, math, sys,time
+import random, copy, math, sys,time, collections, multiprocessing, types
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #______________________________________________________________________________
 
@@ -203,7 +209,7 @@ class Environment:
 
     def run(self, steps=1000):
 	"""Run the Environment for given number of time steps."""
-	for step in range(steps):
+	for step in xrange(steps):
             if self.is_done(): return
             self.step()
 
@@ -216,6 +222,148 @@ class Environment:
             object.performance = 0
             self.agents.append(object)
 	return self
+
+    ## attributes not in a snapshot
+    snapshot_exclude = ('objects', 'agents')
+
+    def snapshot(self):
+        """Return a compact, picklable encoding of the state of the environment,
+        for restore: a Snapshot of its attributes, and for each object in
+        order its class and attributes -- or, for an agent, its index in a
+        tuple of the agents' attributes but .program.  Values that are plain
+        data are copied as they are; any other value is deep-copied, with a
+        reference to the environment or one of its objects kept as a Slot,
+        so that restore can point it at the restored one.  An agent's
+        program (and any state in it) can not be copied, so restore gives
+        the attributes back to the agents themselves, which the Snapshot
+        keeps."""
+        slots = tuple([Slot() for obj in self.objects + [self]])
+        memo = dict([(id(obj), slot)
+                     for (obj, slot) in zip(self.objects + [self], slots)])
+        position = dict([(id(agent), k)
+                         for (k, agent) in enumerate(self.agents)])
+        objects = []
+        for obj in self.objects:
+            k = position.get(id(obj))
+            if k is None:
+                objects.append((obj.__class__,
+                                snapshot_items(obj.__dict__, (), memo)))
+            else:
+                objects.append(k)
+        state = snapshot_items(self.__dict__, self.snapshot_exclude, memo)
+        agent_states = tuple([snapshot_items(a.__dict__, ('program',), memo)
+                              for a in self.agents])
+        return Snapshot(self.__class__, state, tuple(objects), agent_states,
+                        slots, list(self.agents))
+
+    def restore(self, snapshot, agents=None):
+        """Put the environment in the state of a snapshot.  By default the
+        snapshot's own agents come back, even if they have since left the
+        environment; agents, if given, take their places in order instead
+        (as when the snapshot was made in another process).  Other objects
+        are made anew, without calling __init__."""
+        if agents is None:
+            agents = snapshot.agents
+            if agents is None:
+                raise ValueError("The snapshot's agents are not known here;"
+                                 " pass them to restore")
+        elif len(agents) != len(snapshot.agent_states):
+            raise ValueError("The snapshot has %d agents, not %d"
+                             % (len(snapshot.agent_states), len(agents)))
+        objects = []
+        for entry in snapshot.objects:
+            if isinstance(entry, int):
+                objects.append(agents[entry])
+            else:
+                objects.append(new_instance(entry[0]))
+        memo = dict([(id(slot), obj)
+                     for (slot, obj) in zip(snapshot.slots, objects + [self])])
+        restore_items(self, snapshot.state, memo)
+        for (agent, items) in zip(agents, snapshot.agent_states):
+            program = agent.program
+            agent.__dict__.clear()
+            agent.program = program
+            restore_items(agent, items, memo)
+        for (obj, entry) in zip(objects, snapshot.objects):
+            if not isinstance(entry, int):
+                restore_items(obj, entry[1], memo)
+        self.agents = list(agents)
+        self.objects = objects
+
+class Snapshot:
+    """The state of an environment, made by Environment.snapshot.  .agents
+    holds the environment's agents themselves, for restore; it is dropped
+    when the snapshot is pickled, since the agents can not be."""
+
+    def __init__(self, cls, state, objects, agent_states, slots, agents):
+        self.cls, self.state, self.objects = cls, state, objects
+        self.agent_states, self.slots = agent_states, slots
+        self.agents = agents
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['agents'] = None
+        return state
+
+class Slot:
+    "Stands, in a Snapshot, for a reference to the environment or an object."
+    pass
+
+def snapshot_items(attributes, exclude, memo):
+    """The (name, value) pairs of a dict of attributes, as kept in a snapshot;
+    memo is as for copy_value."""
+    return tuple([(name, copy_value(value, memo))
+                  for (name, value) in attributes.items()
+                  if name not in exclude])
+
+def restore_items(object, items, memo):
+    """Set the attributes of object from (name, value) pairs in a snapshot;
+    memo is as for copy_value."""
+    for (name, value) in items:
+        setattr(object, name, copy_value(value, memo))
+
+def copy_value(value, memo):
+    """A copy of value, shared by no one else.  Plain data -- None, numbers,
+    strings, and tuples of them -- is immutable and kept as it is; a list,
+    dict, set or deque of plain data is copied; anything else is deep-copied
+    with memo, which maps the id of each object to put in its place."""
+    if is_plain(value):
+        return value
+    if type(value) in (list, set, collections.deque):
+        if all_plain(value):
+            return copy.copy(value)
+    elif type(value) is dict:
+        if all_plain(value.keys()) and all_plain(value.values()):
+            return value.copy()
+    return copy.deepcopy(value, memo)
+
+def is_plain(value):
+    "Is value None, a number, a string, or a tuple of such plain values?"
+    if type(value) is tuple:
+        return all_plain(value)
+    return value is None or type(value) in plain_types
+
+plain_types = (bool, int, long, float, complex, str, unicode)
+
+def all_plain(values):
+    "Are all the values plain (see is_plain)?"
+    for value in values:
+        if not is_plain(value):
+            return False
+    return True
+
+def restore_environment(snapshot, agents=()):
+    """A new environment in the state of a snapshot (see Environment.snapshot),
+    with the given agents in the places of the snapshot's agents."""
+    env = new_instance(snapshot.cls)
+    env.restore(snapshot, agents)
+    return env
+
+def new_instance(cls):
+    "An instance of cls, made without calling its __init__ (as copy does)."
+    if isinstance(cls, type):
+        return cls.__new__(cls)
+    return types.InstanceType(cls)
     
 
 class XYEnvironment(Environment):
@@ -224,25 +372,49 @@ class XYEnvironment(Environment):
     perceive objects within a radius.  Each agent in the environment
     has a .location slot which should be a location such as (0, 1),
     and a .holding slot, which should be a list of objects that are
-    held """
+    held.  The objects are also kept in .cells, by the unit square of
+    the grid they are in, so that finding the objects at or near a
+    location only looks in the cells around it.  Objects should move
+    with move_to and leave with delete_object, to keep .cells up to date."""
+
+    perceptible_distance = 1
 
     def __init__(self, width=10, height=10):
-        update(self, objects=[], agents=[], width=width, height=height)
+        Environment.__init__(self)
+        self.width, self.height = width, height
+        self.cells = {}     ## (x, y) rounded down -> objects located there
+
+    def cell(self, location):
+        "The cell that holds location: (x, y) rounded down to ints."
+        if location is None: return None
+        return (int(math.floor(location[0])), int(math.floor(location[1])))
 
     def objects_at(self, location):
         "Return all objects exactly at a given location."
-        return [obj for obj in self.objects if obj.location == location]
+        return [obj for obj in self.cells.get(self.cell(location), ())
+                if obj.location == location]
 
     def objects_near(self, location, radius):
-        "Return all objects within radius of location."
+        """Return all objects within radius of location.  Only the cells in
+        the square around location that holds the circle are looked at
+        (or every cell that has objects, if there are fewer of those)."""
         radius2 = radius * radius
-        return [obj for obj in self.objects
+        x0, y0 = self.cell((location[0] - radius, location[1] - radius))
+        x1, y1 = self.cell((location[0] + radius, location[1] + radius))
+        cells = self.cells
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(cells):
+            groups = [objs for (c, objs) in cells.items() if c is not None]
+        else:
+            groups = [cells.get((x, y), ()) for x in xrange(x0, x1 + 1)
+                      for y in xrange(y0, y1 + 1)]
+        return [obj for objs in groups for obj in objs
                 if distance2(location, obj.location) <= radius2]
 
     def percept(self, agent):
         "By default, agent perceives objects within radius r."
         return [self.object_percept(obj, agent)
-                for obj in self.objects_near(agent)]
+                for obj in self.objects_near(agent.location,
+                                             self.perceptible_distance)]
 
     def execute_action(self, agent, action):
         if action == 'TurnRight':
@@ -250,7 +422,7 @@ class XYEnvironment(Environment):
         elif action == 'TurnLeft':
             agent.heading = turn_heading(agent.heading, +1)
         elif action == 'Forward':
-            self.move_to(agent, vector_add(agent.heading, agent.location))
+            self.move_to(agent, update_location(agent.location, agent.heading))
         elif action == 'Grab':
             objs = [obj for obj in self.objects_at(agent.location)
                     if obj.is_grabable(agent)]
@@ -268,14 +440,42 @@ class XYEnvironment(Environment):
     def default_location(self, object):
         return (random.choice(self.width), random.choice(self.height))
 
-    def move_to(object, destination):
+    def move_to(self, object, destination):
         "Move an object to a new location."
-        
+        self.remove_from_cell(object)
+        object.location = destination
+        self.add_to_cell(object)
+
     def add_object(self, object, location=(1, 1)):
         Environment.add_object(self, object, location)
         object.holding = []
         object.held = None
-        self.objects.append(object)
+        self.add_to_cell(object)
+
+    snapshot_exclude = Environment.snapshot_exclude + ('cells',)
+
+    def restore(self, snapshot, agents=None):
+        Environment.restore(self, snapshot, agents)
+        self.cells = {}
+        for obj in self.objects:
+            self.add_to_cell(obj)
+
+    def delete_object(self, object):
+        "Remove an object from the environment."
+        self.remove_from_cell(object)
+        self.objects.remove(object)
+        if object in self.agents:
+            self.agents.remove(object)
+
+    def add_to_cell(self, object):
+        self.cells.setdefault(self.cell(object.location), []).append(object)
+
+    def remove_from_cell(self, object):
+        c = self.cell(object.location)
+        objs = self.cells[c]
+        objs.remove(object)
+        if not objs:
+            del self.cells[c]
 
     def add_walls(self):
         "Put walls around the entire perimeter of the grid."
@@ -392,17 +592,31 @@ class Wumpus(Object): pass
 class Explorer(Agent): pass
 
 class WumpusEnvironment(XYEnvironment):
+    """The wumpus world.  After each step, every function in .observers is
+    called with the environment; with display=True (the default) that is a
+    WumpusDisplay, which redraws the grid on the terminal and pauses, and
+    with display=False the environment runs headless.  .log holds the
+    last log_size events, each a tuple (step, agent name, kind, detail)
+    as in event_messages; format_event turns one into a line of text."""
     object_classes = [Wall, Gold, Pit, Arrow, Wumpus, Explorer]
-    def __init__(self, width=10, height=10):
-        self.objects=[]
-        self.agents=[]
-        self.width=width
-        self.height=height
+
+    log_size = 1000
+    event_messages = {'acted': '%s acted: %s',
+                      'bump': '%s hit the wall',
+                      'dies': '%s meats %s and dies(-1000 points)',
+                      'grab': '%s grabbed the %s(+1000 points)',
+                      'shoot': '%s shoot an arrow(-10 points)',
+                      'kill': '%s killed %s'}
+
+    def __init__(self, width=10, height=10, display=True, log_size=None):
+        XYEnvironment.__init__(self, width, height)
         self.score = 0
-        self.log = ""
+        self.log = collections.deque(maxlen=log_size or self.log_size)
+        self.observers = []
+        if display:
+            self.observers.append(WumpusDisplay())
         self.steps = 0
         self.Scream = False
-        # XYEnvironment.__init__(self, width, height)
         self.add_walls()
 
 ############################################################################
@@ -430,29 +644,15 @@ class WumpusEnvironment(XYEnvironment):
 
        
 
-    # def objects_at(self, location):
-    #     "Return all objects exactly at a given location."
-    #     return [obj for obj in self.objects if obj.location == location]
-
-    def objects_near(self, location, radius):
-
-
-        "Return all objects within radius of location."
-        radius2 = radius * radius
-        return [obj for obj in self.objects
-                if distance2(location, obj.location) <= radius2]
-
-
     def step(self):
         if not self.is_done():
             actions = [agent.program(self.percept(agent))
                        for agent in self.agents]
             for (agent, action) in zip(self.agents, actions):
                 self.execute_action(agent, action)
-            clear_screen()
             self.steps+=1
-            self.draw_grid()
-            time.sleep(TIME_DELAY)
+            for observer in self.observers:
+                observer(self)
             self.exogenous_change()
 
     def exogenous_change(self):
@@ -460,10 +660,21 @@ class WumpusEnvironment(XYEnvironment):
             self.Scream = False
 
 
+    def log_event(self, agent, kind, detail=None):
+        "Add an event to the log."
+        self.log.append((self.steps, agent.__class__.__name__, kind, detail))
+
+    def format_event(self, event):
+        "The line of text for a logged event."
+        step, name, kind, detail = event
+        if detail is None:
+            text = self.event_messages[kind] % name
+        else:
+            text = self.event_messages[kind] % (name, detail)
+        return ' #%03d: %s' % (step, text)
+
     def execute_action(self, agent, action):
-        self.log = "{}\n #{}{}: {} acted: {}".format(
-                        self.log,"0"*(3-len(str(self.steps))), self.steps, 
-                        agent.__class__.__name__, action)
+        self.log_event(agent, 'acted', action)
         if action == 'TurnRight':
             agent.direction = turn_heading(agent.direction, +1)
         elif action == 'TurnLeft':
@@ -476,60 +687,47 @@ class WumpusEnvironment(XYEnvironment):
                 if isinstance(obj, Wall):
                     agent.Bump = True
                     can_move = False
-                    self.log = "{}\n #{}{}: {} hit the wall".format(
-                        self.log,"0"*(3-len(str(self.steps))), self.steps, 
-                        agent.__class__.__name__)
+                    self.log_event(agent, 'bump')
                 elif isinstance(obj, Pit) or isinstance(obj, Wumpus):
-                    self.log = "{}\n #{}{}: {} meats {} and dies(-1000 points)".format(
-                        self.log,"0"*(3-len(str(self.steps))), self.steps,
-                        agent.__class__.__name__, obj.__class__.__name__)
+                    self.log_event(agent, 'dies', obj.__class__.__name__)
                     # print"agent meats {} and dies".format(obj.__class__.__name__)
                     self.score-=1000
                     can_move = False
                     agent.is_alive = False
-                    self.agents.remove(agent)
-                    self.objects.remove(agent)
+                    self.delete_object(agent)
+                    break
             if can_move:
-                agent.location=new_location
+                self.move_to(agent, new_location)
                 self.score-=1
 
         elif action == 'Grab':
             for obj in self.objects_at(agent.location):
                 if isinstance(obj, Gold):
-                    self.log = "{}\n #{}{}: {} grabbed the Gold(+1000 points)".format(
-                        self.log,"0"*(3-len(str(self.steps))), self.steps,
-                        agent.__class__.__name__)
+                    self.log_event(agent, 'grab', obj.__class__.__name__)
                     self.score+=1000
                     agent.holding = obj
-                    self.objects.remove(obj)
+                    self.delete_object(obj)
         #rewrite
         elif action == 'Release':
             if agent.holding:
                 agent.holding.pop()
 
         elif action == 'Shoot':
-            self.log = "{}\n #{}{}: {} shoot an arrow(-10 points)".format(
-                        self.log,"0"*(3-len(str(self.steps))), self.steps,
-                        agent.__class__.__name__)
+            self.log_event(agent, 'shoot')
             arrow_location = agent.location
             self.score-=10
             for i in xrange(max(self.width, self.height)):
                 arrow_location=update_location(arrow_location,agent.direction)
                 for obj in self.objects_at(arrow_location):
                     if isinstance(obj, Wumpus):
-                        self.log = "{}\n #{}{}: {} killed Wumpus".format(
-                        self.log,"0"*(3-len(str(self.steps))), self.steps,
-                        agent.__class__.__name__)
-                        self.objects.remove(obj)
+                        self.log_event(agent, 'kill', obj.__class__.__name__)
+                        self.delete_object(obj)
                         self.Scream = True
 
         agent.bump = False
         
     def add_object(self, object, location=(1, 1), direction=(1,0)):
-        Environment.add_object(self, object, location)
-        object.holding = []
-        object.held = None
-        object.location = location
+        XYEnvironment.add_object(self, object, location)
         if isinstance(object, Agent):
             object.direction = direction
             object.Bump = False
@@ -572,7 +770,9 @@ class WumpusEnvironment(XYEnvironment):
             print""
         print"________"*self.width + "_"
         print"Score: {}".format(self.score)
-        print self.log
+        print
+        for event in self.log:
+            print self.format_event(event)
         # for agent in self.agents:
         #     print"agent {} is {}".format(agent.__class__.__name__, "alive" if agent.is_alive() else "dead")
 
@@ -582,12 +782,158 @@ class WumpusEnvironment(XYEnvironment):
         return True
         
 def distance2(location1, location2):
-        return math.sqrt(math.pow(location1[0] - location2[0],2) 
-                        + math.pow(location1[1] - location2[1],2)) 
+    "The square of the distance between two locations."
+    dx, dy = location1[0] - location2[0], location1[1] - location2[1]
+    return dx * dx + dy * dy
 
 def update_location(location, vector):
     return (location[0]+vector[0],location[1]+vector[1])
     
+#______________________________________________________________________________
+## Many wumpus worlds at once
+
+class BatchWumpusEnvironment:
+    """n wumpus worlds of width x height squares, each with one agent, that
+    step in lockstep by NumPy array operations rather than a Python object
+    per world.  The layouts are boolean arrays indexed [world, x, y] --
+    .walls (around the edge, as add_walls puts them), .pits and .wumpus --
+    and .gold counts the gold on each square.  For each world, .x, .y and
+    .heading (an index into headings) place the agent, and .alive, .bump,
+    .scream, .score and .steps are as in WumpusEnvironment, whose rules and
+    scoring these are.  (Release does nothing, since a grab does not put
+    the gold in a list.)  An action is an index into actions.  (The example
+    is skipped by doctest, since NumPy is optional; see tests/test_agents.py.)
+    >>> env = BatchWumpusEnvironment(2, 4, 4)      # doctest: +SKIP
+    >>> env.pits[1, 2, 1] = True                    # doctest: +SKIP
+    >>> env.step([env.actions.index('Forward')] * 2) # doctest: +SKIP
+    >>> env.x, env.alive, env.score                  # doctest: +SKIP
+    (array([2, 1]), array([ True, False]), array([   -1, -1000]))
+    """
+
+    actions = ('Forward', 'TurnRight', 'TurnLeft', 'Grab', 'Release', 'Shoot')
+    headings = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+
+    def __init__(self, n, width=10, height=10):
+        if numpy is None:
+            raise ImportError("BatchWumpusEnvironment needs NumPy")
+        self.n, self.width, self.height = n, width, height
+        shape = (n, width, height)
+        self.walls = numpy.zeros(shape, bool)
+        self.walls[:, 0, :] = self.walls[:, -1, :] = True
+        self.walls[:, :, 0] = self.walls[:, :, -1] = True
+        self.pits = numpy.zeros(shape, bool)
+        self.wumpus = numpy.zeros(shape, bool)
+        self.gold = numpy.zeros(shape, int)
+        self.x = numpy.ones(n, int)
+        self.y = numpy.ones(n, int)
+        self.heading = numpy.zeros(n, int)
+        self.alive = numpy.ones(n, bool)
+        self.bump = numpy.zeros(n, bool)
+        self.scream = numpy.zeros(n, bool)
+        self.score = numpy.zeros(n, int)
+        self.steps = numpy.zeros(n, int)
+        self.worlds = numpy.arange(n)
+        self.dx = numpy.array([dx for (dx, dy) in self.headings])
+        self.dy = numpy.array([dy for (dx, dy) in self.headings])
+
+    def from_environments(cls, envs):
+        """A batch of the worlds of WumpusEnvironments that all have the same
+        size and one agent (or none, once it has died)."""
+        env = envs[0]
+        batch = cls(len(envs), env.width, env.height)
+        for i, env in enumerate(envs):
+            if (env.width, env.height) != (batch.width, batch.height):
+                raise ValueError("The environments differ in size")
+            batch.walls[i] = False
+            for obj in env.objects:
+                x, y = obj.location
+                if isinstance(obj, Wall): batch.walls[i, x, y] = True
+                elif isinstance(obj, Pit): batch.pits[i, x, y] = True
+                elif isinstance(obj, Wumpus): batch.wumpus[i, x, y] = True
+                elif isinstance(obj, Gold): batch.gold[i, x, y] += 1
+            if len(env.agents) > 1:
+                raise ValueError("An environment has more than one agent")
+            batch.alive[i] = bool(env.agents)
+            for agent in env.agents:
+                batch.x[i], batch.y[i] = agent.location
+                batch.heading[i] = cls.headings.index(agent.direction)
+                batch.bump[i] = agent.Bump
+            batch.score[i], batch.steps[i] = env.score, env.steps
+            batch.scream[i] = env.Scream
+        return batch
+    from_environments = classmethod(from_environments)
+
+    def near(self, layout):
+        "For each world, is layout true at the agent's square or next to it?"
+        result = layout[self.worlds, self.x, self.y]
+        for (dx, dy) in self.headings:
+            x = numpy.clip(self.x + dx, 0, self.width - 1)
+            y = numpy.clip(self.y + dy, 0, self.height - 1)
+            inside = (x == self.x + dx) & (y == self.y + dy)
+            result = result | (inside & layout[self.worlds, x, y])
+        return result
+
+    def percept(self):
+        """The percepts of all the agents, as arrays: (x, y, heading, stench,
+        breeze, glitter, bump, scream).  As in WumpusEnvironment, a bump is
+        perceived once."""
+        bump, self.bump = self.bump, numpy.zeros(self.n, bool)
+        glitter = self.gold[self.worlds, self.x, self.y] > 0
+        return (self.x.copy(), self.y.copy(), self.heading.copy(),
+                self.near(self.wumpus), self.near(self.pits), glitter,
+                bump, self.scream.copy())
+
+    def step(self, actions):
+        """Do an action (an index into actions) in each world whose agent is
+        alive; the others stay as they are."""
+        actions = numpy.asarray(actions)
+        live = self.alive.copy()
+        w = self.worlds
+        act = dict([(name, live & (actions == i))
+                    for (i, name) in enumerate(self.actions)])
+        self.heading[act['TurnRight']] += 1
+        self.heading[act['TurnLeft']] -= 1
+        self.heading %= len(self.headings)
+        ## Forward
+        go = act['Forward']
+        nx = numpy.clip(self.x + self.dx[self.heading], 0, self.width - 1)
+        ny = numpy.clip(self.y + self.dy[self.heading], 0, self.height - 1)
+        dies = go & (self.pits[w, nx, ny] | self.wumpus[w, nx, ny])
+        bumps = go & self.walls[w, nx, ny] & ~dies
+        moves = go & ~dies & ~bumps
+        self.bump |= bumps
+        self.alive &= ~dies
+        self.score -= 1000 * dies + moves
+        self.x = numpy.where(moves, nx, self.x)
+        self.y = numpy.where(moves, ny, self.y)
+        ## Grab
+        grab = act['Grab']
+        self.score += 1000 * grab * self.gold[w, self.x, self.y]
+        self.gold[w[grab], self.x[grab], self.y[grab]] = 0
+        ## Shoot: the arrow flies on for max(width, height) squares
+        shoot = act['Shoot']
+        self.score -= 10 * shoot
+        ax, ay = self.x.copy(), self.y.copy()
+        dx, dy = self.dx[self.heading], self.dy[self.heading]
+        for i in xrange(max(self.width, self.height)):
+            ax, ay = ax + dx, ay + dy
+            inside = (shoot & (ax >= 0) & (ax < self.width) &
+                      (ay >= 0) & (ay < self.height))
+            hit = numpy.zeros(self.n, bool)
+            hit[inside] = self.wumpus[w[inside], ax[inside], ay[inside]]
+            self.wumpus[w[hit], ax[hit], ay[hit]] = False
+            self.scream |= hit
+        self.steps += live
+        ## The scream only lasts the step, as in exogenous_change
+        self.scream[live] = False
+
+    def run(self, policy, steps=1000):
+        """Run the worlds for steps, or until every agent is dead.  policy
+        maps the percept arrays to an array of actions."""
+        for step in xrange(steps):
+            if not self.alive.any(): return
+            self.step(policy(self.percept()))
+
 ########################################################################
 class WumpusWorldAgent(Agent):
     """This agent takes action based solely on the percept. [Fig. 2.13]"""
@@ -624,25 +970,112 @@ class WumpusWorldAgent(Agent):
         return self.alive
 #______________________________________________________________________________
 
-def compare_agents(EnvFactory, AgentFactories, n=10, steps=1000):
+def compare_agents(EnvFactory, AgentFactories, n=10, steps=1000,
+                   seed=None, workers=None, variance=False):
     """See how well each of several agents do in n instances of an environment.
     Pass in a factory (constructor) for environments, and several for agents.
     Create n instances of the environment, and run each agent in copies of 
-    each one for steps. Return a list of (agent, average-score) tuples."""
+    each one for steps. Return a list of (agent, average-score) tuples.
+    With variance, the tuples are (agent, average-score, variance).
+    seed and workers are as in agent_runs."""
     envs = [EnvFactory() for i in range(n)]
-    return [(A, test_agent(A, steps, copy.deepcopy(envs))) 
-            for A in AgentFactories]
-
-def test_agent(AgentFactory, steps, envs):
-    "Return the mean score of running an agent in each of the envs, for steps"
-    total = 0
-    for env in envs:
-        agent = AgentFactory()
-        env.add_object(agent)
-        env.run(steps)
-        total += agent.performance
-    return float(total)/len(envs)
-
+    scores = [[None] * n for A in AgentFactories]
+    for (i, j, score) in agent_runs(AgentFactories, steps, envs, seed, workers):
+        scores[i][j] = score
+    result = []
+    for A, s in zip(AgentFactories, scores):
+        mean, var = mean_variance(s)
+        if variance:
+            result.append((A, mean, var))
+        else:
+            result.append((A, mean))
+    return result
+
+def test_agent(AgentFactory, steps, envs, seed=None, workers=None,
+               copies=False):
+    """Return the mean score of running an agent in each of the envs, for steps.
+    Each agent is added to its env and run there, so the envs are changed.
+    With copies, each run is in a copy of its env instead (in a worker
+    process, with workers), and the envs are left as they were.  seed is as
+    in agent_runs, and so is workers, which needs copies."""
+    if copies:
+        scores = [score for (i, j, score)
+                  in agent_runs([AgentFactory], steps, envs, seed, workers)]
+    elif workers > 1:
+        raise ValueError("Runs in worker processes need copies=True")
+    else:
+        scores = [run_in(AgentFactory, env, steps, seed, 0, j)
+                  for (j, env) in enumerate(envs)]
+    return mean_variance(scores)[0]
+
+def agent_runs(AgentFactories, steps, envs, seed=None, workers=None):
+    """Run each agent in a copy of each of the envs for steps, and generate
+    (agent index, env index, score) for each run.  With a seed, the random
+    module is seeded before each run from (seed, agent index, env index),
+    so each run is reproducible on its own.  With workers > 1, the runs are
+    spread over a pool of that many processes and generated as they finish,
+    in any order; a seed is then drawn if none is given, and the factories
+    and envs must be picklable (defined at the top level of a module).
+    Each run gives the same score in either mode."""
+    ## Ship snapshots rather than whole environments, when no agents are in them.
+    envs = [(env.agents and env) or env.snapshot() for env in envs]
+    jobs = [(A, env, steps, seed, i, j)
+            for (i, A) in enumerate(AgentFactories)
+            for (j, env) in enumerate(envs)]
+    if not workers or workers <= 1:
+        for job in jobs:
+            yield run_agent(job)
+        return
+    if seed is None:
+        seed = random.randrange(1 << 30)
+    jobs = [(A, env, steps, seed, i, j) for (A, env, steps, s, i, j) in jobs]
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(run_agent, jobs):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def run_agent((AgentFactory, env, steps, seed, i, j)):
+    """Run a new agent in a copy of env (an environment, or the snapshot of
+    one), as run_in does; return (i, j, score)."""
+    if isinstance(env, Snapshot):
+        env = restore_environment(env)
+    else:
+        env = copy.deepcopy(env)
+    return i, j, run_in(AgentFactory, env, steps, seed, i, j)
+
+def run_in(AgentFactory, env, steps, seed, i, j):
+    """Add a new agent to env and run it for steps, seeding random first from
+    (seed, i, j) if there is a seed; return the agent's score."""
+    if seed is not None:
+        random.seed((seed, i, j))
+    agent = AgentFactory()
+    env.add_object(agent)
+    env.run(steps)
+    return agent.performance
+
+def mean_variance(scores):
+    "The mean and the (population) variance of a list of numbers."
+    n = len(scores)
+    mean = float(sum(scores)) / n
+    return mean, sum([(x - mean) ** 2 for x in scores]) / n
+
+
+class WumpusDisplay:
+    """An observer for a WumpusEnvironment that redraws its grid on the
+    terminal, then pauses for delay seconds (TIME_DELAY by default)."""
+
+    def __init__(self, delay=None):
+        self.delay = delay
+
+    def __call__(self, env):
+        clear_screen()
+        env.draw_grid()
+        delay = self.delay
+        if delay is None: delay = TIME_DELAY
+        time.sleep(delay)
 
 def clear_screen():
     """Clear screen, return cursor to top left"""
@@ -15,18 +15,27 @@ Then we implement various functions for doing logical inference:
     tt_entails       Say if a statement is entailed by a KB
     pl_resolution    Do resolution on propositional sentences
     dpll_satisfiable See if a propositional sentence is satisfiable
-    WalkSAT          (not yet implemented)
+    portfolio_satisfiable  The same, with several solvers in parallel
+    WalkSAT          Local search for a model of propositional sentences
+    fol_bc_ask       Backward chaining on first-order definite clauses
+    fol_fc_ask       Forward chaining on first-order definite clauses
 
 And a few other functions:
 
     to_cnf           Convert to conjunctive normal form
     unify            Do unification of two FOL sentences
     diff, simp       Symbolic differentiation and simplification             
+    compile_expr     Compile an arithmetic Expr into a numeric function
 """
 
 from __future__ import generators
-import re
-import agents, random
+import re, heapq, weakref, collections, operator, itertools, math
+import array, multiprocessing
+import agents, random, time
+try:
+    import numpy
+except ImportError:
+    numpy = None
 #from utils import *
 import utils_lpw
 #import utils as utils_lpw
@@ -34,7 +43,7 @@ import utils_lpw
 
 #______________________________________________________________________________
 
-class KB:
+class KB(object):
     """A Knowledge base to which you can tell and ask sentences.
     To create a KB, first subclass this class and implement
     tell, ask_generator, and retract.  Why ask_generator instead of ask?  
@@ -60,6 +69,11 @@ class KB:
         except StopIteration:
             return False
 
+    def ask_many(self, queries):
+        """Return the list of answers that ask gives for each of the queries.
+        Subclasses may share the work across the batch."""
+        return [self.ask(query) for query in queries]
+
     def ask_generator(self, query): 
         "Yield all the substitutions that make query true."
         abstract
@@ -70,16 +84,29 @@ class KB:
 
 
 class PropKB(KB):
-    "A KB for Propositional Logic.  Inefficient, with no indexing."
+    """A KB for Propositional Logic.  Inefficient, with no indexing.
+    With cnf='tseitin' or 'pg', sentences are converted to CNF in linear
+    size by naming subsentences with new symbols (see TseitinEncoder)."""
 
-    def __init__(self, sentence=None):
+    def __init__(self, sentence=None, cnf='distribute'):
         self.clauses = []
+        self.encoder = cnf_encoder(cnf)
+        self.definitions = set() ## definitional clauses added so far
         if sentence:
             self.tell(sentence)
 
     def tell(self, sentence): 
         "Add the sentence's clauses to the KB"
-        self.clauses.extend(conjuncts(to_cnf(sentence)))        
+        roots, definitions = self.sentence_clauses(sentence)
+        self.add_definitions(definitions)
+        self.clauses.extend(roots)
+
+    def sentence_clauses(self, sentence):
+        """Return (roots, definitions): the clauses that assert sentence, and
+        any definitional clauses for new symbols that the KB lacks so far."""
+        if self.encoder is None:
+            return conjuncts(to_cnf(sentence)), []
+        return self.encoder.encode(sentence)
 
     def ask_generator(self, query): 
         "Yield the empty substitution if KB implies query; else False"
@@ -88,13 +115,449 @@ class PropKB(KB):
         yield {}
 
     def retract(self, sentence):
-        "Remove the sentence's clauses from the KB"
-        for c in conjuncts(to_cnf(sentence)):
+        """Remove the sentence's clauses from the KB.  Definitions of new
+        symbols stay: they say nothing about the other symbols."""
+        roots, definitions = self.sentence_clauses(sentence)
+        self.add_definitions(definitions)
+        for c in roots:
             if c in self.clauses:
                 self.clauses.remove(c)
 
+    def add_definitions(self, definitions):
+        """Add the definitional clauses that the KB lacks, so each is added
+        once however often the sentences that need it come and go."""
+        for c in definitions:
+            if c not in self.definitions:
+                self.definitions.add(c)
+                self.clauses.append(c)
+
+    def count_models(self, weights=None):
+        """The number of models of the KB over its symbols.  With weights, a
+        dict from literals (P or ~P) to numbers, a model counts instead as
+        the product of the weights of its literals (missing ones weigh 1).
+        The count is exact, by a ModelCounter.
+        >>> PropKB(expr('A | B')).count_models()
+        3
+        """
+        return self.model_count([], [], weights)
+
+    def probability(self, query, weights=None):
+        """The probability that query is true in a model of the KB picked at
+        random, each model with the chance given by its weight (as in
+        count_models).
+        >>> PropKB(expr('A | B')).probability(expr('A'))
+        0.6666666666666666
+        """
+        query = expr(query)
+        symbols = prop_symbols(query)
+        total = self.model_count([], symbols, weights)
+        if not total:
+            raise ValueError("The KB has no models")
+        return self.model_count(conjuncts(to_cnf(query)), symbols,
+                                weights) / float(total)
+
+    def model_count(self, clauses, symbols, weights=None):
+        """The weighted count of the models of the KB's clauses and the given
+        ones, over their symbols and the given symbols.  New symbols from
+        cnf='tseitin' are defined by the others, so they leave the count as
+        it is, but those from cnf='pg' are not, so those KBs are refused."""
+        if self.encoder is not None and self.encoder.method == 'pg':
+            raise ValueError("A KB with cnf='pg' does not keep model counts")
+        symtab = SymbolTable()
+        clauses = list(self.clauses) + list(clauses)
+        for s in clauses + list(symbols):
+            for p in prop_symbols(s):
+                symtab.var(p)
+        variables = range(1, len(symtab) + 1)
+        ints = [c for c in map(symtab.clause, clauses) if c is not None]
+        w = {}
+        for lit, value in (weights or {}).items():
+            w[symtab.literal(expr(lit))] = value
+        return ModelCounter(w).count(ints, variables)
+
+def cnf_encoder(cnf):
+    "Return the TseitinEncoder for a KB's cnf option, or None for 'distribute'."
+    if cnf == 'distribute': return None
+    return TseitinEncoder(cnf)
+
 #______________________________________________________________________________
-    
+# Integer-literal clause store
+
+class SymbolTable:
+    """Interns proposition symbols as the ints 1, 2, 3, ... so that a literal
+    can be a signed int, as in the DIMACS format: P is +i and ~P is -i.
+    A clause is then a sorted tuple of such literals.
+    >>> t = SymbolTable()
+    >>> t.clause(expr('~B | A | B'))
+    >>> t.clause(expr('~B | A'))
+    (-1, 2)
+    """
+
+    def __init__(self):
+        self.index = {}         ## symbol -> int
+        self.symbols = [None]   ## int -> symbol (slot 0 is unused)
+
+    def __len__(self):
+        return len(self.symbols) - 1
+
+    def var(self, symbol):
+        "Return the int for symbol, interning it if it has not been seen."
+        i = self.index.get(symbol)
+        if i is None:
+            i = len(self.symbols)
+            self.index[symbol] = i
+            self.symbols.append(symbol)
+        return i
+
+    def new_var(self, prefix):
+        "Intern and return a new symbol named prefix followed by its int."
+        return self.var(Expr('%s%d' % (prefix, len(self.symbols))))
+
+    def literal(self, literal):
+        """Return the signed int for an Expr literal such as P or ~P; raise
+        ValueError for any other Expr, TRUE and FALSE included."""
+        if literal.op == '~':
+            atom, sign = literal.args[0], -1
+        else:
+            atom, sign = literal, 1
+        if not is_symbol(atom.op) or atom == TRUE or atom == FALSE:
+            raise ValueError("%s is not a literal" % (literal,))
+        return sign * self.var(atom)
+
+    def clause(self, clause):
+        """Return the clause (an Expr disjunction of literals) as a sorted tuple
+        of ints, or None if the clause is always true."""
+        lits = set()
+        todo = [clause]
+        while todo:
+            d = todo.pop()
+            if d.op == '|':
+                todo.extend(d.args)
+                continue
+            if d == TRUE or d == ~FALSE: return None
+            if d == FALSE or d == ~TRUE: continue
+            lits.add(self.literal(d))
+        for lit in lits:
+            if -lit in lits: return None
+        return tuple(sorted(lits))
+
+    def expr_literal(self, lit):
+        "Return the Expr for a signed int literal."
+        if lit < 0: return ~self.symbols[-lit]
+        return self.symbols[lit]
+
+    def expr_clause(self, clause):
+        "Return the Expr disjunction for a tuple of int literals."
+        return NaryExpr('|', *[self.expr_literal(lit) for lit in clause])
+
+
+class IntPropKB(PropKB):
+    """A PropKB that interns each symbol to an int and stores each clause as a
+    tuple of signed int literals.  An occurrence index maps every literal to
+    the ids of the clauses it appears in, so tell and retract only touch the
+    clauses of the sentence at hand.  ask checks that KB & ~query is
+    unsatisfiable with one CDCLSolver kept for the life of the KB: told
+    clauses are added to it as they come, and the clauses of ~query are
+    added guarded by a new symbol Ask_n that is then solved as an
+    assumption, so learned clauses and activities carry over from query to
+    query.  (A retract starts a new solver, keeping only the activities.)
+    ask_many answers queries that are conjunctions of literals from the
+    backbone of the KB (the literals true in every model), which is found
+    once for the symbols of the batch and kept until the clauses change.
+    >>> kb = IntPropKB(expr('A & (A ==> B)'))
+    >>> kb.ask(expr('B'))
+    {}
+    >>> kb.retract(expr('A'))
+    >>> kb.ask(expr('B'))
+    False
+    """
+
+    def __init__(self, sentence=None, cnf='distribute'):
+        self.encoder = cnf_encoder(cnf)
+        self.definitions = set() ## definitional clauses added so far
+        self.symtab = SymbolTable()
+        self.store = []         ## clause id -> tuple of ints, or None if freed
+        self.free_ids = []      ## ids of retracted clauses, for reuse
+        self.ids = {}           ## tuple of ints -> list of clause ids
+        self.occurrences = {}   ## literal -> set of clause ids
+        self.solver = None      ## CDCLSolver over the store, made on demand
+        self.retired_solver = None
+        self.query_vars = {}    ## query -> var that switches on its negation
+        self.backbone = None    ## var -> implied literal or 0, as found so far
+        self.backbone_model = None
+        if sentence:
+            self.tell(sentence)
+
+    def clauses(self):
+        "The clauses of the KB, as Exprs (for code that expects PropKB)."
+        return [self.symtab.expr_clause(c) for c in self.store if c is not None]
+    clauses = property(clauses)
+
+    def tell(self, sentence):
+        "Add the sentence's clauses to the KB"
+        roots, definitions = self.sentence_clauses(sentence)
+        self.add_definitions(definitions)
+        for c in roots:
+            self.add_clause(self.symtab.clause(c))
+
+    def add_definitions(self, definitions):
+        for c in definitions:
+            if c not in self.definitions:
+                self.definitions.add(c)
+                self.add_clause(self.symtab.clause(c))
+
+    def add_clause(self, clause):
+        "Add a tuple of int literals to the store and the occurrence index."
+        if clause is None: return
+        if self.free_ids:
+            cid = self.free_ids.pop()
+            self.store[cid] = clause
+        else:
+            cid = len(self.store)
+            self.store.append(clause)
+        self.ids.setdefault(clause, []).append(cid)
+        for lit in clause:
+            self.occurrences.setdefault(lit, set()).add(cid)
+        if self.solver is not None:
+            self.solver.add_clause(clause)
+        self.backbone = None
+
+    def retract(self, sentence):
+        "Remove the sentence's clauses from the KB"
+        roots, definitions = self.sentence_clauses(sentence)
+        self.add_definitions(definitions)
+        for c in roots:
+            self.remove_clause(self.symtab.clause(c))
+
+    def remove_clause(self, clause):
+        "Remove one copy of a tuple of int literals, if it is in the store."
+        cids = self.ids.get(clause)
+        if not cids: return
+        cid = cids.pop()
+        if not cids: del self.ids[clause]
+        for lit in clause:
+            self.occurrences[lit].discard(cid)
+        self.store[cid] = None
+        self.free_ids.append(cid)
+        if self.solver is not None:
+            self.retired_solver, self.solver = self.solver, None
+        self.backbone = None
+
+    def ask_generator(self, query):
+        "Yield the empty substitution if KB implies query; else False"
+        solver = self.incremental_solver()
+        if solver.solve([self.query_var(expr(query))]):
+            return
+        yield {}
+
+    def incremental_solver(self):
+        """The KB's CDCLSolver, building it from the store if there is none
+        (at first, or after a retract)."""
+        if self.solver is None:
+            solver = CDCLSolver(len(self.symtab))
+            old = self.retired_solver
+            if old is not None:
+                n = min(old.nvars, solver.nvars) + 1
+                solver.activity[:n] = old.activity[:n]
+                solver.phase[:n] = old.phase[:n]
+                solver.var_inc = old.var_inc
+                solver.rebuild_heap()
+                self.retired_solver = None
+            for c in self.store:
+                if c is not None:
+                    solver.add_clause(c)
+            self.solver, self.query_vars = solver, {}
+        return self.solver
+
+    def query_var(self, query):
+        """The var that, as an assumption, adds ~query to the solver's clauses.
+        Each distinct query gets its guarded clauses once."""
+        var = self.query_vars.get(query)
+        if var is None:
+            roots, definitions = self.sentence_clauses(~query)
+            self.add_definitions(definitions)
+            var = self.query_vars[query] = self.symtab.new_var('Ask_')
+            for c in roots:
+                c = self.symtab.clause(c)
+                if c is not None:
+                    self.solver.add_clause(c + (-var,))
+        return var
+
+    def ask_many(self, queries):
+        """Return the list of answers that ask gives for each of the queries.
+        A query that is a literal or a conjunction of literals is entailed
+        just when each of its literals is implied, so these are looked up in
+        the implied literals over all their symbols, found in one go (TRUE
+        and ~FALSE are dropped from the conjunction); other queries go to
+        ask, on the same solver.
+        >>> kb = IntPropKB(expr('A & (A ==> B) & (C | D)'))
+        >>> kb.ask_many([expr('A & B'), expr('~C'), expr('C | D'), TRUE])
+        [{}, False, {}, {}]
+        """
+        queries = [expr(q) for q in queries]
+        literals = []           ## query -> its int literals, or None
+        for q in queries:
+            lits = []
+            for c in conjuncts(q):
+                if c == TRUE or c == ~FALSE:
+                    continue
+                p = literal_symbol(c)
+                if not is_prop_symbol(p.op) or p.args:
+                    lits = None
+                    break
+                lits.append(self.symtab.literal(c))
+            literals.append(lits)
+        implied = self.implied_literals([abs(lit) for lits in literals
+                                         if lits for lit in lits])
+        answers = []
+        for q, lits in zip(queries, literals):
+            if lits is None:
+                answers.append(self.ask(q))
+            elif implied is None or [lit for lit in lits
+                                     if implied[abs(lit)] != lit] == []:
+                answers.append({})
+            else:
+                answers.append(False)
+        return answers
+
+    def implied_literals(self, vars):
+        """Return {var: lit} for the vars, where lit is var or -var if the KB
+        implies it, or 0 if the KB has models with either value; or None if
+        the KB is unsatisfiable.  Starting from one model, each candidate
+        literal is checked by solving with its negation as an assumption; a
+        model found that way rules out every candidate it falsifies.  The
+        answers are kept until the clauses change.
+        >>> kb = IntPropKB(expr('A & (A ==> B) & (C | D)'))
+        >>> kb.implied_literals([1, 2, 3])
+        {1: 1, 2: 2, 3: 0}
+        """
+        solver = self.incremental_solver()
+        if self.backbone is None:
+            if not solver.solve():
+                return None
+            self.backbone, self.backbone_model = {}, solver.model
+        backbone, model = self.backbone, self.backbone_model
+        candidates = []
+        for v in set(vars):
+            if v in backbone:
+                continue
+            elif v >= len(model):   ## in no clause when the model was found
+                backbone[v] = 0
+            else:
+                candidates.append(utils_lpw.if_(model[v], v, -v))
+        while candidates:
+            lit = candidates.pop()
+            if solver.solve([-lit]):
+                backbone[abs(lit)] = 0
+                model, rest = solver.model, []
+                for c in candidates:
+                    if model[abs(c)] == (c > 0):
+                        rest.append(c)
+                    else:
+                        backbone[abs(c)] = 0
+                candidates = rest
+            else:
+                backbone[abs(lit)] = lit
+                solver.add_clause([lit])
+        return dict([(v, backbone[v]) for v in vars])
+
+def read_dimacs(f, kb=None, prefix='V', chunk_size=1 << 20):
+    """Read a CNF in DIMACS format from f (a file name or an open file) into
+    kb (a new IntPropKB by default), and return kb.  The file is read in
+    chunks of chunk_size bytes, and each clause goes to kb.add_clause as a
+    tuple of ints, with no Exprs made along the way.  DIMACS var k becomes
+    the symbol named on a 'c var k name' comment line (as write_dimacs
+    writes them), or else prefix followed by k.  A '%' line ends the input,
+    as in the SAT competition benchmark files.
+    >>> import StringIO
+    >>> kb = read_dimacs(StringIO.StringIO('p cnf 2 2\\n1 -2 0\\n2 0\\n'))
+    >>> kb.clauses, kb.ask(expr('V1'))
+    ([(~V2 | V1), V2], {})
+    """
+    if kb is None: kb = IntPropKB()
+    if isinstance(f, str):
+        f = open(f, 'rb')
+        try:
+            return read_dimacs(f, kb, prefix, chunk_size)
+        finally:
+            f.close()
+    symtab = kb.symtab
+    mapping = [0]       ## DIMACS var -> kb var (0 if not yet seen)
+    names = {}          ## DIMACS var -> symbol, from comments
+    clause = []
+    rest = ''
+    chunk = True
+    while chunk:
+        chunk = f.read(chunk_size)
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop() if chunk else ''
+        for line in lines:
+            line = line.strip()
+            if not line: continue
+            first = line[0]
+            if first == 'c':
+                words = line.split()
+                if (len(words) == 4 and words[1] == 'var'
+                    and words[2].isdigit()): ## Other comments are free text
+                    names[int(words[2])] = Expr(words[3])
+                continue
+            elif first == 'p':
+                continue
+            elif first == '%':
+                chunk = ''
+                break
+            for lit in map(int, line.split()):
+                if lit == 0:
+                    lits = set(clause)
+                    for l in lits:
+                        if -l in lits: break
+                    else:
+                        kb.add_clause(tuple(sorted(lits)))
+                    clause = []
+                    continue
+                v = abs(lit)
+                if v >= len(mapping):
+                    mapping.extend([0] * (v + 1 - len(mapping)))
+                if not mapping[v]:
+                    mapping[v] = symtab.var(names.get(v) or
+                                            Expr('%s%d' % (prefix, v)))
+                clause.append(utils_lpw.if_(lit > 0, mapping[v], -mapping[v]))
+    if clause:
+        raise ValueError("DIMACS clause without a final 0: %s" % clause)
+    return kb
+
+def write_dimacs(kb, f, names=True):
+    """Write the clauses of kb (a PropKB) to f (a file name or an open file)
+    in DIMACS format, as read_dimacs reads them; with names, a 'c var k
+    name' comment line for each symbol comes first.
+    >>> import StringIO
+    >>> out = StringIO.StringIO()
+    >>> write_dimacs(IntPropKB(expr('A & (A ==> B)')), out, names=False)
+    >>> out.getvalue()
+    'p cnf 2 2\\n1 0\\n-1 2 0\\n'
+    """
+    if isinstance(f, str):
+        f = open(f, 'wb')
+        try:
+            return write_dimacs(kb, f, names)
+        finally:
+            f.close()
+    if isinstance(kb, IntPropKB):
+        symtab, clauses = kb.symtab, [c for c in kb.store if c is not None]
+    else:
+        symtab = SymbolTable()
+        clauses = [c for c in map(symtab.clause, kb.clauses) if c is not None]
+    if names:
+        f.write(''.join(['c var %d %s\n' % (v, symtab.symbols[v])
+                         for v in range(1, len(symtab) + 1)]))
+    f.write('p cnf %d %d\n' % (len(symtab), len(clauses)))
+    for i in range(0, len(clauses), 10000):
+        f.write(''.join(['%s 0\n' % ' '.join(map(str, c))
+                         for c in clauses[i:i + 10000]]))
+
+
+#______________________________________________________________________________
+
 class KB_Agent(agents.Agent):
     """A generic logical knowledge-based agent. [Fig. 7.1]"""
     def __init__(self, KB):
@@ -118,7 +581,9 @@ class KB_Agent(agents.Agent):
 
 #______________________________________________________________________________
 
-class Expr:
+_expr_table = weakref.WeakValueDictionary() ## (type(op), op, args) -> Expr
+
+class Expr(object):
     """A symbolic mathematical expression.  We use this class for logical
     expressions, and for terms within logical expressions. In general, an
     Expr has an op (operator) and a list of args.  The op can be:
@@ -162,13 +627,41 @@ class Expr:
     1 doesn't know how to add an Expr.  (Adding an __radd__ method to Expr
     wouldn't help, because int.__add__ is still called first.) Therefore,
     you should use Expr(1) + x instead, or ONE + x, or expr('1 + x').
+
+    Exprs are immutable and hash-consed: the args are a tuple, the hash is
+    computed once, and constructing an Expr that is structurally equal to a
+    live one returns that same object (from a table of weak references).
+    So x == y is just x is y, and dicts and sets of Exprs are cheap.
     """
 
-    def __init__(self, op, *args):
+    __slots__ = ('op', 'args', '_hash', '__weakref__')
+
+    def __new__(cls, op, *args):
         "Op is a string or number; args are Exprs (or are coerced to Exprs)."
         assert isinstance(op, str) or (utils_lpw.isnumber(op) and not args)
-        self.op = utils_lpw.num_or_str(op)
-        self.args = map(expr, args) ## Coerce args to Exprs
+        op = utils_lpw.num_or_str(op)
+        args = tuple(map(expr, args)) ## Coerce args to Exprs
+        key = (type(op), op, args) ## Keep Expr(2) and Expr(2.0) apart
+        self = _expr_table.get(key)
+        if self is None:
+            self = object.__new__(cls)
+            object.__setattr__(self, 'op', op)
+            object.__setattr__(self, 'args', args)
+            object.__setattr__(self, '_hash', hash(key))
+            _expr_table[key] = self
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Exprs are immutable")
+
+    def __reduce__(self):
+        return (Expr, (self.op,) + self.args)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __call__(self, *args):
         """Self must be a symbol with no args, such as Expr('F').  Create a new
@@ -188,13 +681,16 @@ class Expr:
             return '(%s)' % (' '+self.op+' ').join(map(repr, self.args))
 
     def __eq__(self, other):
-        """x and y are equal iff their ops and args are equal."""
-        return (other is self) or (isinstance(other, Expr) 
-            and self.op == other.op and self.args == other.args)
+        """x and y are equal iff their ops and args are equal; since Exprs are
+        hash-consed, that means iff they are the same object."""
+        return other is self
+
+    def __ne__(self, other):
+        return other is not self
 
     def __hash__(self):
         "Need a hash method so Exprs can live in dicts."
-        return hash(self.op) ^ hash(tuple(self.args))
+        return self._hash
 
     # See http://www.python.org/doc/current/lib/module-operator.html
     # Not implemented: not, abs, pos, concat, contains, *item, *slice
@@ -219,6 +715,9 @@ class Expr:
     
 
 
+_expr_cache = collections.OrderedDict() ## source string -> parsed Expr
+expr_cache_size = 1024                  ## at most this many are cached
+
 def expr(s):
     """Create an Expr representing a logic expression by parsing the input
     string. Symbols and numbers are automatically converted to Exprs.
@@ -229,6 +728,8 @@ def expr(s):
       'x =/= y'   parses as   (x ^ y)     # Logical disequality (xor)
     But BE CAREFUL; precedence of implication is wrong. expr('P & Q ==> R & S')
     is ((P & (Q >> R)) & S); so you must use expr('(P & Q) ==> (R & S)').
+    The string is parsed by an ExprParser, with the precedence Python would
+    give the operators, and the most recently parsed strings are cached.
     >>> expr('P <=> Q(1)')
     (P <=> Q(1))
     >>> expr('P & Q | ~R(x, F(x))')
@@ -236,13 +737,155 @@ def expr(s):
     """
     if isinstance(s, Expr): return s
     if utils_lpw.isnumber(s): return Expr(s)
-    ## Replace the alternative spellings of operators with canonical spellings
-    s = s.replace('==>', '>>').replace('<==', '<<')
-    s = s.replace('<=>', '%').replace('=/=', '^')
-    ## Replace a symbol or number, such as 'P' with 'Expr("P")'
-    s = re.sub(r'([a-zA-Z0-9_.]+)', r'Expr("\1")', s)
-    ## Now eval the string.  (A security hole; do not use with an adversary.)
-    return eval(s, {'Expr':Expr})
+    try:
+        e = _expr_cache.pop(s)
+    except KeyError:
+        e = ExprParser(s).parse()
+        if len(_expr_cache) >= expr_cache_size:
+            _expr_cache.popitem(last=False)
+    _expr_cache[s] = e
+    return e
+
+class ExprParser:
+    """A precedence-climbing (Pratt) parser for the strings taken by expr.
+    It builds the Expr that Python would evaluate the string to if every
+    symbol and number in it were an Expr: the operators are Expr's own, with
+    Python's precedence, and a comma outside a call makes a tuple.
+    >>> ExprParser('~P ==> Q, R').parse()
+    ((~P >> Q), R)
+    """
+
+    token_re = re.compile(r'(==>|<==|<=>|=/=|\*\*|<<|>>|<=|>='
+                          r'|[-+*/%&|^~<>(),])|([a-zA-Z0-9_.]+)|(\S)')
+
+    ## op -> (binding power, function); ** and the comparisons are special
+    infix = {'|': (1, operator.or_),
+             '^': (2, operator.xor), '=/=': (2, operator.xor),
+             '&': (3, operator.and_),
+             '<<': (4, operator.lshift), '<==': (4, operator.lshift),
+             '>>': (4, operator.rshift), '==>': (4, operator.rshift),
+             '+': (5, operator.add), '-': (5, operator.sub),
+             '*': (6, operator.mul), '/': (6, operator.truediv),
+             '%': (6, operator.mod), '<=>': (6, operator.mod)}
+    comparisons = {'<': operator.lt, '>': operator.gt,
+                   '<=': operator.le, '>=': operator.ge}
+    prefix = {'~': operator.invert, '-': operator.neg}
+
+    def __init__(self, s):
+        self.s = s
+        self.tokens = self.tokenize(s)
+        self.pos = 0
+
+    def tokenize(self, s):
+        """Return a list of (op, None) and (None, Expr) tokens, ending with
+        (None, None)."""
+        tokens = []
+        lookup = _expr_table.get
+        for op, name, bad in self.token_re.findall(s):
+            if op:
+                tokens.append((op, None))
+            elif name:
+                ## A symbol that is already interned skips Expr's coercions.
+                ## (A name that is a number is never interned under str.)
+                tokens.append((None, lookup((str, name, ())) or Expr(name)))
+            else:
+                raise SyntaxError('bad character %r in expr: %r' % (bad, s))
+        tokens.append((None, None))
+        return tokens
+
+    def parse(self):
+        "Parse the whole string."
+        if len(self.tokens) == 1:
+            raise SyntaxError('empty expr')
+        e = self.sequence(None)
+        if self.tokens[self.pos] != (None, None):
+            self.error()
+        return e
+
+    def error(self):
+        raise SyntaxError('unexpected %r in expr: %r'
+                          % (self.tokens[self.pos][0], self.s))
+
+    def next_op(self):
+        return self.tokens[self.pos][0]
+
+    def expect(self, op):
+        if self.tokens[self.pos][0] != op:
+            self.error()
+        self.pos += 1
+
+    def sequence(self, close):
+        """Parse comma-separated expressions up to the token close: one
+        expression alone, or else a tuple of them."""
+        items = []
+        comma = False
+        while self.tokens[self.pos] != (close, None):
+            items.append(self.comparison())
+            if self.next_op() != ',':
+                break
+            self.pos += 1
+            comma = True
+        if len(items) == 1 and not comma:
+            return items[0]
+        return tuple(items)
+
+    def comparison(self):
+        """Parse a chain of comparisons.  As in Python, x < y < z is
+        (x < y) and (y < z), which for Exprs is just (y < z)."""
+        left = self.binary(0)
+        result = left
+        while self.next_op() in self.comparisons:
+            fn = self.comparisons[self.next_op()]
+            self.pos += 1
+            right = self.binary(0)
+            result, left = fn(left, right), right
+        return result
+
+    def binary(self, rbp):
+        "Parse operators that bind tighter than rbp, left to right."
+        left = self.unary()
+        infix = self.infix
+        while True:
+            op = self.next_op()
+            if op not in infix: return left
+            bp, fn = infix[op]
+            if bp <= rbp: return left
+            self.pos += 1
+            left = fn(left, self.binary(bp))
+
+    def unary(self):
+        "Parse a prefix ~ or -, which binds looser than ** on its right."
+        op = self.next_op()
+        if op in self.prefix:
+            self.pos += 1
+            return self.prefix[op](self.unary())
+        return self.power()
+
+    def power(self):
+        "Parse x ** y, which groups to the right: x ** y ** z is x ** (y ** z)."
+        left = self.primary()
+        if self.next_op() == '**':
+            self.pos += 1
+            return left ** self.unary()
+        return left
+
+    def primary(self):
+        "Parse a symbol, number or parenthesized expression, and any calls."
+        op, e = self.tokens[self.pos]
+        self.pos += 1
+        if op == '(':
+            e = self.sequence(')')
+            self.expect(')')
+        elif e is None:
+            self.pos -= 1
+            self.error()
+        while self.next_op() == '(':
+            self.pos += 1
+            args = self.sequence(')')
+            self.expect(')')
+            if not isinstance(args, tuple): args = (args,)
+            e = e(*args)
+        return e
 
 def is_symbol(s):
     "A string s is a symbol if it starts with an alphabetic char."
@@ -266,13 +909,17 @@ A, B, C, F, G, P, Q, x, y, z  = map(Expr, 'ABCFGPQxyz')
 
 def tt_entails(kb, alpha):
     """Use truth tables to determine if KB entails sentence alpha. [Fig. 7.10]
+    Rather than enumerating the models one at a time as tt_check_all does,
+    this evaluates kb & ~alpha on big blocks of models at once with a
+    BitEvaluator, and looks for a model where it is true.
     >>> tt_entails(expr('P & Q'), expr('Q'))
     True
     """
-    return tt_check_all(kb, alpha, prop_symbols(kb & alpha), {})
+    kb, alpha = expr(kb), expr(alpha)
+    return not BitEvaluator(kb & ~alpha, prop_symbols(kb & alpha)).any_true()
 
 def tt_check_all(kb, alpha, symbols, model):
-    "Auxiliary routine to implement tt_entails."
+    "Auxiliary routine to implement tt_entails, one model at a time."
     if not symbols:
         if pl_true(kb, model): return pl_true(alpha, model)
         else: return True
@@ -348,13 +995,150 @@ def pl_true(exp, model={}):
     else:
         raise ValueError, "illegal operator in logic expression" + str(exp)
 
+#______________________________________________________________________________
+# Bit-parallel evaluation of propositional sentences
+
+class BitEvaluator:
+    """Compiles a propositional sentence into straight-line code over bit
+    vectors (Python ints), where bit j of each vector is about model j.  A
+    value is a pair of vectors (T, F): bit j is set in T if the sentence is
+    true in model j, in F if it is false, and in neither if it is unknown,
+    just as pl_true returns True, False or None.  Each distinct subsentence
+    is computed once, and ~ costs nothing (it swaps T and F).  A call on the
+    (T, F) pairs of the symbols, in the order of self.symbols, evaluates
+    the sentence in every model at once.
+    >>> e = BitEvaluator(expr('P | ~Q'), [P, Q])
+    >>> e([(0b0011, 0b1100), (0b0101, 0b1010)], 0b1111)
+    (11, 4)
+    """
+
+    block_bits = 18 ## Models in one block of tt enumeration: 2 ** block_bits
+
+    def __init__(self, sentence, symbols=None):
+        sentence = expr(sentence)
+        if symbols is None:
+            symbols = prop_symbols(sentence)
+        self.symbols = list(symbols)
+        self.registers = {}     ## subsentence -> (T name, F name)
+        self.code = []          ## lines of the compiled function
+        for i, p in enumerate(self.symbols):
+            self.registers[p] = ('t%d' % i, 'f%d' % i)
+        T, F = self.compile(sentence)
+        source = ('def evaluate(V, ALL):\n' +
+                  ''.join(['    t%d, f%d = V[%d]\n' % (i, i, i)
+                           for i in range(len(self.symbols))]) +
+                  ''.join(['    %s\n' % line for line in self.code]) +
+                  '    return %s, %s\n' % (T, F))
+        namespace = {}
+        exec source in namespace
+        self.evaluate = namespace['evaluate']
+
+    def __call__(self, values, ALL):
+        """Evaluate on the (T, F) vectors of the symbols; ALL has a bit set
+        for every model.  Return the (T, F) vectors of the sentence."""
+        return self.evaluate(values, ALL)
+
+    def compile(self, s):
+        "Emit code for s (once), returning the names of its (T, F) vectors."
+        if s in self.registers:
+            return self.registers[s]
+        op, args = s.op, s.args
+        if s == TRUE:
+            return ('ALL', '0')
+        elif s == FALSE:
+            return ('0', 'ALL')
+        elif is_prop_symbol(op):
+            raise ValueError("%s is not among the symbols %s"
+                             % (s, self.symbols))
+        elif op == '~':
+            T, F = self.compile(args[0])
+            return (F, T)
+        elif op == '>>':
+            return self.compile(~args[0] | args[1])
+        elif op == '<<':
+            return self.compile(args[0] | ~args[1])
+        vectors = [self.compile(arg) for arg in args]
+        Ts = [T for (T, F) in vectors]
+        Fs = [F for (T, F) in vectors]
+        n = len(self.registers)
+        T, F = 't%d' % n, 'f%d' % n
+        if op == '&':
+            self.code.append('%s = %s' % (T, ' & '.join(Ts) or 'ALL'))
+            self.code.append('%s = %s' % (F, ' | '.join(Fs) or '0'))
+        elif op == '|':
+            self.code.append('%s = %s' % (T, ' | '.join(Ts) or '0'))
+            self.code.append('%s = %s' % (F, ' & '.join(Fs) or 'ALL'))
+        elif op in ('<=>', '^') and len(args) == 2:
+            (pt, pf), (qt, qf) = vectors
+            same = '(%s & %s) | (%s & %s)' % (pt, qt, pf, qf)
+            different = '(%s & %s) | (%s & %s)' % (pt, qf, pf, qt)
+            if op == '^': same, different = different, same
+            self.code.append('%s = %s' % (T, same))
+            self.code.append('%s = %s' % (F, different))
+        else:
+            raise ValueError("illegal operator in logic expression" + str(s))
+        self.registers[s] = (T, F)
+        return T, F
+
+    def any_true(self):
+        """Is the sentence true in some model of self.symbols?  The models are
+        enumerated in blocks of 2 ** block_bits: within a block, the low
+        symbols cycle through their values in fixed bit patterns, and the high
+        symbols are constant."""
+        n = len(self.symbols)
+        k = min(n, self.block_bits)
+        lanes = 1 << k
+        ALL = (1 << lanes) - 1
+        low = []
+        for i in range(k):
+            ## Bit j is set iff bit i of j is: runs of 2**i zeros, then ones
+            period, pattern = 2 << i, ((1 << (1 << i)) - 1) << (1 << i)
+            while period < lanes:
+                pattern |= pattern << period
+                period *= 2
+            low.append((pattern, ALL ^ pattern))
+        for block in xrange(1 << (n - k)):
+            high = [((block >> i) & 1 and (ALL, 0)) or (0, ALL)
+                    for i in range(n - k)]
+            T, F = self.evaluate(low + high, ALL)
+            if T: return True
+        return False
+
+def pl_true_many(exp, models):
+    """Evaluate exp in each model, returning the list of what pl_true would
+    return for each, but in one bit-parallel pass with a BitEvaluator.
+    >>> pl_true_many(P | Q, [{P: True}, {P: False, Q: False}, {}])
+    [True, False, None]
+    """
+    exp = expr(exp)
+    symbols = prop_symbols(exp)
+    values = []
+    for p in symbols:
+        T = F = 0
+        for j, model in enumerate(models):
+            v = model.get(p)
+            if v is True: T |= 1 << j
+            elif v is False: F |= 1 << j
+        values.append((T, F))
+    T, F = BitEvaluator(exp, symbols)(values, (1 << len(models)) - 1)
+    results = []
+    for j in range(len(models)):
+        if (T >> j) & 1: results.append(True)
+        elif (F >> j) & 1: results.append(False)
+        else: results.append(None)
+    return results
+
 #______________________________________________________________________________
 
 ## Convert to Conjunctive Normal Form (CNF)
  
-def to_cnf(s):
+def to_cnf(s, method='distribute'):
     """Convert a propositional logical sentence s to conjunctive normal form.
     That is, of the form ((A | ~B | ...) & (B | C | ...) & ...) [p. 215]
+    The book's method distributes & over |, which can blow up exponentially.
+    With method='tseitin' or 'pg' (Plaisted-Greenbaum) the result is instead
+    linear in the size of s, but it introduces new symbols Aux_1, Aux_2, ...,
+    so it is only equisatisfiable with s; see TseitinEncoder.
     >>> to_cnf("~(B|C)")
     (~B & ~C)
     >>> to_cnf("B <=> (P1|P2)")
@@ -365,6 +1149,9 @@ def to_cnf(s):
     (A & (D | B) & (E | B))
     """
     if isinstance(s, str): s = expr(s)
+    if method != 'distribute':
+        roots, definitions = TseitinEncoder(method).encode(s)
+        return NaryExpr('&', *(definitions + roots))
     s = eliminate_implications(s) # Steps 1, 2 from p. 215
     s = move_not_inwards(s) # Step 3
     return distribute_and_over_or(s) # Step 4
@@ -415,7 +1202,7 @@ def distribute_and_over_or(s):
     ((A | C) & (B | C))
     """
     if s.op == '|':
-        s = NaryExpr('|', *s.args)
+        s = NaryExpr('|', *dissociate('|', s.args)) ## Flatten nested |s
         if len(s.args) == 0: 
             return FALSE
         if len(s.args) == 1: 
@@ -435,6 +1222,117 @@ def distribute_and_over_or(s):
     else:
         return s
 
+class TseitinEncoder:
+    """Converts sentences to CNF in linear size by naming each compound
+    subsentence with a new symbol Aux_n, defined by a few short clauses.
+    With method='tseitin' a name is equivalent to its subsentence; with
+    method='pg' (Plaisted-Greenbaum) only the direction of the implication
+    that the polarity of the occurrence needs is emitted, which gives fewer
+    clauses but does not preserve the number of models.  Names are cached by
+    subsentence, so an encoder shared across calls (as by PropKB) reuses them.
+    >>> e = TseitinEncoder('pg')
+    >>> roots, definitions = e.encode(expr('B <=> (P | Q)'))
+    >>> roots
+    [(~B | Aux_1), (B | ~Aux_1)]
+    >>> definitions
+    [(~Aux_1 | P | Q), (Aux_1 | ~P), (Aux_1 | ~Q)]
+    """
+
+    counter = 0 ## Shared by all encoders, so names never collide
+
+    def __init__(self, method='tseitin'):
+        if method not in ('tseitin', 'pg'):
+            raise ValueError("Unknown CNF method: %s" % method)
+        self.method = method
+        self.names = {}     ## subsentence -> aux symbol
+        self.emitted = {}   ## subsentence -> polarities defined so far
+        self.definitions = []
+
+    def encode(self, s):
+        """Return (roots, definitions): the clauses that say s is true, and the
+        new definitional clauses that the encoding of s added."""
+        self.definitions = []
+        roots = [NaryExpr('|', *c) for c in self.root_clauses(expr(s))]
+        return roots, [NaryExpr('|', *c) for c in self.definitions]
+
+    def root_clauses(self, s):
+        "The clauses (lists of literals) that assert s."
+        if s.op == '&':
+            return [c for arg in s.args for c in self.root_clauses(arg)]
+        elif s.op == '|':
+            return [[self.literal(d, +1) for d in dissociate('|', s.args)]]
+        elif s.op == '>>':
+            return self.root_clauses(~s.args[0] | s.args[1])
+        elif s.op == '<<':
+            return self.root_clauses(s.args[0] | ~s.args[1])
+        elif s.op == '<=>':
+            a, b = [self.literal(arg, 0) for arg in s.args]
+            return [[negate_literal(a), b], [a, negate_literal(b)]]
+        elif s.op == '~' and s.args[0].op == '|':
+            return [c for arg in s.args[0].args for c in self.root_clauses(~arg)]
+        return [[self.literal(s, +1)]]
+
+    def literal(self, s, polarity):
+        """A literal that stands for s where s occurs with the given polarity
+        (+1 positive, -1 negative, 0 both), defining a new symbol if need be."""
+        if s.op == '~':
+            return negate_literal(self.literal(s.args[0], -polarity))
+        elif is_symbol(s.op) or not s.args:
+            return s
+        elif s.op == '>>':
+            return self.literal(~s.args[0] | s.args[1], polarity)
+        elif s.op == '<<':
+            return self.literal(s.args[0] | ~s.args[1], polarity)
+        if self.method == 'tseitin':
+            polarity = 0
+        x = self.names.get(s)
+        if x is None:
+            TseitinEncoder.counter += 1
+            x = self.names[s] = Expr('Aux_%d' % TseitinEncoder.counter)
+            self.emitted[s] = set()
+        done = self.emitted[s]
+        for pol in (+1, -1):
+            if polarity in (pol, 0) and pol not in done:
+                done.add(pol)
+                self.define(x, s, pol)
+        return x
+
+    def define(self, x, s, pol):
+        """Add the clauses for x ==> s (pol=+1) or s ==> x (pol=-1)."""
+        op, add, nx = s.op, self.definitions.append, ~x
+        if op in ('&', '|'):
+            lits = [self.literal(a, pol) for a in dissociate(op, s.args)]
+            if op == '&' and pol > 0:
+                for l in lits: add([nx, l])
+            elif op == '&':
+                add([x] + [negate_literal(l) for l in lits])
+            elif pol > 0:
+                add([nx] + lits)
+            else:
+                for l in lits: add([x, negate_literal(l)])
+        elif op in ('<=>', '^'):
+            a, b = [self.literal(arg, 0) for arg in s.args]
+            na, nb = negate_literal(a), negate_literal(b)
+            head = (pol > 0 and nx) or x
+            if (op == '<=>') == (pol > 0):
+                add([head, na, b])
+                add([head, a, nb])
+            else:
+                add([head, a, b])
+                add([head, na, nb])
+        else:
+            raise ValueError("illegal operator in logic expression" + str(s))
+
+def negate_literal(literal):
+    """The complement of a literal, keeping TRUE and FALSE as constants.
+    >>> negate_literal(~P), negate_literal(TRUE)
+    (P, FALSE)
+    """
+    if literal.op == '~': return literal.args[0]
+    if literal == TRUE: return FALSE
+    if literal == FALSE: return TRUE
+    return ~literal
+
 _NaryExprTable = {'&':TRUE, '|':FALSE, '+':ZERO, '*':ONE}
 
 def NaryExpr(op, *args):
@@ -454,6 +1352,20 @@ def NaryExpr(op, *args):
     else:
         return Expr(op, *arglist)
 
+def dissociate(op, args):
+    """Given an associative op, return a flattened list result such
+    that Expr(op, *result) means the same as Expr(op, *args).
+    >>> dissociate('&', [A & B])
+    [A, B]
+    """
+    result = []
+    def collect(subargs):
+        for arg in subargs:
+            if arg.op == op: collect(arg.args)
+            else: result.append(arg)
+    collect(args)
+    return result
+
 def conjuncts(s):
     """Return a list of the conjuncts in the sentence s.
     >>> conjuncts(A & B)
@@ -462,7 +1374,7 @@ def conjuncts(s):
     [(A | B)]
     """
     if isinstance(s, Expr) and s.op == '&': 
-        return s.args
+        return list(s.args)
     else:
         return [s]
 
@@ -474,14 +1386,17 @@ def disjuncts(s):
     [(A & B)]
     """
     if isinstance(s, Expr) and s.op == '|': 
-        return s.args
+        return list(s.args)
     else:
         return [s]
 
 #______________________________________________________________________________
 
-def pl_resolution(KB, alpha):
-    "Propositional Logic Resolution: say if alpha follows from KB. [Fig. 7.12]"
+def pl_resolution(KB, alpha, engine='naive'):
+    """Propositional Logic Resolution: say if alpha follows from KB. [Fig. 7.12]
+    engine='sos' uses a ResolutionProver instead of resolving every pair."""
+    if engine == 'sos':
+        return ResolutionProver.for_query(KB, alpha).prove()
     clauses = KB.clauses + conjuncts(to_cnf(~alpha))
     new = set()
     while True:
@@ -510,54 +1425,280 @@ def pl_resolve(ci, cj):
                 clauses.append(NaryExpr('|', *dnew))
     return clauses
 
+class ResolutionProver:
+    """Resolution refutation over clauses that are frozensets of int literals
+    (see SymbolTable).  The clauses are split in two: the usable clauses
+    (those of the KB) and the set of support (those of the negated query).
+    Every resolution takes one clause from the set of support, the smallest
+    first (unit preference), and resolves it only against the usable clauses
+    indexed under a complementary literal.  Tautologies are dropped, as is
+    any resolvent subsumed by a kept clause, and a new clause deletes the
+    kept clauses it subsumes.  Set of support is complete only when the
+    usable clauses are consistent, so prove checks that first.
+    >>> ResolutionProver([(-1, 2), (1,)], [(-2,)]).prove()
+    True
+    >>> ResolutionProver([(-1, 2)], [(-2,)]).prove()
+    False
+    """
+
+    def __init__(self, usable, support, verbose=0):
+        self.verbose = verbose  ## report stats every this many given clauses
+        self.stats = dict(given=0, resolvents=0, tautologies=0, kept=0,
+                          forward_subsumed=0, backward_subsumed=0)
+        self.occurrences = {}   ## literal -> set of kept clauses
+        self.usable = {}        ## literal -> set of usable clauses
+        self.support = set()    ## kept clauses not yet given
+        self.queue = []         ## heap of (len, n, clause) over self.support
+        self.initial = []       ## the usable clauses, for the consistency check
+        self.empty = False      ## set when the empty clause is derived
+        for c in usable:
+            c = self.clause(c)
+            if c is not None and self.keep(c):
+                self.initial.append(c)
+                for lit in c:
+                    self.usable.setdefault(lit, set()).add(c)
+        for c in support:
+            c = self.clause(c)
+            if c is not None and self.keep(c):
+                self.push(c)
+
+    def for_query(cls, KB, alpha, verbose=0):
+        "The prover for KB & ~alpha, with the clauses of ~alpha as support."
+        symtab = SymbolTable()
+        roots, definitions = KB.sentence_clauses(~expr(alpha))
+        usable = [symtab.clause(c) for c in KB.clauses + definitions]
+        support = [symtab.clause(c) for c in roots]
+        return cls(usable, support, verbose)
+    for_query = classmethod(for_query)
+
+    def clause(self, lits):
+        "Return lits as a frozenset, or None (counted) if it is a tautology."
+        if lits is None:
+            self.stats['tautologies'] += 1
+            return None
+        c = frozenset(lits)
+        for lit in c:
+            if -lit in c:
+                self.stats['tautologies'] += 1
+                return None
+        return c
+
+    def keep(self, c):
+        """Add c to the kept clauses unless one of them subsumes it, removing
+        those it subsumes.  Return True if c was kept."""
+        occurrences = self.occurrences
+        for lit in c:
+            for d in occurrences.get(lit, ()):
+                if len(d) <= len(c) and d <= c:
+                    self.stats['forward_subsumed'] += 1
+                    return False
+        if not c:
+            self.empty = True
+        else:
+            ## Every clause that c subsumes is filed under each literal of c.
+            rarest = min(c, key=lambda lit: len(occurrences.get(lit, ())))
+            for d in [d for d in occurrences.get(rarest, ()) if c <= d]:
+                self.discard(d)
+                self.stats['backward_subsumed'] += 1
+        for lit in c:
+            occurrences.setdefault(lit, set()).add(c)
+        self.stats['kept'] += 1
+        return True
+
+    def discard(self, c):
+        "Remove c from the kept clauses, wherever it is."
+        for lit in c:
+            self.occurrences[lit].discard(c)
+            if lit in self.usable:
+                self.usable[lit].discard(c)
+        self.support.discard(c)
+
+    def push(self, c):
+        self.support.add(c)
+        heapq.heappush(self.queue, (len(c), self.stats['kept'], c))
+
+    def consistent(self):
+        "Are the usable clauses satisfiable (by a CDCLSolver)?"
+        solver = CDCLSolver()
+        for c in self.initial:
+            solver.add_clause(c)
+        return solver.solve()
+
+    def prove(self):
+        "Return True if the empty clause can be derived, else False."
+        if self.empty or not self.consistent():
+            return True
+        queue, usable, stats = self.queue, self.usable, self.stats
+        while queue:
+            given = heapq.heappop(queue)[2]
+            if given not in self.support: continue  ## subsumed after queueing
+            self.support.remove(given)
+            stats['given'] += 1
+            if self.verbose and stats['given'] % self.verbose == 0:
+                print 'resolution:', stats
+            for lit in given:
+                usable.setdefault(lit, set()).add(given)
+            for lit in given:
+                for d in list(usable.get(-lit, ())):
+                    if d not in usable[-lit]: continue  ## subsumed meanwhile
+                    stats['resolvents'] += 1
+                    r = self.clause((given - frozenset([lit])) |
+                                    (d - frozenset([-lit])))
+                    if r is not None and self.keep(r):
+                        if self.empty: return True
+                        self.push(r)
+                if given not in usable.get(lit, ()):
+                    break   ## a resolvent subsumed the given clause
+        return False
+
 #______________________________________________________________________________
 
 class PropHornKB(PropKB):
-    "A KB of Propositional Horn clauses."
+    """A KB of Propositional Horn clauses.  It keeps an index from each
+    symbol to the clauses with that symbol in their premise, and the state
+    of forward chaining [Fig. 7.14] -- the count of premises not yet
+    inferred for each clause, and the inferred symbols -- which tell brings
+    up to date incrementally.  So asking about a symbol is a lookup, and
+    the total work of chaining is linear in the size of the KB.  Each
+    inferred symbol records the clause it was first inferred by, so retract
+    only undoes the inferences that rest on the retracted clause, and then
+    infers again those of them that still follow some other way.
+    >>> kb = PropHornKB()
+    >>> for s in ['A', 'B', 'A >> C', 'B >> C', 'C >> D']: kb.tell(expr(s))
+    >>> kb.retract(expr('A')); kb.ask(expr('D'))
+    {}
+    >>> kb.retract(expr('B')); kb.ask(expr('D'))
+    False
+    """
+
+    def __init__(self, sentence=None):
+        self.clauses = []
+        self.told = {}          ## clause -> number of copies told
+        self.index = {}         ## symbol -> clauses with it in the premise
+        self.concluding = {}    ## symbol -> clauses with it as the conclusion
+        self.count = {}         ## clause -> number of premises not inferred
+        self.inferred = {}      ## inferred symbol -> the clause it came from
+        if sentence:
+            self.tell(sentence)
 
     def tell(self, sentence):
         "Add a Horn Clauses to this KB."
         op = sentence.op
         assert op == '>>' or is_prop_symbol(op), "Must be Horn Clause"
         self.clauses.append(sentence)
+        self.told[sentence] = self.told.get(sentence, 0) + 1
+        if op == '>>':
+            if sentence in self.count: return
+            premises = set(conjuncts(sentence.args[0]))
+            for p in premises:
+                self.index.setdefault(p, []).append(sentence)
+            conclusion = sentence.args[1]
+            self.concluding.setdefault(conclusion, []).append(sentence)
+            self.count[sentence] = len([p for p in premises
+                                        if p not in self.inferred])
+            if self.count[sentence] == 0:
+                self.infer(conclusion, sentence)
+        else:
+            self.infer(sentence, sentence)
+
+    def infer(self, symbol, reason):
+        """Add symbol to the inferred symbols, inferred by the clause reason,
+        and chain forward from it."""
+        agenda = [(symbol, reason)]
+        while agenda:
+            p, reason = agenda.pop()
+            if p not in self.inferred:
+                self.inferred[p] = reason
+                for c in self.index.get(p, ()):
+                    self.count[c] -= 1
+                    if self.count[c] == 0:
+                        agenda.append((c.args[1], c))
 
     def ask_generator(self, query): 
         "Yield the empty substitution if KB implies query; else False"
-        if not pl_fc_entails(self.clauses, query):
-            return
+        for p in conjuncts(query):
+            if p not in self.inferred:
+                return
         yield {}
 
     def retract(self, sentence):
-        "Remove the sentence's clauses from the KB"
-        for c in conjuncts(to_cnf(sentence)):
-            if c in self.clauses:
-                self.clauses.remove(c)
+        """Remove the sentence from the KB, and undo what was inferred by it."""
+        if not self.told.get(sentence): return
+        self.clauses.remove(sentence)
+        self.told[sentence] -= 1
+        if self.told[sentence]: return  ## Another copy is still told
+        del self.told[sentence]
+        if sentence.op == '>>':
+            for p in set(conjuncts(sentence.args[0])):
+                self.index[p].remove(sentence)
+            conclusion = sentence.args[1]
+            self.concluding[conclusion].remove(sentence)
+            del self.count[sentence]
+        else:
+            conclusion = sentence
+        if self.inferred.get(conclusion) == sentence:
+            self.uninfer(conclusion)
+
+    def uninfer(self, symbol):
+        """Remove symbol from the inferred symbols, along with every symbol
+        that was inferred (first) from one removed; then infer again those
+        that are told or that some clause with all premises inferred gives."""
+        lost = []
+        agenda = [symbol]
+        while agenda:
+            p = agenda.pop()
+            if p not in self.inferred: continue
+            del self.inferred[p]
+            lost.append(p)
+            for c in self.index.get(p, ()):
+                self.count[c] += 1
+                if self.inferred.get(c.args[1]) == c:
+                    agenda.append(c.args[1])
+        for p in lost:
+            if p in self.told:
+                self.infer(p, p)
+                continue
+            for c in self.concluding.get(p, ()):
+                if self.count[c] == 0:
+                    self.infer(p, c)
+                    break
 
     def clauses_with_premise(self, p):
         """The list of clauses in KB that have p in the premise.
-        This could be cached away for O(1) speed, but we'll recompute it."""
-        return [c for c in self.clauses 
-                if c.op == '>>' and p in conjuncts(c.args[0])]
+        This is cached away in self.index for O(1) speed."""
+        return self.index.get(p, [])
 
 def pl_fc_entails(KB, q):
-    """Use forward chaining to see if a HornKB entails symbol q. [Fig. 7.14]
-    >>> pl_fc_entails(Fig[7,15], expr('Q'))
+    """Use forward chaining to see if a KB of definite clauses entails q, a
+    symbol or a conjunction of symbols. [Fig. 7.14]  Any KB whose .clauses
+    are definite clauses will do; the index of premises is built here, so
+    the work is linear in the size of the KB.  (A PropHornKB keeps the
+    chaining up to date as it is told, so its ask is just a lookup.)
+    >>> pl_fc_entails(Fig_7_15, expr('Q'))
     True
     """
-    count = dict([(c, len(conjuncts(c.args[0]))) for c in KB.clauses if c.op == '>>'])
-    inferred = utils_lpw.DefaultDict(False)
-    agenda = [s for s in KB.clauses if is_prop_symbol(s.op)]
-    if q in agenda: return True
+    goals = set(conjuncts(q))
+    count, index, agenda = {}, {}, []
+    for c in KB.clauses:
+        if c.op != '>>':
+            agenda.append(c)
+        elif c not in count:
+            premises = set(conjuncts(c.args[0]))
+            count[c] = len(premises)
+            for p in premises:
+                index.setdefault(p, []).append(c)
+    inferred = set()
     while agenda:
         p = agenda.pop()
-        if not inferred[p]:
-            inferred[p] = True
-            for c in KB.clauses_with_premise(p):
+        if p not in inferred:
+            inferred.add(p)
+            goals.discard(p)
+            if not goals: return True
+            for c in index.get(p, ()):
                 count[c] -= 1
                 if count[c] == 0:
-                    if c.args[1] == q: return True
                     agenda.append(c.args[1])
-    return False
+    return not goals
 
 ## Wumpus World example [Fig. 7.13]
 Fig_7_13 = expr("(B11 <=> (P12 | P21))  &  ~B11")
@@ -571,20 +1712,35 @@ for s in "P>>Q   (L&M)>>P   (B&L)>>M   (A&P)>>L   (A&B)>>L   A   B".split():
 
 # DPLL-Satisfiable [Fig. 7.16]
 
-def dpll_satisfiable(s):
+def dpll_satisfiable(s, engine='dpll', cnf='distribute'):
     """Check satisfiability of a propositional sentence.
     This differs from the book code in two ways: (1) it returns a model
     rather than True when it succeeds; this is more useful. (2) The
     function find_pure_symbol is passed a list of unknown clauses, rather
     than a list of all clauses and the model; this is more efficient.
+    With engine='cdcl' the search is done by a CDCLSolver instead, which
+    returns a model over every symbol in s.  cnf is the to_cnf method; the
+    new symbols of 'tseitin' or 'pg' are left out of the model.
     >>> dpll_satisfiable(A&~B)
     {A: True, B: False}
     >>> dpll_satisfiable(P&~P)
     False
+    >>> dpll_satisfiable(A&~B, engine='cdcl')
+    {A: True, B: False}
     """
-    clauses = conjuncts(to_cnf(s))
+    if engine == 'cdcl':
+        return cdcl_satisfiable(s, cnf=cnf)
+    elif engine != 'dpll':
+        raise ValueError("Unknown engine: %s" % engine)
+    s = expr(s)
+    clauses = conjuncts(to_cnf(s, cnf))
+    if cnf == 'distribute':
+        return dpll(clauses, prop_symbols(s), {})
+    model = dpll(clauses, prop_symbols(Expr('&', *clauses)), {})
+    if model is False:
+        return False
     symbols = prop_symbols(s)
-    return dpll(clauses, symbols, {})
+    return dict([(p, v) for (p, v) in model.items() if p in symbols])
  
 def dpll(clauses, symbols, model):
     "See if the clauses are true in a partial model."
@@ -599,11 +1755,11 @@ def dpll(clauses, symbols, model):
         return model
     P, value = find_pure_symbol(symbols, unknown_clauses)
     if P:
-        return dpll(clauses, removeall(P, symbols), extend(model, P, value))
+        return dpll(clauses, utils_lpw.removeall(P, symbols), extend(model, P, value))
     P, value = find_unit_clause(clauses, model)
     if P:
-        return dpll(clauses, removeall(P, symbols), extend(model, P, value))
-    P = symbols.pop()
+        return dpll(clauses, utils_lpw.removeall(P, symbols), extend(model, P, value))
+    P, symbols = symbols[0], symbols[1:]
     return (dpll(clauses, symbols, extend(model, P, True)) or
             dpll(clauses, symbols, extend(model, P, False)))
  
@@ -623,7 +1779,8 @@ def find_pure_symbol(symbols, unknown_clauses):
 
 def find_unit_clause(clauses, model):
     """A unit clause has only 1 variable that is not bound in the model.
-    >>> find_unit_clause([A|B|C, B|~C, A|~B], {A:True})
+    Clauses that are already true in the model do not count.
+    >>> find_unit_clause([A|B|C, B|~C, ~A|~B], {A:True})
     (B, False)
     """
     for clause in clauses:
@@ -633,8 +1790,11 @@ def find_unit_clause(clauses, model):
             if sym not in model:
                 num_not_in_model += 1
                 P, value = sym, (literal.op != '~')
-        if num_not_in_model == 1:
-            return P, value
+            elif model[sym] == (literal.op != '~'):
+                break
+        else:
+            if num_not_in_model == 1:
+                return P, value
     return None, None
                 
 
@@ -650,58 +1810,1299 @@ def literal_symbol(literal):
     else:
         return literal
         
+#______________________________________________________________________________
+# Conflict-driven clause learning
+
+def cdcl_satisfiable(s, seed=None, cnf='distribute'):
+    """Check satisfiability of a propositional sentence with a CDCLSolver.
+    Return a model {symbol: value} over all the symbols in s, or False.
+    >>> cdcl_satisfiable(A & (~A | B) & (~B | ~C))
+    {A: True, C: False, B: True}
+    """
+    s = expr(s)
+    symtab = SymbolTable()
+    for p in prop_symbols(s):
+        symtab.var(p)
+    n = len(symtab)
+    solver = CDCLSolver(seed=seed)
+    for c in conjuncts(to_cnf(s, cnf)):
+        c = symtab.clause(c)
+        if c is not None:
+            solver.add_clause(c)
+    solver.ensure_vars(len(symtab))
+    if not solver.solve():
+        return False
+    return dict([(symtab.symbols[v], solver.model[v])
+                 for v in range(1, n + 1)])
+
+class CDCLSolver:
+    """A conflict-driven clause-learning SAT solver over int clauses (see
+    SymbolTable).  Unit propagation watches two literals per clause, so an
+    assignment only visits the clauses watching the literal it falsifies.
+    Branching picks the unassigned variable with the highest VSIDS activity,
+    reusing its last value (phase saving).  A conflict learns its first-UIP
+    clause and backjumps to the second-highest decision level in it.  The
+    search restarts on a Luby schedule and periodically forgets the learned
+    clauses with the most distinct decision levels (LBD).
+    >>> solver = CDCLSolver()
+    >>> solver.add_clause([1, 2]) and solver.add_clause([-1])
+    True
+    >>> solver.solve(), solver.model[1:]
+    (True, [False, True])
+    """
+
+    restart_base = 100      ## conflicts in the first run between restarts
+    var_decay = 0.95
+
+    def __init__(self, nvars=0, seed=None):
+        ## val and watches are indexed by literal: positive literals count
+        ## from the front of the list and negative ones from the back.
+        self.nvars = 0
+        self.val = [0]          ## literal -> 1 (true), -1 (false) or 0
+        self.watches = [[]]     ## literal -> clauses watching it
+        self.level = [0]        ## var -> decision level of its assignment
+        self.reason = [None]    ## var -> clause that implied it, if any
+        self.activity = [0.0]   ## var -> VSIDS score
+        self.phase = [False]    ## var -> last value assigned
+        self.heap = []          ## (-activity, var), with stale entries
+        self.trail, self.trail_lim, self.qhead = [], [], 0
+        self.clauses, self.learnts, self.lbd = [], [], {}
+        self.var_inc = 1.0
+        self.max_learnts = 2000
+        self.ok = True
+        self.model = None
+        self.assumptions = []
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.stats = dict(decisions=0, propagations=0, conflicts=0,
+                          restarts=0, learned=0)
+        self.ensure_vars(nvars)
+
+    def ensure_vars(self, n):
+        "Make room for the variables 1..n."
+        old = self.nvars
+        if n <= old: return
+        val = [0] * (2 * n + 1)
+        watches = [[] for i in range(2 * n + 1)]
+        for v in range(1, old + 1):
+            val[v], val[-v] = self.val[v], self.val[-v]
+            watches[v], watches[-v] = self.watches[v], self.watches[-v]
+        self.val, self.watches, self.nvars = val, watches, n
+        for v in range(old + 1, n + 1):
+            self.level.append(0)
+            self.reason.append(None)
+            if self.seed is None:
+                self.activity.append(0.0)
+                self.phase.append(False)
+            else:
+                self.activity.append(self.random.random() * 1e-5)
+                self.phase.append(self.random.random() < 0.5)
+            heapq.heappush(self.heap, (-self.activity[v], v))
+
+    def add_clause(self, clause):
+        """Add a clause (an iterable of int literals).  Return False if the
+        clauses are now known to be unsatisfiable."""
+        if not self.ok: return False
+        self.cancel_until(0)
+        lits = set(clause)
+        if lits:
+            self.ensure_vars(max([abs(lit) for lit in lits]))
+        c = []
+        for lit in lits:
+            if -lit in lits or self.val[lit] == 1:
+                return True ## A tautology, or already true
+            if self.val[lit] == 0:
+                c.append(lit)
+        if not c:
+            self.ok = False
+        elif len(c) == 1:
+            self.enqueue(c[0], None)
+            self.ok = self.propagate() is None
+        else:
+            self.clauses.append(c)
+            self.watches[c[0]].append(c)
+            self.watches[c[1]].append(c)
+        return self.ok
+
+    def solve(self, assumptions=()):
+        """Search for a model in which the assumptions (int literals) are true.
+        Return True and set self.model (a list indexed by var of True/False)
+        if there is one, else return False.  The assumptions are decided
+        before any other var, so learned clauses and activities stay valid
+        for later calls with other assumptions or more clauses."""
+        self.model = None
+        if not self.ok: return False
+        self.assumptions = list(assumptions)
+        if self.assumptions:
+            self.ensure_vars(max([abs(lit) for lit in self.assumptions]))
+        self.cancel_until(0)
+        if self.propagate() is not None:
+            self.ok = False
+            return False
+        restarts = 0
+        while True:
+            status = self.search(self.restart_base * luby(restarts))
+            if status is not None:
+                return status
+            restarts += 1
+            self.stats['restarts'] += 1
+
+    def search(self, max_conflicts):
+        """Run CDCL until a model, unsatisfiability (True or False), or
+        max_conflicts conflicts (None, for a restart)."""
+        conflicts = 0
+        while True:
+            confl = self.propagate()
+            if confl is not None:
+                conflicts += 1
+                self.stats['conflicts'] += 1
+                if not self.trail_lim:
+                    self.ok = False
+                    return False
+                learnt, backtrack_level = self.analyze(confl)
+                self.cancel_until(backtrack_level)
+                if len(learnt) == 1:
+                    self.enqueue(learnt[0], None)
+                else:
+                    self.learnts.append(learnt)
+                    self.lbd[id(learnt)] = len(set(
+                        [self.level[abs(lit)] for lit in learnt]))
+                    self.watches[learnt[0]].append(learnt)
+                    self.watches[learnt[1]].append(learnt)
+                    self.enqueue(learnt[0], learnt)
+                self.stats['learned'] += 1
+                self.var_inc /= self.var_decay
+            else:
+                if conflicts >= max_conflicts:
+                    self.cancel_until(0)
+                    return None
+                if len(self.learnts) >= self.max_learnts + len(self.trail):
+                    self.reduce_learnts()
+                lit = 0
+                while len(self.trail_lim) < len(self.assumptions):
+                    p = self.assumptions[len(self.trail_lim)]
+                    if self.val[p] == 1:
+                        self.trail_lim.append(len(self.trail)) ## Empty level
+                    elif self.val[p] == -1:
+                        self.cancel_until(0)
+                        return False
+                    else:
+                        lit = p
+                        break
+                if lit == 0:
+                    v = self.pick_branch_var()
+                    if v == 0:
+                        self.model = [None] + [self.val[v] > 0 for v in
+                                               range(1, self.nvars + 1)]
+                        self.cancel_until(0)
+                        return True
+                    lit = v if self.phase[v] else -v
+                self.stats['decisions'] += 1
+                self.trail_lim.append(len(self.trail))
+                self.enqueue(lit, None)
+
+    def enqueue(self, lit, reason):
+        "Make lit true at the current decision level, implied by reason."
+        v = abs(lit)
+        self.val[lit], self.val[-lit] = 1, -1
+        self.level[v] = len(self.trail_lim)
+        self.reason[v] = reason
+        self.trail.append(lit)
+
+    def propagate(self):
+        """Propagate the literals on the trail not yet propagated.  Return a
+        conflicting clause, or None.  In each watched clause, the two watched
+        literals are kept at positions 0 and 1."""
+        val, watches, trail = self.val, self.watches, self.trail
+        level, reason = self.level, self.reason
+        decision_level = len(self.trail_lim)
+        qhead = self.qhead
+        while qhead < len(trail):
+            false_lit = -trail[qhead]
+            qhead += 1
+            ws = watches[false_lit]
+            watches[false_lit] = kept = []
+            keep = kept.append
+            i, n = 0, len(ws)
+            while i < n:
+                c = ws[i]
+                i += 1
+                if not c: continue ## A forgotten learned clause
+                if c[0] == false_lit:
+                    c[0], c[1] = c[1], false_lit
+                first = c[0]
+                if val[first] == 1:
+                    keep(c)
+                    continue
+                for k in xrange(2, len(c)):
+                    lit = c[k]
+                    if val[lit] != -1:
+                        c[1], c[k] = lit, false_lit
+                        watches[lit].append(c)
+                        break
+                else:
+                    keep(c)
+                    if val[first] == -1:
+                        kept.extend(ws[i:])
+                        self.stats['propagations'] += qhead - self.qhead
+                        self.qhead = len(trail)
+                        return c
+                    ## Inlined self.enqueue(first, c)
+                    val[first], val[-first] = 1, -1
+                    v = abs(first)
+                    level[v] = decision_level
+                    reason[v] = c
+                    trail.append(first)
+        self.stats['propagations'] += qhead - self.qhead
+        self.qhead = qhead
+        return None
+
+    def analyze(self, confl):
+        """Resolve the conflict clause back to its first unique implication
+        point.  Return the learned clause, with the asserting literal first
+        and a literal of the backjump level second, and that level."""
+        level, reason, trail = self.level, self.reason, self.trail
+        current = len(self.trail_lim)
+        seen = set()
+        learnt = [0]
+        counter, p, index = 0, 0, len(trail) - 1
+        while True:
+            for q in (p and confl[1:] or confl):
+                v = abs(q)
+                if v not in seen and level[v] > 0:
+                    seen.add(v)
+                    self.bump(v)
+                    if level[v] >= current:
+                        counter += 1
+                    else:
+                        learnt.append(q)
+            while abs(trail[index]) not in seen:
+                index -= 1
+            p = trail[index]
+            index -= 1
+            confl = reason[abs(p)]
+            counter -= 1
+            if counter == 0: break
+        learnt[0] = -p
+        ## Drop literals whose reason is made of other literals in the clause
+        learnt[1:] = [q for q in learnt[1:] if reason[abs(q)] is None or
+                      [r for r in reason[abs(q)][1:]
+                       if abs(r) not in seen and level[abs(r)] > 0]]
+        if len(learnt) == 1:
+            return learnt, 0
+        top = 1
+        for i in range(2, len(learnt)):
+            if level[abs(learnt[i])] > level[abs(learnt[top])]:
+                top = i
+        learnt[1], learnt[top] = learnt[top], learnt[1]
+        return learnt, level[abs(learnt[1])]
+
+    def cancel_until(self, lvl):
+        "Undo all assignments above decision level lvl."
+        if len(self.trail_lim) <= lvl: return
+        val, trail = self.val, self.trail
+        start = self.trail_lim[lvl]
+        for i in range(len(trail) - 1, start - 1, -1):
+            lit = trail[i]
+            v = abs(lit)
+            val[v] = val[-v] = 0
+            self.phase[v] = lit > 0
+            self.reason[v] = None
+            heapq.heappush(self.heap, (-self.activity[v], v))
+        del trail[start:]
+        del self.trail_lim[lvl:]
+        self.qhead = len(trail)
+
+    def bump(self, v):
+        "Raise v's VSIDS activity; rescale everything if it grows too big."
+        self.activity[v] += self.var_inc
+        if self.activity[v] > 1e100:
+            self.activity = [a * 1e-100 for a in self.activity]
+            self.var_inc *= 1e-100
+            self.rebuild_heap()
+        elif self.val[v] == 0:
+            heapq.heappush(self.heap, (-self.activity[v], v))
+
+    def rebuild_heap(self):
+        self.heap = [(-self.activity[v], v) for v in range(1, self.nvars + 1)
+                     if self.val[v] == 0]
+        heapq.heapify(self.heap)
+
+    def pick_branch_var(self):
+        "Return the unassigned var with the highest activity, or 0 if none."
+        if len(self.heap) > 10 * self.nvars + 100:
+            self.rebuild_heap()
+        heap, val, activity = self.heap, self.val, self.activity
+        while heap:
+            a, v = heapq.heappop(heap)
+            if val[v] == 0 and -a == activity[v]:
+                return v
+        return 0
+
+    def reduce_learnts(self):
+        """Forget about half of the learned clauses, keeping binary ones, ones
+        that are the reason for a current assignment, and those with low LBD."""
+        reason, lbd = self.reason, self.lbd
+        self.learnts.sort(key=lambda c: lbd[id(c)])
+        keep = []
+        for i, c in enumerate(self.learnts):
+            if (i < len(self.learnts) / 2 or len(c) <= 2 or lbd[id(c)] <= 2
+                or reason[abs(c[0])] is c):
+                keep.append(c)
+            else:
+                del lbd[id(c)]
+                del c[:] ## Watch lists drop emptied clauses lazily
+        self.learnts = keep
+        self.max_learnts = int(self.max_learnts * 1.1)
+
+def luby(i):
+    """The i-th (from 0) term of the Luby sequence 1 1 2 1 1 2 4 1 1 2 ...
+    >>> [luby(i) for i in range(7)]
+    [1, 1, 2, 1, 1, 2, 4]
+    """
+    size, seq = 1, 0
+    while size < i + 1:
+        seq += 1
+        size = 2 * size + 1
+    while size - 1 != i:
+        size = (size - 1) >> 1
+        seq -= 1
+        i = i % size
+    return 2 ** seq
+
 
 #______________________________________________________________________________
 # Walk-SAT [Fig. 7.17]
 
-def WalkSAT(clauses, p=0.5, max_flips=10000):
-    ## model is a random assignment of true/false to the symbols in clauses
-    ## See ~/aima1e/print1/manual/knowledge+logic-answers.tex ???
-    model = dict([(s, random.choice([True, False])) 
-                 for s in prop_symbols(clauses)])
-    for i in range(max_flips):
-        satisfied, unsatisfied = [], []
-        for clause in clauses:
-            if_(pl_true(clause, model), satisfied, unsatisfied).append(clause)
-        if not unsatisfied: ## if model satisfies all the clauses
-            return model
-        clause = random.choice(unsatisfied)
-        if probability(p):
-            sym = random.choice(prop_symbols(clause))
+def WalkSAT(clauses, p=0.5, max_flips=10000, seed=None, max_seconds=None,
+            strategy='walksat'):
+    """Local search for a model of the list of sentences clauses. [Fig. 7.17]
+    Return a model {symbol: value}, or None if none was found within
+    max_flips flips (or max_seconds seconds).  With probability p a flip
+    takes a random symbol of a random unsatisfied clause; otherwise the
+    symbol that maximizes the number of satisfied clauses.  With
+    strategy='probsat', p is ignored and the symbol is drawn with a
+    probability that falls off with the number of clauses the flip breaks.
+    Pass a seed for a reproducible run.
+    >>> WalkSAT([A & ~B], seed=0)
+    {A: True, B: False}
+    """
+    symtab = SymbolTable()
+    int_clauses = []
+    for sentence in clauses:
+        for symbol in prop_symbols(sentence):
+            symtab.var(symbol)
+        for c in conjuncts(to_cnf(sentence)):
+            c = symtab.clause(c)
+            if c is not None:
+                int_clauses.append(c)
+    solver = WalkSATSolver(int_clauses, len(symtab), seed)
+    if not solver.solve(p, max_flips, max_seconds, strategy):
+        return None
+    return dict([(symtab.symbols[v], solver.model[v])
+                 for v in range(1, len(symtab) + 1)])
+
+class WalkSATSolver:
+    """WalkSAT and ProbSAT local search over int clauses (see SymbolTable).
+    For the current assignment we keep the number of true literals in each
+    clause (and the sum of their vars, which is the one true var when there
+    is exactly one), the list of unsatisfied clauses, and for each var its
+    break count (clauses only it satisfies) and make count (unsatisfied
+    clauses it occurs in).  A flip updates these through the occurrence
+    lists of the flipped var alone.
+    >>> solver = WalkSATSolver([(1, 2), (-1,), (-2, 3)], 3, seed=1)
+    >>> solver.solve(), solver.model[1:]
+    (True, [False, True, True])
+    """
+
+    cb = 2.3    ## ProbSAT's break exponent (the best value for 3-SAT)
+
+    def __init__(self, clauses, nvars, seed=None):
+        self.clauses = [tuple(c) for c in clauses]
+        self.nvars = nvars
+        self.random = random.Random(seed) if seed is not None else random
+        self.occurrences = dict([(lit, []) for v in range(1, nvars + 1)
+                                 for lit in (v, -v)])
+        for i, c in enumerate(self.clauses):
+            for lit in c:
+                self.occurrences[lit].append(i)
+        self.model = None
+        self.stats = dict(flips=0, restarts=0)
+
+    def solve(self, p=0.5, max_flips=10000, max_seconds=None,
+              strategy='walksat'):
+        """Search from a random assignment.  Return True and set self.model (a
+        list indexed by var of True/False) if a model is found, else False."""
+        if strategy not in ('walksat', 'probsat'):
+            raise ValueError("Unknown strategy: %s" % strategy)
+        if () in self.clauses: return False
+        rng, clauses, occurrences = self.random, self.clauses, self.occurrences
+        deadline = max_seconds is not None and time.time() + max_seconds
+        value = [None] + [rng.random() < 0.5 for v in range(self.nvars)]
+        num_true = [0] * len(clauses)
+        true_sum = [0] * len(clauses)   ## sum of the vars of true literals
+        breaks = [0] * (self.nvars + 1)
+        makes = [0] * (self.nvars + 1)
+        unsat, unsat_pos = [], {}       ## unsat clauses; clause -> position
+        for i, c in enumerate(clauses):
+            for lit in c:
+                if value[abs(lit)] == (lit > 0):
+                    num_true[i] += 1
+                    true_sum[i] += abs(lit)
+            if num_true[i] == 0:
+                unsat_pos[i] = len(unsat)
+                unsat.append(i)
+                for lit in c:
+                    makes[abs(lit)] += 1
+            elif num_true[i] == 1:
+                breaks[true_sum[i]] += 1
+        self.stats['restarts'] += 1
+        probsat_weights = [(1.0 + b) ** -self.cb for b in range(64)]
+        flips = 0
+        for flip in xrange(max_flips):
+            if not unsat: break
+            if deadline and flip & 1023 == 0 and time.time() > deadline:
+                break
+            c = clauses[unsat[rng.randrange(len(unsat))]]
+            if strategy == 'probsat':
+                weights = [probsat_weights[min(breaks[abs(lit)], 63)]
+                           for lit in c]
+                r = rng.random() * sum(weights)
+                for lit, w in zip(c, weights):
+                    r -= w
+                    if r <= 0: break
+                v = abs(lit)
+            elif rng.random() < p:
+                v = abs(c[rng.randrange(len(c))])
+            else:
+                ## The var in c that maximizes the number of satisfied clauses
+                best = None
+                for lit in c:
+                    score = makes[abs(lit)] - breaks[abs(lit)]
+                    if best is None or score > best:
+                        best, candidates = score, [abs(lit)]
+                    elif score == best:
+                        candidates.append(abs(lit))
+                v = rng.choice(candidates)
+            ## Flip v, and update the counts of the clauses it occurs in
+            value[v] = not value[v]
+            now_true = value[v] and v or -v
+            for i in occurrences[now_true]:
+                n = num_true[i]
+                if n == 0:
+                    last = unsat.pop()
+                    if last != i:
+                        unsat[unsat_pos[i]] = last
+                        unsat_pos[last] = unsat_pos[i]
+                    del unsat_pos[i]
+                    for lit in clauses[i]:
+                        makes[abs(lit)] -= 1
+                    breaks[v] += 1
+                elif n == 1:
+                    breaks[true_sum[i]] -= 1
+                num_true[i] = n + 1
+                true_sum[i] += v
+            for i in occurrences[-now_true]:
+                n = num_true[i] - 1
+                num_true[i] = n
+                true_sum[i] -= v
+                if n == 0:
+                    unsat_pos[i] = len(unsat)
+                    unsat.append(i)
+                    for lit in clauses[i]:
+                        makes[abs(lit)] += 1
+                    breaks[v] -= 1
+                elif n == 1:
+                    breaks[true_sum[i]] += 1
+            flips += 1
+        self.stats['flips'] += flips
+        if unsat: return False
+        self.model = value
+        return True
+
+
+#______________________________________________________________________________
+# Parallel portfolio
+
+def portfolio_satisfiable(s, workers=None, cnf='distribute', seed=0,
+                          configs=None):
+    """Check satisfiability of a propositional sentence by running several
+    solvers at once, one configuration per task of a pool of worker
+    processes (by default, one per CPU), and taking the first definite
+    answer; the rest of the pool is then terminated.  The clauses go to
+    each worker once, when it starts, as a string of packed ints.  configs
+    defaults to portfolio_configs(workers, seed).  Return a model as
+    dpll_satisfiable does, or False.
+    >>> portfolio_satisfiable(A & ~B, workers=2)
+    {A: True, B: False}
+    """
+    s = expr(s)
+    symtab = SymbolTable()
+    for p in prop_symbols(s):
+        symtab.var(p)
+    flat = array.array('i')
+    for c in conjuncts(to_cnf(s, cnf)):
+        c = symtab.clause(c)
+        if c is not None:
+            flat.extend(c)
+            flat.append(0)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if configs is None:
+        configs = portfolio_configs(workers, seed)
+    pool = multiprocessing.Pool(min(workers, len(configs)), portfolio_init,
+                                (flat.tostring(), len(symtab)))
+    try:
+        for config, status, model in pool.imap_unordered(portfolio_run,
+                                                         configs):
+            if status is not None:
+                break
         else:
-            ## Flip the symbol in clause that miximizes number of sat. clauses
-            raise NotImplementedError
-        model[sym] = not model[sym]
+            raise ValueError("No configuration was complete: %s" % configs)
+    finally:
+        pool.terminate()
+        pool.join()
+    if not status:
+        return False
+    symbols = prop_symbols(s)
+    return dict([(p, model[symtab.index[p]]) for p in symbols])
+
+def portfolio_configs(n, seed=0):
+    """n solver configurations for portfolio_satisfiable: a seeded
+    CDCLSolver, dpll, and then WalkSAT runs with different noise and seeds
+    in turn with CDCLSolvers with different seeds (and so different initial
+    activities and phases).  WalkSAT alone can not show that there is no
+    model, so the first two are the complete ones.
+    >>> portfolio_configs(4)
+    [('cdcl', 0), ('dpll', None), ('walksat', (0.5, 2)), ('cdcl', 3)]
+    """
+    configs = [('cdcl', seed), ('dpll', None)]
+    noise = [0.5, 0.2, 0.35, 0.65]
+    i = 2
+    while len(configs) < n:
+        if i % 2:
+            configs.append(('cdcl', seed + i))
+        else:
+            configs.append(('walksat', (noise[(i // 2 - 1) % 4], seed + i)))
+        i += 1
+    return configs[:max(n, 1)]
+
+_portfolio = {}     ## the clauses and nvars, in a portfolio worker process
+
+def portfolio_init(packed, nvars):
+    "Unpack the clauses shipped to a portfolio worker."
+    flat = array.array('i')
+    flat.fromstring(packed)
+    clauses, c = [], []
+    for lit in flat:
+        if lit:
+            c.append(lit)
+        else:
+            clauses.append(tuple(c))
+            c = []
+    _portfolio['clauses'], _portfolio['nvars'] = clauses, nvars
+
+walksat_flips = 1000000     ## flips for a WalkSAT configuration
+
+def portfolio_run(config):
+    """Run one configuration on the worker's clauses.  Return (config,
+    status, model), where status is True (model is a list of values indexed
+    by var), False, or None when the run gave no definite answer."""
+    clauses, nvars = _portfolio['clauses'], _portfolio['nvars']
+    engine, arg = config
+    if engine == 'cdcl':
+        solver = CDCLSolver(nvars, seed=arg)
+        for c in clauses:
+            solver.add_clause(c)
+        if solver.solve():
+            return config, True, solver.model
+        return config, False, None
+    elif engine == 'walksat':
+        p, seed = arg
+        solver = WalkSATSolver(clauses, nvars, seed)
+        if solver.solve(p, walksat_flips):
+            return config, True, solver.model
+        return config, None, None
+    elif engine == 'dpll':
+        symtab = SymbolTable()
+        for v in range(1, nvars + 1):
+            symtab.var(Expr('X%d' % v))
+        try:
+            model = dpll(map(symtab.expr_clause, clauses),
+                         symtab.symbols[1:], {})
+        except RuntimeError:    ## too deep a recursion
+            return config, None, None
+        if model is False:
+            return config, False, None
+        return config, True, [None] + [model.get(symtab.symbols[v], False)
+                                       for v in range(1, nvars + 1)]
+    raise ValueError("Unknown engine: %s" % engine)
+
+#______________________________________________________________________________
+# Model counting
+
+class ModelCounter:
+    """Counts the models of int clauses (see SymbolTable) by DPLL: branch on
+    the var in the most clauses, propagate units, and split what is left
+    into components that share no vars, whose counts multiply.  The count
+    of each component is cached under its clauses, so a component that
+    recurs on other branches is counted once.  With weights, a dict from
+    int literals to numbers (missing ones weigh 1), a model counts as the
+    product of the weights of its literals.
+    >>> ModelCounter().count([(1, 2), (-1, 3)], [1, 2, 3, 4])
+    8
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+        self.cache = {}         ## frozenset of clauses -> count
+
+    def weight(self, lit):
+        return self.weights.get(lit, 1)
+
+    def count(self, clauses, variables):
+        "The (weighted) number of models of the clauses over the variables."
+        clauses = frozenset([tuple(sorted(set(c))) for c in clauses])
+        result = self.count_branch(clauses, set(variables), ())
+        return utils_lpw.if_(result is None, 0, result)
+
+    def count_component(self, clauses):
+        "The count of a connected set of clauses, over their vars."
+        result = self.cache.get(clauses)
+        if result is None:
+            occurrences = {}
+            for c in clauses:
+                for lit in c:
+                    occurrences[abs(lit)] = occurrences.get(abs(lit), 0) + 1
+            v = max(occurrences, key=occurrences.get)
+            vs = set(occurrences)
+            result = 0
+            for lit in (v, -v):
+                n = self.count_branch(clauses, vs, (lit,))
+                if n is not None:
+                    result += n
+            self.cache[clauses] = result
+        return result
+
+    def count_branch(self, clauses, variables, units):
+        """The count over variables of the clauses with the literals in units
+        made true, or None if unit propagation finds a conflict."""
+        assigned = set()
+        factor = 1
+        units = list(units) + [c[0] for c in clauses if len(c) == 1]
+        while units:
+            lit = units.pop()
+            if lit in assigned: continue
+            if -lit in assigned: return None
+            assigned.add(lit)
+            factor *= self.weight(lit)
+            rest = []
+            for c in clauses:
+                if lit in c: continue
+                if -lit in c:
+                    c = tuple([l for l in c if l != -lit])
+                    if not c: return None
+                    if len(c) == 1: units.append(c[0])
+                rest.append(c)
+            clauses = rest
+        clauses = [c for c in clauses if not assigned.intersection(c)]
+        free = set(variables)
+        for lit in assigned:
+            free.discard(abs(lit))
+        for c in clauses:
+            for lit in c:
+                free.discard(abs(lit))
+        for v in free:
+            factor *= self.weight(v) + self.weight(-v)
+        for component in components(clauses):
+            if not factor: break
+            factor *= self.count_component(component)
+        return factor
+
+def components(clauses):
+    """Split clauses into frozensets that share no vars.
+    >>> sorted(map(sorted, components([(1, 2), (3,), (-2, 4)])))
+    [[(-2, 4), (1, 2)], [(3,)]]
+    """
+    parent = {}
+    def find(v):
+        root = v
+        while parent[root] != root:
+            root = parent[root]
+        while parent[v] != root:
+            parent[v], v = root, parent[v]
+        return root
+    for c in clauses:
+        for lit in c:
+            parent.setdefault(abs(lit), abs(lit))
+        for lit in c[1:]:
+            a, b = find(abs(c[0])), find(abs(lit))
+            if a != b: parent[a] = b
+    groups = {}
+    for c in clauses:
+        groups.setdefault(find(abs(c[0])), []).append(c)
+    return [frozenset(group) for group in groups.values()]
+
+#______________________________________________________________________________
+# Knowledge compilation
+
+class BDD:
+    """A manager of reduced ordered binary decision diagrams over int vars
+    (see SymbolTable).  A node is an int: 0 and 1 are the false and true
+    terminals, and node i > 1 tests self.var[i], going to self.low[i] if it
+    is false and to self.high[i] if it is true.  The unique table makes
+    each (var, low, high) one node, and no node has low == high, so two
+    functions are equal just when their nodes are.  Vars are tested in the
+    order given (a var not in it goes after the vars seen so far).  ite
+    keeps its results in a computed table, which is emptied whenever it
+    reaches cache_size entries, so its memory stays bounded.
+    >>> bdd = BDD([2, 1])
+    >>> f = bdd.and_(bdd.clause((1, 2)), bdd.clause((-1, 2)))
+    >>> f == bdd.literal(2), bdd.count(f, [1, 2]), bdd.size(f)
+    (True, 2, 1)
+    """
+
+    def __init__(self, order=(), cache_size=1 << 18):
+        self.var, self.low, self.high = [0, 0], [0, 1], [0, 1]
+        self.levels = [1 << 30, 1 << 30]    ## node -> level of its var
+        self.unique = {}        ## (var, low, high) -> node
+        self.computed = {}      ## (f, g, h) -> ite(f, g, h)
+        self.cache_size = cache_size
+        self.order = {}         ## var -> level
+        for v in order:
+            self.level(v)
+
+    def __len__(self):
+        return len(self.var)
+
+    def level(self, v):
+        "The level of var v, giving it the next level if it has none."
+        level = self.order.get(v)
+        if level is None:
+            level = self.order[v] = len(self.order)
+        return level
+
+    def node(self, v, low, high):
+        "The node that tests v, made if there is none yet."
+        if low == high: return low
+        key = (v, low, high)
+        n = self.unique.get(key)
+        if n is None:
+            n = self.unique[key] = len(self.var)
+            self.var.append(v)
+            self.low.append(low)
+            self.high.append(high)
+            self.levels.append(self.level(v))
+        return n
+
+    def literal(self, lit):
+        "The node for the int literal lit."
+        if lit > 0: return self.node(lit, 0, 1)
+        return self.node(-lit, 1, 0)
+
+    def clause(self, clause):
+        "The node for the disjunction of the int literals in clause."
+        f = 0
+        for lit in sorted(clause, key=lambda lit: -self.level(abs(lit))):
+            if lit > 0: f = self.node(lit, f, 1)
+            else: f = self.node(-lit, 1, f)
+        return f
+
+    def ite(self, f, g, h):
+        """The node for (f & g) | (~f & h).  The recursion on the cofactors
+        runs on a stack of our own, as it goes as deep as there are vars:
+        a call is a triple, and a pair (key, var) makes the node for key
+        from the two results on top of the results stack."""
+        levels, low, high = self.levels, self.low, self.high
+        computed = self.computed
+        stack, results = [(f, g, h)], []
+        while stack:
+            frame = stack.pop()
+            if len(frame) == 2:
+                key, v = frame
+                r1, r0 = results.pop(), results.pop()
+                r = self.node(v, r0, r1)
+                if len(computed) >= self.cache_size:
+                    computed.clear()
+                computed[key] = r
+                results.append(r)
+                continue
+            f, g, h = frame
+            if f == 1: r = g
+            elif f == 0: r = h
+            elif g == h: r = g
+            elif g == 1 and h == 0: r = f
+            else: r = computed.get(frame)
+            if r is not None:
+                results.append(r)
+                continue
+            top = min(levels[f], levels[g], levels[h])
+            for n in (f, g, h):
+                if levels[n] == top:
+                    v = self.var[n]
+                    break
+            f0, f1 = utils_lpw.if_(levels[f] == top, (low[f], high[f]), (f, f))
+            g0, g1 = utils_lpw.if_(levels[g] == top, (low[g], high[g]), (g, g))
+            h0, h1 = utils_lpw.if_(levels[h] == top, (low[h], high[h]), (h, h))
+            stack.append((frame, v))
+            stack.append((f1, g1, h1))
+            stack.append((f0, g0, h0))
+        return results[0]
+
+    def not_(self, f):
+        return self.ite(f, 0, 1)
+
+    def and_(self, f, g):
+        return self.ite(f, g, 0)
+
+    def or_(self, f, g):
+        return self.ite(f, 1, g)
+
+    def conjoin(self, nodes):
+        """The node for the conjunction of nodes, taken in pairs so that the
+        intermediate nodes stay small."""
+        nodes = list(nodes) or [1]
+        while len(nodes) > 1:
+            pairs = [self.and_(nodes[i], nodes[i + 1])
+                     for i in range(0, len(nodes) - 1, 2)]
+            if len(nodes) % 2: pairs.append(nodes[-1])
+            nodes = pairs
+        return nodes[0]
+
+    def nodes(self, f):
+        "The nodes reachable from f (terminals included), children first."
+        seen, result, stack = set([0, 1]), [], [f]
+        while stack:
+            n = stack[-1]
+            if n in seen:
+                stack.pop()
+                continue
+            low, high = self.low[n], self.high[n]
+            if low in seen and high in seen:
+                seen.add(n)
+                result.append(stack.pop())
+            else:
+                stack.extend([c for c in (low, high) if c not in seen])
+        return result
+
+    def size(self, f):
+        "The number of non-terminal nodes reachable from f."
+        return len(self.nodes(f))
+
+    def restrict(self, f, lits):
+        """The node for f with each of the int literals in lits made true, in
+        one pass over the nodes of f."""
+        value = dict([(abs(lit), lit > 0) for lit in lits])
+        new = {0: 0, 1: 1}
+        for n in self.nodes(f):
+            v, low, high = self.var[n], new[self.low[n]], new[self.high[n]]
+            if v in value:
+                new[n] = utils_lpw.if_(value[v], high, low)
+            else:
+                new[n] = self.node(v, low, high)
+        return new[f]
+
+    def count(self, f, variables, weights=None):
+        """The number of models of f over the variables (which include those
+        of f), in one pass over its nodes.  With weights, a dict from int
+        literals to numbers (missing ones weigh 1), a model counts as the
+        product of the weights of its literals."""
+        weights = weights or {}
+        variables = sorted(variables, key=self.level)
+        position = dict([(v, i) for (i, v) in enumerate(variables)])
+        both = [weights.get(v, 1) + weights.get(-v, 1) for v in variables]
+        def gap(i, n):
+            "The weight of the variables from position i to node n's var."
+            j = position[self.var[n]] if n > 1 else len(variables)
+            result = 1
+            for w in both[i:j]:
+                result *= w
+            return result
+        count = {0: 0, 1: 1}
+        for n in self.nodes(f):
+            v = self.var[n]
+            i = position[v] + 1
+            low, high = self.low[n], self.high[n]
+            count[n] = (weights.get(-v, 1) * gap(i, low) * count[low] +
+                        weights.get(v, 1) * gap(i, high) * count[high])
+        return gap(0, f) * count[f]
+
+    def copy_to(self, other, f):
+        "The node for f in the manager other, copying the nodes of f there."
+        new = {0: 0, 1: 1}
+        for n in self.nodes(f):
+            new[n] = other.node(self.var[n], new[self.low[n]],
+                                new[self.high[n]])
+        return new[f]
+
+def force_order(clauses, variables, iterations=20):
+    """An order of the variables that keeps the vars of each clause close
+    together, by the FORCE heuristic: each var moves to the mean of the
+    centres of its clauses, over and over, while the total span of the
+    clauses goes down.  BDDs of clauses that are near in the order stay
+    small.
+    >>> force_order([(1, 3), (3, 2)], [1, 2, 3])
+    [1, 3, 2]
+    """
+    order = list(variables)
+    occurrences = dict([(v, []) for v in order])
+    clauses = [[abs(lit) for lit in c] for c in clauses if c]
+    for i, c in enumerate(clauses):
+        for v in c:
+            occurrences[v].append(i)
+    def span(position):
+        return sum([max([position[v] for v in c]) -
+                    min([position[v] for v in c]) for c in clauses])
+    position = dict([(v, i) for (i, v) in enumerate(order)])
+    best = span(position)
+    for iteration in range(iterations):
+        centre = [sum([position[v] for v in c]) / float(len(c))
+                  for c in clauses]
+        gravity = {}
+        for v in order:
+            cs = occurrences[v]
+            if cs:
+                gravity[v] = sum([centre[i] for i in cs]) / len(cs)
+            else:
+                gravity[v] = position[v]
+        new_order = sorted(order, key=lambda v: (gravity[v], position[v]))
+        new_position = dict([(v, i) for (i, v) in enumerate(new_order)])
+        s = span(new_position)
+        if s >= best: break
+        order, position, best = new_order, new_position, s
+    return order
+
+class BDDKB(PropKB):
+    """A PropKB compiled to one BDD, for a KB that is asked far more often
+    than it changes.  tell conjoins the BDDs of the new clauses to the root;
+    retract compiles the remaining clauses again, in a new BDD manager (as
+    does tell, when the manager grows past max_nodes).  With order='force'
+    the vars are ordered by force_order; with order='given', in the order
+    the symbols were first told.  Once compiled, consistency is a test of
+    the root, and counting models and asking whether a conjunction of
+    literals is entailed each take one pass over the BDD; other queries
+    take a conjunction with the BDD of the negated query.  condition makes
+    a new KB with some literals told, sharing the BDD manager.
+    >>> kb = BDDKB(expr('(A ==> B) & (B ==> C)'))
+    >>> kb.ask(expr('A ==> C')), kb.ask(expr('C')), kb.count_models()
+    ({}, False, 4)
+    >>> kb.condition(expr('A')).ask(expr('C'))
+    {}
+    """
+
+    max_nodes = 1 << 20     ## compact the manager when it has this many nodes
+
+    def __init__(self, sentence=None, order='force', cache_size=1 << 18):
+        if order not in ('force', 'given'):
+            raise ValueError("Unknown order: %s" % order)
+        PropKB.__init__(self)
+        self.order, self.cache_size = order, cache_size
+        self.symtab = SymbolTable()
+        self.variables = set()  ## the vars of the KB's symbols
+        if sentence:
+            PropKB.tell(self, sentence)
+        self.compile()
+
+    def compile(self):
+        "Build the BDD of the KB's clauses anew."
+        ints = [c for c in map(self.symtab.clause, self.clauses)
+                if c is not None]
+        self.variables = set()
+        self.add_variables(self.clauses)
+        order = sorted(self.variables)
+        if self.order == 'force':
+            order = force_order(ints, order)
+        self.bdd = BDD(order, self.cache_size)
+        self.root = self.bdd.conjoin(map(self.bdd.clause, ints))
+
+    def add_variables(self, clauses):
+        """Add the vars of the symbols of clauses to .variables, including
+        those of clauses that are always true, as PropKB counts them."""
+        for c in clauses:
+            for p in prop_symbols(c):
+                self.variables.add(self.symtab.var(p))
+
+    def from_kb(cls, kb, order='force'):
+        "Compile the clauses of a PropKB."
+        result = cls(order=order)
+        result.clauses = list(kb.clauses)
+        result.compile()
+        return result
+    from_kb = classmethod(from_kb)
+
+    def tell(self, sentence):
+        "Add the sentence's clauses to the KB, and conjoin them to the BDD."
+        n = len(self.clauses)
+        PropKB.tell(self, sentence)
+        ints = [c for c in map(self.symtab.clause, self.clauses[n:])
+                if c is not None]
+        self.add_variables(self.clauses[n:])
+        bdd = self.bdd
+        self.root = bdd.and_(self.root, bdd.conjoin(map(bdd.clause, ints)))
+        if len(bdd) > self.max_nodes:
+            self.bdd = BDD(sorted(bdd.order, key=bdd.order.get),
+                           self.cache_size)
+            self.root = bdd.copy_to(self.bdd, self.root)
+
+    def retract(self, sentence):
+        "Remove the sentence's clauses from the KB, and compile it again."
+        PropKB.retract(self, sentence)
+        self.compile()
+
+    def ask_generator(self, query):
+        "Yield the empty substitution if KB implies query; else False"
+        if self.entails(expr(query)):
+            yield {}
+
+    def consistent(self):
+        "Does the KB have a model?"
+        return self.root != 0
+
+    def entails(self, query):
+        """Does the KB imply query?  For a conjunction of literals, the KB
+        implies each one if making it false leaves no model.  TRUE (or ~FALSE)
+        is dropped from the conjunction, and FALSE (or ~TRUE) makes it entailed
+        just when the KB has no model.
+        >>> kb = BDDKB(expr('A & (A ==> B)'))
+        >>> kb.entails(expr('B & TRUE')), kb.entails(expr('B & ~TRUE'))
+        (True, False)
+        """
+        lits = []
+        for c in conjuncts(query):
+            if c == TRUE or c == ~FALSE:
+                continue
+            if c == FALSE or c == ~TRUE:
+                return not self.consistent()
+            p = literal_symbol(c)
+            if not is_prop_symbol(p.op) or p.args:
+                bdd, clauses = self.bdd, conjuncts(to_cnf(~query))
+                ints = [c for c in map(self.symtab.clause, clauses)
+                        if c is not None]
+                return bdd.and_(self.root, bdd.conjoin(map(bdd.clause,
+                                                           ints))) == 0
+            lits.append(self.symtab.literal(c))
+        for lit in lits:
+            if self.bdd.restrict(self.root, [-lit]) != 0:
+                return False
+        return True
+
+    def condition(self, facts):
+        """A new KB that is this one with facts (a conjunction of literals)
+        told, sharing its BDD manager."""
+        kb = BDDKB.__new__(BDDKB)
+        kb.__dict__.update(self.__dict__)
+        kb.clauses, kb.variables = list(self.clauses), set(self.variables)
+        kb.definitions = set(self.definitions)
+        kb.tell(facts)
+        return kb
+
+    def model_count(self, clauses, symbols, weights=None):
+        """The weighted count of the models of the KB's clauses and the given
+        ones, over their symbols and the given symbols (as for PropKB), by a
+        pass over the BDD of the KB conjoined with the given clauses."""
+        bdd, symtab = self.bdd, self.symtab
+        variables = set(self.variables)
+        for s in list(clauses) + list(symbols):
+            for p in prop_symbols(s):
+                variables.add(symtab.var(p))
+        ints = [c for c in map(symtab.clause, clauses) if c is not None]
+        f = bdd.and_(self.root, bdd.conjoin(map(bdd.clause, ints)))
+        w = {}
+        for lit, value in (weights or {}).items():
+            w[symtab.literal(expr(lit))] = value
+        return bdd.count(f, variables, w)
+
+#______________________________________________________________________________
+# Wumpus world
+
+class WumpusKB(IntPropKB):
+    """An IntPropKB of wumpus-world axioms for the squares (x, y) with
+    1 <= x <= width and 1 <= y <= height, over the symbols P_x_y (a pit),
+    W_x_y (the wumpus), B_x_y (a breeze) and S_x_y (a stench).  Telling all
+    the axioms up front takes a clause per pair of squares (there is at
+    most one wumpus), so instead visit(x, y) adds only those about the
+    visited square and its neighbours, straight as int clauses:
+    B_x_y <=> (P of some neighbour), the same for S and W, that the square
+    is safe, and at-most-one clauses for the wumpus among the squares seen
+    so far.  (The at-most-one clauses for unseen squares would change nothing
+    that follows about the seen ones; there is no at-least-one clause.)
+    >>> kb = WumpusKB(4, 4)
+    >>> kb.tell_percept(1, 1, stench=False, breeze=False)
+    >>> kb.safe(2, 1), kb.safe(3, 1)
+    (True, False)
+    >>> kb.ask(expr('~P_1_2'))
+    {}
+    """
+
+    def __init__(self, width, height):
+        IntPropKB.__init__(self)
+        self.width, self.height = width, height
+        self.vars = {}          ## (kind, x, y) -> int
+        self.visited = set()
+        self.walls = set()      ## squares found to be walls, not to explore
+        self.seen = []          ## squares with at-most-one wumpus clauses
+
+    def var(self, kind, x, y):
+        "The int for the symbol kind_x_y, where kind is 'P', 'W', 'B' or 'S'."
+        key = (kind, x, y)
+        v = self.vars.get(key)
+        if v is None:
+            v = self.vars[key] = self.symtab.var(Expr('%s_%d_%d' % key))
+        return v
+
+    def neighbours(self, x, y):
+        "The squares next to (x, y) on the grid."
+        return [(i, j) for (i, j) in ((x+1, y), (x-1, y), (x, y+1), (x, y-1))
+                if 1 <= i <= self.width and 1 <= j <= self.height]
+
+    def fringe(self):
+        "The unvisited squares, not known to be walls, next to a visited one."
+        return set([sq for square in self.visited
+                    for sq in self.neighbours(*square)
+                    if sq not in self.visited and sq not in self.walls])
+
+    def wall(self, x, y):
+        "Rule out (x, y) as a square to explore: there is a wall there."
+        self.walls.add((x, y))
+
+    def add(self, *lits):
+        self.add_clause(tuple(sorted(lits)))
+
+    def visit(self, x, y):
+        "Add the axioms about square (x, y), if it has not been visited."
+        if (x, y) in self.visited: return
+        self.visited.add((x, y))
+        var = self.var
+        self.add(-var('P', x, y))
+        self.add(-var('W', x, y))
+        nbrs = self.neighbours(x, y)
+        for sq in [(x, y)] + nbrs:
+            self.see(*sq)
+        for percept, cause in (('B', 'P'), ('S', 'W')):
+            p = var(percept, x, y)
+            causes = [var(cause, i, j) for (i, j) in nbrs]
+            self.add(-p, *causes)
+            for c in causes:
+                self.add(p, -c)
+
+    def see(self, x, y):
+        "Add that there is no wumpus both at (x, y) and at a square seen before."
+        if (x, y) in self.seen: return
+        w = self.var('W', x, y)
+        for (i, j) in self.seen:
+            self.add(-w, -self.var('W', i, j))
+        self.seen.append((x, y))
+
+    def tell_percept(self, x, y, stench, breeze):
+        "Add what was perceived at square (x, y)."
+        self.visit(x, y)
+        self.add(utils_lpw.if_(stench, 1, -1) * self.var('S', x, y))
+        self.add(utils_lpw.if_(breeze, 1, -1) * self.var('B', x, y))
+
+    def entails(self, lit):
+        "Does the KB imply the int literal lit?"
+        implied = self.implied_literals([abs(lit)])
+        return implied is None or implied[abs(lit)] == lit
+
+    def safe(self, x, y):
+        "Is there provably neither a pit nor the wumpus at (x, y)?"
+        return (self.entails(-self.var('P', x, y)) and
+                self.entails(-self.var('W', x, y)))
+
+    def unsafe(self, x, y):
+        "Is there provably a pit or the wumpus at (x, y)?"
+        return (self.entails(self.var('P', x, y)) or
+                self.entails(self.var('W', x, y)))
 
 
 # PL-Wumpus-Agent [Fig. 7.19]
 class PLWumpusAgent(agents.Agent):
-    "An agent for the wumpus world that does logical inference. [Fig. 7.19]"""
-    def __init__(self):
-        KB = FOLKB()
-        x, y, orientation = 1, 1, (1, 0)
-        visited = set() ## squares already visited
-        action = None
+    """An agent for the wumpus world that does logical inference. [Fig. 7.19]
+    It tells each percept to a WumpusKB of the width x height squares inside
+    the walls, grabs any gold, and otherwise goes, through visited squares,
+    to the nearest unvisited square that the KB proves safe; if there is
+    none, to one that the KB can not prove unsafe.  for_environment sizes
+    the KB to an environment; otherwise a bump tells the agent that the
+    square ahead is a wall, which it then no longer tries to reach."""
+
+    def __init__(self, width=8, height=8):
+        agents.Agent.__init__(self)
+        self.KB = WumpusKB(width, height)
         plan = []
 
         def program(percept):
-            stench, breeze, glitter = percept
-            x, y, orientation = update_position(x, y, orientation, action)
-            KB.tell('%sS_%d,%d' % (if_(stench, '', '~'), x, y))
-            KB.tell('%sB_%d,%d' % (if_(breeze, '', '~'), x, y))
-            if glitter: action = 'Grab'
-            elif plan: action = plan.pop()
-            else:
-                for [i, j] in fringe(visited):
-                    if KB.ask('~P_%d,%d & ~W_%d,%d' % (i, j, i, j)) != False:
-                        raise NotImplementedError
-                    KB.ask('~P_%d,%d | ~W_%d,%d' % (i, j, i, j)) != False 
-            if action == None: 
-                action = random.choice(['Forward', 'TurnRight', 'TurnLeft'])
-            return action
+            location, direction, stench, breeze, glitter, bump, scream = percept
+            self.KB.tell_percept(location[0], location[1], stench, breeze)
+            if bump:
+                self.KB.wall(*vector_add(location, direction))
+                del plan[:]
+            if glitter:
+                return 'Grab'
+            if not plan:
+                plan.extend(reversed(self.plan(location, direction)))
+            if plan:
+                return plan.pop()
+            return random.choice(['Forward', 'TurnRight', 'TurnLeft'])
 
         self.program = program
 
+    def for_environment(cls, env):
+        "An agent whose KB covers the squares inside the walls of env."
+        return cls(env.width - 2, env.height - 2)
+    for_environment = classmethod(for_environment)
+
+    def plan(self, location, direction):
+        "The actions to the next square to explore, or [] if there is none."
+        KB = self.KB
+        fringe = KB.fringe()
+        KB.implied_literals([KB.var(kind, x, y)
+                             for (x, y) in fringe for kind in 'PW'])
+        goals = [sq for sq in fringe if KB.safe(*sq)]
+        if not goals:
+            goals = [sq for sq in fringe if not KB.unsafe(*sq)]
+        return plan_route(location, direction, goals, KB.visited)
+
+def plan_route(start, heading, goals, allowed):
+    """The actions that take an agent at start facing heading to the nearest
+    of the goals, moving only through the allowed squares; [] if none can
+    be reached.  Actions are as in update_position.
+    >>> plan_route((1, 1), (1, 0), [(1, 2)], set([(1, 1)]))
+    ['TurnRight', 'Forward']
+    """
+    goals = set(goals)
+    previous = {start: None}
+    frontier = collections.deque([start])
+    while frontier:
+        square = frontier.popleft()
+        if square in goals:
+            path = []
+            while square != start:
+                path.append(square)
+                square = previous[square]
+            break
+        if square not in allowed: continue
+        for heading1 in ((1, 0), (0, 1), (-1, 0), (0, -1)):
+            sq = vector_add(square, heading1)
+            if sq not in previous and (sq in allowed or sq in goals):
+                previous[sq] = square
+                frontier.append(sq)
+    else:
+        return []
+    actions = []
+    square = start
+    for sq in reversed(path):
+        want = (sq[0] - square[0], sq[1] - square[1])
+        while heading != want:
+            if turn_heading(heading, -1) == want:
+                actions.append('TurnLeft')
+                heading = want
+            else:
+                actions.append('TurnRight')
+                heading = turn_heading(heading, +1)
+        actions.append('Forward')
+        square = sq
+    return actions
+
 def update_position(x, y, orientation, action):
     if action == 'TurnRight':
         orientation = turn_heading(orientation, +1)
@@ -739,8 +3140,8 @@ def unify(x, y, s):
     elif isinstance(x, Expr) and isinstance(y, Expr):
         return unify(x.args, y.args, unify(x.op, y.op, s))
     elif isinstance(x, str) or isinstance(y, str) or not x or not y:
-        return if_(x == y, s, None)
-    elif issequence(x) and issequence(y) and len(x) == len(y):
+        return utils_lpw.if_(x == y, s, None)
+    elif utils_lpw.issequence(x) and utils_lpw.issequence(y) and len(x) == len(y):
         return unify(x[1:], y[1:], unify(x[0], y[0], s))
     else:
         return None
@@ -752,6 +3153,8 @@ def is_variable(x):
 def unify_var(var, x, s):
     if var in s:
         return unify(s[var], x, s)
+    elif is_variable(x) and x in s:
+        return unify(var, s[x], s)
     elif occur_check(var, x):
         return None
     else:
@@ -778,7 +3181,8 @@ def extend(s, var, val):
     return s2
     
 def subst(s, x):
-    """Substitute the substitution s into the expression x.
+    """Substitute the substitution s into the expression x.  Parts of x
+    that the substitution leaves alone are returned as they are, not copied.
     >>> subst({x: 42, y:0}, F(x) + y)
     (F(42) + 0)
     """
@@ -790,18 +3194,378 @@ def subst(s, x):
         return x
     elif is_var_symbol(x.op): 
         return s.get(x, x)
+    elif not x.args or not s:
+        return x
     else: 
-        return Expr(x.op, *[subst(s, arg) for arg in x.args])
+        args = [subst(s, arg) for arg in x.args]
+        for new, old in zip(args, x.args):
+            if new is not old:
+                return Expr(x.op, *args)
+        return x
+
+class BindingStore:
+    """A substitution that is changed in place, for unification without
+    copying dicts.  Each binding is recorded on a trail, so checkpoint()
+    marks a point and undo(mark) takes back every binding made since, in
+    time proportional to their number.  Bindings are kept in triangular
+    form (a var may be bound to a term with bound vars in it), and walk and
+    subst look through them.  With occur_check=False, unify skips the check
+    that a var is not bound to a term containing it: faster, but unsound
+    in the cases the check exists for.
+    >>> store = BindingStore()
+    >>> store.unify(F(x, y), F(y, A))
+    True
+    >>> store.subst(F(x, y))
+    F(A, A)
+    >>> mark = store.checkpoint()
+    >>> store.unify(G(z), G(F(x))), store.subst(z)
+    (True, F(A))
+    >>> store.undo(mark); store.subst(z)
+    z
+    """
+
+    def __init__(self, occur_check=True):
+        self.bindings = {}  ## var -> value
+        self.trail = []     ## the bound vars, in the order bound
+        self.occur_check = occur_check
+
+    def checkpoint(self):
+        return len(self.trail)
+
+    def undo(self, mark):
+        "Unbind every var bound since checkpoint() returned mark."
+        trail, bindings = self.trail, self.bindings
+        while len(trail) > mark:
+            del bindings[trail.pop()]
+
+    def bind(self, var, value):
+        self.bindings[var] = value
+        self.trail.append(var)
+
+    def walk(self, x):
+        "Follow x through the bindings while it is a bound var."
+        bindings = self.bindings
+        try:
+            while x in bindings:
+                x = bindings[x]
+        except TypeError:   ## x is a list, so not a var
+            pass
+        return x
+
+    def unify(self, x, y):
+        """Extend the bindings so that x and y are equal and return True, or
+        return False with the bindings unchanged if they can not unify."""
+        mark = len(self.trail)
+        stack = [(x, y)]
+        while stack:
+            x, y = stack.pop()
+            x, y = self.walk(x), self.walk(y)
+            if x is y or x == y:
+                continue
+            if is_variable(x):
+                if self.occur_check and self.occurs(x, y): break
+                self.bind(x, y)
+            elif is_variable(y):
+                if self.occur_check and self.occurs(y, x): break
+                self.bind(y, x)
+            elif isinstance(x, Expr) and isinstance(y, Expr):
+                if x.op != y.op or len(x.args) != len(y.args): break
+                stack.extend(zip(x.args, y.args))
+            elif (isinstance(x, (list, tuple)) and
+                  isinstance(y, (list, tuple)) and len(x) == len(y)):
+                stack.extend(zip(x, y))
+            else:
+                break
+        else:
+            return True
+        self.undo(mark)
+        return False
+
+    def occurs(self, var, x):
+        "Does var occur in x, looking through the bindings?"
+        todo = [x]
+        while todo:
+            x = self.walk(todo.pop())
+            if x is var:
+                return True
+            elif isinstance(x, Expr):
+                todo.extend(x.args)
+            elif isinstance(x, (list, tuple)):
+                todo.extend(x)
+        return False
+
+    def subst(self, x):
+        """Apply the bindings to x all the way down.  As with subst, parts
+        of x that do not change are returned as they are."""
+        if not self.bindings:
+            return x
+        x = self.walk(x)
+        if isinstance(x, Expr):
+            if not x.args:
+                return x
+            args = [self.subst(arg) for arg in x.args]
+            for new, old in zip(args, x.args):
+                if new is not old:
+                    return Expr(x.op, *args)
+            return x
+        elif isinstance(x, list):
+            return [self.subst(xi) for xi in x]
+        elif isinstance(x, tuple):
+            return tuple([self.subst(xi) for xi in x])
+        return x
+
+    def substitution(self):
+        "The bindings as a dict, resolved through one another."
+        return dict([(var, self.subst(var)) for var in self.bindings])
         
+def variables(s):
+    """Return the set of variables in the expression s.
+    >>> sorted(variables(F(x, A, y)))
+    [x, y]
+    """
+    result = set()
+    todo = [s]
+    while todo:
+        s = todo.pop()
+        if is_variable(s):
+            result.add(s)
+        elif isinstance(s, Expr):
+            todo.extend(s.args)
+    return result
+
+def is_definite_clause(s):
+    """A definite clause is an atom, or a conjunction of atoms that
+    implies an atom.
+    >>> is_definite_clause(expr('Farmer(Mac)'))
+    True
+    >>> is_definite_clause(expr('~Farmer(Mac)'))
+    False
+    >>> is_definite_clause(expr('(Farmer(f) & Rabbit(r)) ==> Hates(f, r)'))
+    True
+    """
+    if is_symbol(s.op):
+        return True
+    elif s.op == '>>':
+        antecedent, consequent = s.args
+        premises = dissociate('&', [antecedent])
+        return (is_symbol(consequent.op) and
+                all([is_symbol(arg.op) for arg in premises]))
+    return False
+
+def parse_definite_clause(s):
+    "Return the premises (a list of atoms) and the conclusion of s."
+    assert is_definite_clause(s)
+    if is_symbol(s.op):
+        return [], s
+    return dissociate('&', [s.args[0]]), s.args[1]
+
+class AtomIndex:
+    """Files items under an atom: first under its predicate (op and arity),
+    then under its first argument if that has no variables, or None if it
+    has.  fetch(atom) returns the items filed under atoms that might unify
+    with atom, skipping those with a different first argument.
+    >>> index = AtomIndex()
+    >>> for a in [F(A), F(B), F(x), G(A)]: index.add(a, a)
+    >>> index.fetch(F(A)), index.fetch(F(y))
+    ([F(A), F(x)], [F(A), F(B), F(x)])
+    """
+
+    def __init__(self):
+        self.table = {} ## (op, arity) -> (items, {first arg or None: items})
+
+    def key(self, atom):
+        "The predicate of atom, and its first argument (or None)."
+        first = None
+        if atom.args and not variables(atom.args[0]):
+            first = atom.args[0]
+        return (atom.op, len(atom.args)), first
+
+    def add(self, atom, item):
+        pred, first = self.key(atom)
+        entry = self.table.get(pred)
+        if entry is None:
+            entry = self.table[pred] = ([], {})
+        entry[0].append(item)
+        entry[1].setdefault(first, []).append(item)
+
+    def remove(self, atom, item):
+        pred, first = self.key(atom)
+        items, by_first = self.table[pred]
+        items.remove(item)
+        by_first[first].remove(item)
+
+    def fetch(self, atom):
+        pred, first = self.key(atom)
+        entry = self.table.get(pred)
+        if entry is None:
+            return []
+        items, by_first = entry
+        if first is None:
+            return items
+        return by_first.get(first, []) + by_first.get(None, [])
+
+
+class FolKB(KB):
+    """A KB of first-order definite clauses.  Each clause is filed in an
+    AtomIndex under its conclusion, so ask only tries the clauses whose
+    conclusion could unify with the goal at hand.  With occur_check=False,
+    ask skips the occur check when unifying (see BindingStore).
+    >>> kb = FolKB(map(expr, ['Farmer(Mac)', 'Rabbit(Pete)',
+    ...     '(Rabbit(r) & Farmer(f)) ==> Hates(f, r)']))
+    >>> kb.ask(expr('Hates(Mac, x)'))
+    {x: Pete}
+    """
+
+    def __init__(self, initial_clauses=[], occur_check=True):
+        self.clauses = []       ## the sentences, in the order told
+        self.index = AtomIndex()
+        self.occur_check = occur_check  ## for the unifications in ask
+        self.renamings = {}     ## (sentence, step) -> renamed copy, per ask
+        for clause in initial_clauses:
+            self.tell(clause)
+
+    def tell(self, sentence):
+        sentence = expr(sentence)
+        if not is_definite_clause(sentence):
+            raise ValueError("Not a definite clause: %s" % sentence)
+        premises, conclusion = parse_definite_clause(sentence)
+        self.clauses.append(sentence)
+        self.index.add(conclusion, (sentence, premises, conclusion,
+                                    list(variables(sentence))))
+
+    def fetch_rules_for_goal(self, goal):
+        """The (sentence, premises, conclusion, variables) entries of the
+        clauses whose conclusion might unify with goal."""
+        return self.index.fetch(goal)
+
+    renamings_size = 1 << 16 ## clear the renamings when there are this many
+
+    def renamed(self, entry, step):
+        """The premises and conclusion of a fetched clause with each var x
+        renamed to x.step, for use at that step of a proof.  The copies are
+        cached for the current ask, up to renamings_size of them."""
+        key = (entry[0], step)
+        copy = self.renamings.get(key)
+        if copy is None:
+            if len(self.renamings) >= self.renamings_size:
+                self.renamings.clear()
+            sentence, premises, conclusion, vs = entry
+            renaming = dict([(v, Expr('%s.%d' % (v.op, step))) for v in vs])
+            copy = ([subst(renaming, p) for p in premises],
+                    subst(renaming, conclusion))
+            self.renamings[key] = copy
+        return copy
+
+    def ask_generator(self, query):
+        "Yield a substitution for the query's variables for each proof."
+        query = expr(query)
+        qvars = variables(query)
+        self.renamings.clear()
+        store = BindingStore(self.occur_check)
+        for _ in fol_bc_and(self, dissociate('&', [query]), 0, store, 1):
+            yield dict([(var, store.subst(var)) for var in qvars])
+
+    def retract(self, sentence):
+        sentence = expr(sentence)
+        if sentence in self.clauses:
+            self.clauses.remove(sentence)
+            self.renamings.clear()
+            premises, conclusion = parse_definite_clause(sentence)
+            for entry in self.index.fetch(conclusion):
+                if entry[0] == sentence:
+                    self.index.remove(conclusion, entry)
+                    break
+
 def fol_fc_ask(KB, alpha):
-    """Inefficient forward chaining for first-order logic. [Fig. 9.3]
-    KB is an FOLHornKB and alpha must be an atomic sentence."""
+    """Semi-naive forward chaining for first-order logic. [Fig. 9.3]
+    KB is a FolKB of ground facts and rules, and alpha must be an atomic
+    sentence.  Yield a substitution for each fact, known or inferred, that
+    alpha unifies with.  Each round only joins a rule against the facts
+    inferred in the round before (the delta): once for each premise, which
+    is matched first, against the delta alone, while the premises before it
+    are matched against older facts and the ones after it against both.
+    >>> kb = FolKB(map(expr, ['Edge(A, B)', 'Edge(B, C)', 'Edge(x, y) ==> Path(x, y)',
+    ...     '(Path(x, y) & Edge(y, z)) ==> Path(x, z)']))
+    >>> sorted([repr(s[x]) for s in fol_fc_ask(kb, expr('Path(x, C)'))])
+    ['A', 'B']
+    """
+    alpha = expr(alpha)
+    facts = AtomIndex()
+    stamp = {}      ## fact -> the round it was inferred in
+    rules = []
+    for sentence in KB.clauses:
+        premises, conclusion = parse_definite_clause(sentence)
+        if premises:
+            rules.append((premises, conclusion))
+        elif conclusion not in stamp:
+            stamp[conclusion] = 0
+            facts.add(conclusion, conclusion)
+            theta = unify(alpha, conclusion, {})
+            if theta is not None:
+                yield theta
+    joins = [(fc_join_order(premises, i), conclusion)
+             for premises, conclusion in rules for i in range(len(premises))]
+    latest, delta = 0, facts
     while True:
-        new = {}
-        for r in KB.clauses:
-            r1 = standardize_apart(r)
-            ps, q = conjuncts(r.args[0]), r.args[1]
-            raise NotImplementedError
+        new = []
+        for order, conclusion in joins:
+            for theta in fc_join(facts, delta, stamp, order, 0, latest, {}):
+                q = subst(theta, conclusion)
+                if q not in stamp:
+                    stamp[q] = latest + 1
+                    new.append(q)
+        if not new:
+            return
+        delta = AtomIndex()
+        for q in new:
+            facts.add(q, q)
+            delta.add(q, q)
+            theta = unify(alpha, q, {})
+            if theta is not None:
+                yield theta
+        latest += 1
+
+def fc_join_order(premises, i):
+    """The order to match premises in when premises[i] is matched to the
+    delta.  Each premise comes paired with what fc_join should match it to.
+    The order is the one that leaves fewest premises after the first with
+    an unbound first argument (which the AtomIndex cannot narrow down), and
+    then that starts with the delta, which is smallest."""
+    tagged = [(p, j < i) for j, p in enumerate(premises)]
+    tagged[i] = (premises[i], None)
+    def cost(order):
+        unindexed, bound = 0, set()
+        for k, (p, older) in enumerate(order):
+            if k and not (p.args and variables(p.args[0]) <= bound):
+                unindexed += 1
+            bound |= variables(p)
+        return unindexed, order[0][1] is not None
+    if len(tagged) > 6:
+        return [tagged[i]] + tagged[:i] + tagged[i+1:]
+    return list(min(itertools.permutations(tagged), key=cost))
+
+def fc_join(facts, delta, stamp, order, j, latest, theta):
+    """Yield each extension of theta that matches the premises in order[j:]
+    to facts.  Each comes with None to match it to the delta, True to match
+    it to facts older than round latest, or False for facts up to latest."""
+    if j == len(order):
+        yield theta
+        return
+    p, older = order[j]
+    p = subst(theta, p)
+    if older is None:
+        candidates = delta.fetch(p)
+    else:
+        candidates = facts.fetch(p)
+    for fact in candidates:
+        t = stamp[fact]
+        if t > latest or (older and t == latest):
+            continue
+        theta1 = unify(p, fact, theta)
+        if theta1 is not None:
+            for theta2 in fc_join(facts, delta, stamp, order, j + 1, latest,
+                                  theta1):
+                yield theta2
 
 def standardize_apart(sentence, dic):
     """Replace all the variables in sentence with new variables."""
@@ -812,19 +3576,59 @@ def standardize_apart(sentence, dic):
             return dic[sentence]
         else:
             standardize_apart.counter += 1
-            dic[sentence] = Expr('V_%d' % standardize-apart.counter)
+            dic[sentence] = Expr('v_%d' % standardize_apart.counter)
             return dic[sentence]
     else: 
-        return Expr(sentence.op, *[standardize-apart(a, dic) for a in sentence.args])
+        return Expr(sentence.op, *[standardize_apart(a, dic) for a in sentence.args])
 
 standardize_apart.counter = 0
 
-def fol_bc_ask(KB, goals, theta):
-    "A simple backward-chaining algorithm for first-order logic. [Fig. 9.6]"
-    if not goals:
-        yield theta
-    q1 = subst(theta, goals[0])
-    raise NotImplementedError
+def fol_bc_ask(KB, goals, theta={}):
+    """A backward-chaining algorithm for first-order logic. [Fig. 9.6]
+    Yield each substitution extending theta that proves the goals (a list
+    of atoms, or a conjunction) from KB, a FolKB.  The clauses for a goal
+    come from the KB's index.  The search binds and unbinds vars in one
+    BindingStore rather than copying substitutions, and a clause used at
+    step n of a proof has its vars renamed apart as x.n, y.n, and so on,
+    so the renamed copies can be cached and used again.
+    >>> kb = FolKB(map(expr, ['Parent(A, B)', 'Parent(B, C)',
+    ...     '(Parent(x, y) & Parent(y, z)) ==> Grandparent(x, z)']))
+    >>> [s[x] for s in fol_bc_ask(kb, expr('Grandparent(x, C)'))]
+    [A]
+    """
+    if isinstance(goals, Expr):
+        goals = dissociate('&', [goals])
+    store = BindingStore(KB.occur_check)
+    for var, value in theta.items():
+        store.bind(var, value)
+    for _ in fol_bc_and(KB, goals, 0, store, 1):
+        yield store.substitution()
+
+def fol_bc_or(KB, goal, store, step):
+    """Yield (with the bindings in store) once for each proof of the atom
+    goal that starts at the given step, undoing the bindings of each proof
+    before trying the next.  What is yielded is the step after the proof."""
+    goal = store.subst(goal)
+    for entry in KB.fetch_rules_for_goal(goal):
+        sentence, premises, conclusion, vs = entry
+        next_step = step
+        if vs:
+            premises, conclusion = KB.renamed(entry, step)
+            next_step = step + 1
+        mark = store.checkpoint()
+        if store.unify(conclusion, goal):
+            for step1 in fol_bc_and(KB, premises, 0, store, next_step):
+                yield step1
+            store.undo(mark)
+
+def fol_bc_and(KB, goals, i, store, step):
+    "Yield once for each proof of all the atoms in goals[i:], as fol_bc_or."
+    if i == len(goals):
+        yield step
+        return
+    for step1 in fol_bc_or(KB, goals[i], store, step):
+        for step2 in fol_bc_and(KB, goals, i + 1, store, step1):
+            yield step2
 
 #______________________________________________________________________________
 
@@ -832,46 +3636,102 @@ def fol_bc_ask(KB, goals, theta):
 # You can use the Expr class to do symbolic differentiation.  This used to be
 # a part of AI; now it is considered a separate field, Symbolic Algebra.
 
-def diff(y, x):
+def subexpressions(y):
+    """Return the distinct subexpressions of y, each one after its args, so
+    that y comes last.  Exprs are hash-consed, so a subexpression that
+    occurs many times is one node of a DAG, and is listed once.
+    >>> subexpressions(x * x + x)
+    [x, (x * x), ((x * x) + x)]
+    """
+    order, seen = [], set()
+    stack = [(y, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            order.append(node)
+        elif node not in seen:
+            seen.add(node)
+            stack.append((node, True))
+            for arg in reversed(node.args):
+                if arg not in seen:
+                    stack.append((arg, False))
+    return order
+
+def diff(y, x, memo=None):
     """Return the symbolic derivative, dy/dx, as an Expr.
     However, you probably want to simplify the results with simp.
+    The derivative of each node of y's DAG is worked out once, from those
+    of its args, and kept in memo under (node, x); pass the same dict to
+    several calls to share that work between them.
     >>> diff(x * x, x)
     ((x * 1) + (x * 1))
     >>> simp(diff(x * x, x))
     (2 * x)
     """
+    if memo is None: memo = {}
+    if (y, x) not in memo:
+        for node in subexpressions(y):
+            if (node, x) not in memo:
+                memo[(node, x)] = diff_node(node, x, memo)
+    return memo[(y, x)]
+
+def diff_node(y, x, memo):
+    "The derivative of y, given those of its args in memo."
     if y == x: return ONE
     elif not y.args: return ZERO
     else:
         u, op, v = y.args[0], y.op, y.args[-1]
-        if op == '+': return diff(u, x) + diff(v, x)
-        elif op == '-' and len(args) == 1: return -diff(u, x)
-        elif op == '-': return diff(u, x) - diff(v, x)
-        elif op == '*': return u * diff(v, x) + v * diff(u, x)
-        elif op == '/': return (v*diff(u, x) - u*diff(v, x)) / (v * v)
-        elif op == '**' and utils_lpw.isnumber(x.op):
-            return (v * u ** (v - 1) * diff(u, x))
-        elif op == '**': return (v * u ** (v - 1) * diff(u, x)
-                                 + u ** v * Expr('log')(u) * diff(v, x))
-        elif op == 'log': return diff(u, x) / u
+        du, dv = memo[(u, x)], memo[(v, x)]
+        if op == '+': return du + dv
+        elif op == '-' and len(y.args) == 1: return -du
+        elif op == '-': return du - dv
+        elif op == '*': return u * dv + v * du
+        elif op == '/': return (v*du - u*dv) / (v * v)
+        elif op == '**' and utils_lpw.isnumber(v.op):
+            return (v * u ** (v - 1) * du)
+        elif op == '**': return (v * u ** (v - 1) * du
+                                 + u ** v * Expr('log')(u) * dv)
+        elif op == 'log': return du / u
         else: raise ValueError("Unknown op: %s in diff(%s, %s)" % (op, y, x))
 
-def simp(x):
+def simp(x, memo=None):
+    """Simplify x, a node of its DAG at a time, from the args up, keeping
+    each result in memo.  Since Exprs are hash-consed, equal results are one
+    node, so subexpressions common to several parts are simplified once
+    and shared (common-subexpression elimination).  Arithmetic on numbers
+    is done.
+    >>> simp(diff(x ** 3, x))
+    (3 * (x ** 2))
+    """
+    if memo is None: memo = {}
+    if x not in memo:
+        for node in subexpressions(x):
+            if node not in memo:
+                memo[node] = simp_node(node, memo)
+    return memo[x]
+
+_fold = {'+': operator.add, '-': operator.sub, '*': operator.mul}
+
+def simp_node(x, memo):
+    "Simplify x, given its args simplified in memo."
     if not x.args: return x
-    args = map(simp, x.args)
+    args = [memo[arg] for arg in x.args]
     u, op, v = args[0], x.op, args[-1]
+    if op in _fold and len(args) == 2 and utils_lpw.isnumber(u.op) \
+           and utils_lpw.isnumber(v.op):
+        return Expr(_fold[op](u.op, v.op))
     if op == '+': 
         if v == ZERO: return u
         if u == ZERO: return v
         if u == v: return TWO * u
         if u == -v or v == -u: return ZERO
     elif op == '-' and len(args) == 1: 
+        if utils_lpw.isnumber(u.op): return Expr(-u.op)
         if u.op == '-' and len(u.args) == 1: return u.args[0] ## --y ==> y
     elif op == '-': 
         if v == ZERO: return u
         if u == ZERO: return -v
         if u == v: return ZERO
-        if u == -v or v == -u: return ZERO
     elif op == '*': 
         if u == ZERO or v == ZERO: return ZERO
         if u == ONE: return v
@@ -881,10 +3741,10 @@ def simp(x):
         if u == ZERO: return ZERO
         if v == ZERO: return Expr('Undefined')
         if u == v: return ONE
-        if u == -v or v == -u: return ZERO
+        if u == -v or v == -u: return Expr(-1)
     elif op == '**': 
-        if u == ZERO: return ZERO
         if v == ZERO: return ONE
+        if u == ZERO: return ZERO
         if u == ONE: return ONE
         if v == ONE: return u
     elif op == 'log': 
@@ -897,6 +3757,51 @@ def d(y, x):
     "Differentiate and then simplify."
     return simp(diff(y, x))    
 
+def compile_expr(y, variables):
+    """Compile y into a Python function of the variables (a list of symbols)
+    that evaluates y on numbers, or elementwise on NumPy arrays.  The code
+    is straight-line, with one local per node of y's DAG, so a subexpression
+    used many times is computed once.  The functions log, exp, sqrt, sin,
+    cos and tan come from NumPy if it is installed, else from math.
+    >>> f = compile_expr(d(x * x + x ** 3, x), [x])
+    >>> f(2)
+    16
+    """
+    names = {}
+    for i, var in enumerate(variables):
+        names[expr(var)] = 'a%d' % i
+    lines = ['def f(%s):' % ', '.join([names[expr(v)] for v in variables])]
+    for node in subexpressions(y):
+        if node in names: continue
+        op, args = node.op, [names.get(arg) for arg in node.args]
+        if utils_lpw.isnumber(op):
+            names[node] = '(%r)' % (op,)  ## so (-2) ** a0 is not -(2 ** a0)
+            continue
+        elif not args:
+            raise ValueError("Not a variable: %s" % node)
+        elif op == '-' and len(args) == 1:
+            code = '-' + args[0]
+        elif op in ('+', '-', '*', '**'):
+            code = (' %s ' % op).join(args)
+        elif op == '/' and len(args) == 2:
+            code = 'truediv(%s, %s)' % tuple(args)
+        elif op in _numeric_functions and len(args) == 1:
+            code = '%s(%s)' % (op, args[0])
+        else:
+            raise ValueError("Can not compile op: %s" % op)
+        names[node] = 't%d' % len(lines)
+        lines.append('    %s = %s' % (names[node], code))
+    lines.append('    return %s' % names[y])
+    namespace = {'truediv': operator.truediv}
+    lib = numpy or math
+    for name in _numeric_functions:
+        namespace[name] = getattr(lib, name)
+    exec '\n'.join(lines) in namespace
+    return namespace['f']
+
+_numeric_functions = ('log', 'exp', 'sqrt', 'sin', 'cos', 'tan')
+
+
 
 # #######################################################################
 # ### PropKB
@@ -1000,46 +3905,23 @@ print "5: kb.clauses = ", kb.clauses
 
 
 
-grid_expression = { "S_1,1":Expr("S11"),
-                    "~S_1,1":Expr("~S11"),
-                    "B_1,1":Expr("B11"),
-                    "~B_1,1":Expr("~B11"),
-    
-}
-
-
 # PL-Wumpus-Agent [Fig. 7.19]
-class PLWumpusAgent_2(agents.Agent):
-    "An agent for the wumpus world that does logical inference. [Fig. 7.19]"""
-    def __init__(self):
-        import time
-        self.KB = PropKB()
-        # KB = FOLKB()
-        self.x, self.y, self.orientation = 1, 1, (1, 0)
-        visited = set() ## squares already visited
-        self.action = None
-        plan = []
-
-        def program(percept):
-            # stench, breeze, glitter = percept
-            location, direction, stench, breeze, glitter, Bump, Scream = percept
-            self.x, self.y, self.orientation = update_position(self.x, self.y, self.orientation, self.action)
-            self.KB.tell(grid_expression['%sS_%d,%d' % ('' if stench else '~', self.x, self.y)])
-            self.KB.tell(grid_expression['%sB_%d,%d' % ('' if breeze else '~', self.x, self.y)])
-            if glitter: action = 'Grab'
-            elif plan: action = plan.pop()
-            else:
-                for [i, j] in visited:
-                    if KB.ask('~P_%d,%d & ~W_%d,%d' % (i, j, i, j)) != False:
-                        raise NotImplementedError
-                    KB.ask('~P_%d,%d | ~W_%d,%d' % (i, j, i, j)) != False 
-            if self.action == None: 
-                action = random.choice(['Forward', 'TurnRight', 'TurnLeft'])
-            print "kb.clauses = ", self.KB.clauses
-            time.sleep(1)
+class PLWumpusAgent_2(PLWumpusAgent):
+    """A PLWumpusAgent that, if verbose, prints the size of its KB after
+    each percept."""
+    def __init__(self, width=8, height=8, verbose=False):
+        PLWumpusAgent.__init__(self, width, height)
+        self.verbose = verbose
+        program = self.program
+
+        def traced_program(percept):
+            action = program(percept)
+            if self.verbose:
+                print "kb: %d symbols, %d clauses" % (len(self.KB.symtab),
+                                                      len(self.KB.ids))
             return action
 
-        self.program = program
+        self.program = traced_program
 
 # def tell_if_not_there()
 # class WumpusWorldAgent_to_delete(Agent):
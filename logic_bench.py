@@ -0,0 +1,350 @@
+"""Benchmarks for the inference procedures of cs156_logic.
+
+    python logic_bench.py [-o results.json] [-k pattern] [-r repeat]
+                          [-t timeout] [-c old_results.json]
+
+There are four generators of standard instances:
+
+    random_ksat   Random k-SAT at a given clause/variable ratio
+    pigeonhole    n+1 pigeons in n holes (unsatisfiable)
+    wumpus_board  What an agent knows after exploring a random board
+    horn_chain    A chain of definite clauses, with the goal at its end
+
+Each instance is a list of clauses and a query, and a procedure is asked
+whether the clauses entail the query (a query of FALSE asks whether the
+clauses are unsatisfiable).  Every case of SUITE runs in a fresh process,
+so its peak memory (ru_maxrss) is its own.  The results are written as
+JSON: for each case the best time of the repeats, the counters of the
+procedure (nodes, decisions, propagations, flips ...) and their rates per
+second, and the peak memory in kilobytes.  With -c the results are also
+compared with an earlier run, and the exit status is 1 if any case got
+slower by more than the regression factor.
+"""
+
+import sys, time, random, resource, platform, json, multiprocessing, optparse
+import cs156_logic as logic
+from cs156_logic import Expr, FALSE
+
+#______________________________________________________________________________
+# Instance generators
+
+def random_ksat(n, ratio=4.26, k=3, seed=0):
+    """Random k-SAT over the symbols X1..Xn: round(ratio * n) clauses, each
+    of k distinct symbols with random signs.  Near ratio 4.26, random 3-SAT
+    is satisfiable about half the time, and hardest for the solvers.
+    >>> random_ksat(4, ratio=1, seed=1)
+    ([(~X1 | ~X3 | ~X2), (~X3 | X4 | ~X1), (X4 | ~X1 | X3), (X4 | X1 | ~X3)], FALSE)
+    """
+    rand = random.Random(seed)
+    symbols = [Expr('X%d' % i) for i in range(1, n + 1)]
+    clauses = []
+    for i in range(int(round(ratio * n))):
+        lits = []
+        for p in rand.sample(symbols, k):
+            if rand.random() < 0.5: p = ~p
+            lits.append(p)
+        clauses.append(Expr('|', *lits))
+    return clauses, FALSE
+
+def pigeonhole(n):
+    """n+1 pigeons in n holes, over the symbols P_i_j (pigeon i is in hole
+    j): each pigeon is in some hole, and no two share one.  Unsatisfiable,
+    and hard for resolution (and so for DPLL and CDCL) as n grows.
+    >>> pigeonhole(1)
+    ([P_1_1, P_2_1, (~P_1_1 | ~P_2_1)], FALSE)
+    """
+    P = lambda i, j: Expr('P_%d_%d' % (i, j))
+    clauses = [logic.NaryExpr('|', *[P(i, j) for j in range(1, n + 1)])
+               for i in range(1, n + 2)]
+    for j in range(1, n + 1):
+        for i in range(1, n + 2):
+            for k in range(i + 1, n + 2):
+                clauses.append(~P(i, j) | ~P(k, j))
+    return clauses, FALSE
+
+def wumpus_board(n, pit_probability=0.2, seed=0):
+    """The clauses a WumpusKB holds after exploring a random n x n board:
+    the percepts of every square without a pit or the wumpus that can be
+    reached from (1, 1) through such squares.  The query is that the first
+    square of the fringe (in sorted order) has no pit.
+    >>> clauses, query = wumpus_board(3)
+    >>> len(clauses), query
+    (124, ~P_2_2)
+    """
+    rand = random.Random(seed)
+    squares = [(x, y) for x in range(1, n + 1) for y in range(1, n + 1)]
+    pits = set([sq for sq in squares[1:] if rand.random() < pit_probability])
+    wumpus = rand.choice(squares[1:])
+    kb = logic.WumpusKB(n, n)
+    agenda = [(1, 1)]
+    while agenda:
+        x, y = agenda.pop()
+        if (x, y) in kb.visited: continue
+        nbrs = kb.neighbours(x, y)
+        kb.tell_percept(x, y, stench=wumpus in nbrs,
+                        breeze=bool(pits.intersection(nbrs)))
+        agenda.extend([sq for sq in nbrs if sq not in kb.visited
+                       and sq not in pits and sq != wumpus])
+    fringe = sorted(kb.fringe())
+    query = fringe and ~Expr('P_%d_%d' % fringe[0]) or FALSE
+    return kb.clauses, query
+
+def horn_chain(n):
+    """Definite clauses A_0, B_0, A_i-1 & B_i-1 ==> A_i and A_i-1 ==> B_i for
+    i up to n, and the query A_n, which takes the whole chain to prove.
+    >>> horn_chain(1)
+    ([A_0, B_0, ((A_0 & B_0) >> A_1), (A_0 >> B_1)], A_1)
+    """
+    A = lambda i: Expr('A_%d' % i)
+    B = lambda i: Expr('B_%d' % i)
+    clauses = [A(0), B(0)]
+    for i in range(1, n + 1):
+        clauses.append((A(i - 1) & B(i - 1)) >> A(i))
+        clauses.append(A(i - 1) >> B(i))
+    return clauses, A(n)
+
+#______________________________________________________________________________
+# The procedures.  Each takes (clauses, query) and returns (answer, stats).
+
+class CallCounter:
+    """Count the calls to module.name until restore() is called.  Recursive
+    calls go through the module global too, so they count as well."""
+
+    def __init__(self, module, name):
+        self.module, self.name, self.calls = module, name, 0
+        self.function = function = getattr(module, name)
+        def counted(*args):
+            self.calls += 1
+            return function(*args)
+        setattr(module, name, counted)
+
+    def restore(self):
+        setattr(self.module, self.name, self.function)
+
+def conjunction(clauses):
+    return logic.NaryExpr('&', *clauses)
+
+def run_tt_entails(clauses, query):
+    n = len(logic.prop_symbols(conjunction(clauses + [query])))
+    answer = logic.tt_entails(conjunction(clauses), query)
+    return answer, dict(models=2 ** n)
+
+def run_dpll(clauses, query):
+    counter = CallCounter(logic, 'dpll')
+    try:
+        model = logic.dpll_satisfiable(conjunction(clauses + [~query]))
+    finally:
+        counter.restore()
+    return model is False, dict(nodes=counter.calls)
+
+def int_clauses(clauses, query):
+    "The clauses of clauses & ~query as int clauses, and the number of vars."
+    symtab = logic.SymbolTable()
+    result = []
+    for s in clauses + [~query]:
+        for p in logic.prop_symbols(s):
+            symtab.var(p)
+        for c in logic.conjuncts(logic.to_cnf(s)):
+            c = symtab.clause(c)
+            if c is not None:
+                result.append(c)
+    return result, len(symtab)
+
+def run_cdcl(clauses, query):
+    ints, nvars = int_clauses(clauses, query)
+    solver = logic.CDCLSolver(nvars, seed=0)
+    for c in ints:
+        solver.add_clause(c)
+    return not solver.solve(), dict(solver.stats)
+
+def run_walksat(clauses, query, max_flips=100000):
+    """WalkSAT looks for a model of clauses & ~query, so it can only answer
+    False (a model was found) or None (none was found)."""
+    ints, nvars = int_clauses(clauses, query)
+    solver = logic.WalkSATSolver(ints, nvars, seed=0)
+    answer = None
+    if solver.solve(max_flips=max_flips):
+        answer = False
+    return answer, dict(solver.stats)
+
+def prop_kb(clauses):
+    kb = logic.PropKB()
+    for c in clauses:
+        kb.tell(c)
+    return kb
+
+def run_pl_resolution(clauses, query):
+    counter = CallCounter(logic, 'pl_resolve')
+    try:
+        answer = logic.pl_resolution(prop_kb(clauses), query)
+    finally:
+        counter.restore()
+    return answer, dict(resolutions=counter.calls)
+
+def run_pl_resolution_sos(clauses, query):
+    prover = logic.ResolutionProver.for_query(prop_kb(clauses), query)
+    return prover.prove(), dict(prover.stats)
+
+def run_pl_fc_entails(clauses, query):
+    kb = logic.PropHornKB()
+    for c in clauses:
+        kb.tell(c)
+    answer = logic.pl_fc_entails(kb, query)
+    return answer, dict(clauses=len(clauses), inferred=len(kb.inferred))
+
+procedures = {
+    'tt_entails': run_tt_entails,
+    'dpll': run_dpll,
+    'cdcl': run_cdcl,
+    'walksat': run_walksat,
+    'pl_resolution': run_pl_resolution,
+    'pl_resolution_sos': run_pl_resolution_sos,
+    'pl_fc_entails': run_pl_fc_entails,
+    }
+
+generators = {
+    'ksat': random_ksat,
+    'pigeonhole': pigeonhole,
+    'wumpus': wumpus_board,
+    'horn': horn_chain,
+    }
+
+## (procedure, generator, sizes): a case for each size.  The sizes stop
+## short of where the procedure takes minutes.
+SUITE = [
+    ('tt_entails', 'ksat', [16, 20, 24]),
+    ('tt_entails', 'pigeonhole', [4, 5]),
+    ('tt_entails', 'wumpus', [2]),
+    ('tt_entails', 'horn', [10, 12]),
+    ('dpll', 'ksat', [10, 20, 30]),
+    ('dpll', 'pigeonhole', [3, 4]),
+    ('dpll', 'wumpus', [3, 4]),
+    ('dpll', 'horn', [10, 20]),
+    ('cdcl', 'ksat', [50, 100, 150]),
+    ('cdcl', 'pigeonhole', [5, 6, 7]),
+    ('cdcl', 'wumpus', [4, 8, 12]),
+    ('cdcl', 'horn', [100, 1000]),
+    ('walksat', 'ksat', [50, 100, 200]),
+    ('walksat', 'wumpus', [4, 8, 12]),
+    ('pl_resolution', 'pigeonhole', [2]),
+    ('pl_resolution', 'horn', [2, 3]),
+    ('pl_resolution_sos', 'pigeonhole', [2, 3]),
+    ('pl_resolution_sos', 'wumpus', [3, 4]),
+    ('pl_resolution_sos', 'horn', [10, 100]),
+    ('pl_fc_entails', 'horn', [100, 1000, 10000]),
+    ]
+
+def cases(pattern=''):
+    "The (name, procedure, generator, size) of the cases whose name has pattern."
+    return [('%s/%s-%d' % (proc, gen, n), proc, gen, n)
+            for (proc, gen, sizes) in SUITE for n in sizes
+            if pattern in '%s/%s-%d' % (proc, gen, n)]
+
+#______________________________________________________________________________
+# Running and comparing
+
+def run_case(args):
+    """Run a case (in a worker process) repeat times, and return its result.
+    The instance is made anew for each repeat, outside the timing."""
+    name, proc, gen, n, repeat = args
+    times = []
+    for i in range(repeat):
+        clauses, query = generators[gen](n)
+        start = time.time()
+        answer, stats = procedures[proc](clauses, query)
+        times.append(time.time() - start)
+    seconds = min(times)
+    rates = dict([(k + '_per_second', v / max(seconds, 1e-9))
+                  for (k, v) in stats.items()])
+    return dict(name=name, procedure=proc, instance=gen, size=n,
+                answer=repr(answer), seconds=seconds, times=times,
+                stats=stats, rates=rates,
+                peak_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def run(pattern='', repeat=3, timeout=60, out=sys.stdout):
+    """Run the cases, each in a fresh process, and return the results.  A
+    case that takes longer than timeout seconds is recorded as a timeout."""
+    results = []
+    for (name, proc, gen, n) in cases(pattern):
+        pool = multiprocessing.Pool(1)
+        try:
+            job = pool.apply_async(run_case, [(name, proc, gen, n, repeat)])
+            try:
+                result = job.get(timeout)
+            except multiprocessing.TimeoutError:
+                result = dict(name=name, procedure=proc, instance=gen, size=n,
+                              timeout=timeout)
+        finally:
+            pool.terminate()
+            pool.join()
+        results.append(result)
+        if out:
+            print >> out, format_result(result)
+    return results
+
+def format_result(result):
+    if 'timeout' in result:
+        return '%-32s timeout after %ss' % (result['name'], result['timeout'])
+    rates = ' '.join(['%s=%.0f' % (k.replace('_per_second', '/s'), v)
+                      for (k, v) in sorted(result['rates'].items())])
+    return '%-32s %9.4fs %8dKB %-6s %s' % (
+        result['name'], result['seconds'], result['peak_kb'],
+        result['answer'], rates)
+
+def compare(old, new, factor=1.25, floor=0.01, out=sys.stdout):
+    """Print the time of each case in new against old (both as run returns
+    them), and return the names of the cases more than factor times slower.
+    Cases that took less than floor seconds are too noisy to count."""
+    old = dict([(r['name'], r) for r in old])
+    slower = []
+    for r in new:
+        o = old.get(r['name'])
+        if o is None or 'timeout' in o or 'timeout' in r:
+            continue
+        ratio = r['seconds'] / max(o['seconds'], 1e-9)
+        flag = ''
+        if ratio > factor and r['seconds'] >= floor:
+            slower.append(r['name'])
+            flag = 'SLOWER'
+        elif o['answer'] != r['answer']:
+            flag = 'ANSWER CHANGED'
+        print >> out, '%-32s %9.4fs %9.4fs %6.2fx %s' % (
+            r['name'], o['seconds'], r['seconds'], ratio, flag)
+    return slower
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='write the results here as JSON')
+    parser.add_option('-k', '--pattern', default='',
+                      help='run only the cases whose name contains this')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='time each case this many times (default 3)')
+    parser.add_option('-t', '--timeout', type='float', default=60,
+                      help='seconds before a case is given up (default 60)')
+    parser.add_option('-c', '--compare',
+                      help='compare with the results in this JSON file')
+    parser.add_option('-f', '--factor', type='float', default=1.25,
+                      help='slowdown counted as a regression (default 1.25)')
+    options, args = parser.parse_args(argv)
+    report = dict(python=platform.python_version(),
+                  platform=platform.platform(),
+                  date=time.strftime('%Y-%m-%d %H:%M:%S'),
+                  results=run(options.pattern, options.repeat, options.timeout))
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(report, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+    if options.compare:
+        f = open(options.compare)
+        try:
+            old = json.load(f)
+        finally:
+            f.close()
+        if compare(old['results'], report['results'], options.factor):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
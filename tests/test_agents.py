@@ -0,0 +1,251 @@
+import gc
+import pickle
+import random
+import weakref
+import pytest
+from agents import (Agent, BatchWumpusEnvironment, Gold, Object, Pit,
+                    RandomVacuumAgent, ReflexVacuumAgent,
+                    TrivialVacuumEnvironment, Wumpus, WumpusEnvironment,
+                    XYEnvironment, compare_agents, distance2,
+                    restore_environment)
+from agents import test_agent as run_test_agent
+
+
+def forward_agent():
+    agent = Agent()
+    agent.program = lambda percept: 'Forward'
+    return agent
+
+
+def small_world():
+    env = WumpusEnvironment(5, 5, display=False)
+    env.add_object(Pit(), (2, 1))
+    wumpus = Wumpus()
+    wumpus.alive = False
+    env.add_object(wumpus, (3, 3))
+    env.add_object(Gold(), (1, 3))
+    return env
+
+
+def test_restore_after_death():
+    env = small_world()
+    agent = forward_agent()
+    env.add_object(agent)
+    snap = env.snapshot()
+    env.step()
+    assert not env.agents and env.score == -1000
+    env.restore(snap)
+    assert env.agents == [agent] and agent in env.objects
+    assert agent.location == (1, 1) and env.score == 0
+    assert agent.is_alive()
+    assert agent in env.objects_at((1, 1))
+    env.step()
+    assert not env.agents and env.score == -1000
+
+
+def test_snapshot_keeps_object_attributes():
+    snap = pickle.loads(pickle.dumps(small_world().snapshot(), 2))
+    env = restore_environment(snap)
+    [wumpus] = env.objects_at((3, 3))
+    assert isinstance(wumpus, Wumpus) and wumpus.alive is False
+    assert len(env.objects) == len(small_world().objects)
+
+
+def test_restore_with_other_agents():
+    env = small_world()
+    env.add_object(forward_agent())
+    snap = env.snapshot()
+    with pytest.raises(ValueError):
+        env.restore(snap, [])
+    other = forward_agent()
+    clone = restore_environment(snap, [other])
+    assert clone.agents == [other] and other.location == (1, 1)
+
+
+def test_headless_run_prints_nothing(capsys):
+    env = small_world()
+    env.add_object(forward_agent(), (1, 1), (0, 1))
+    env.run(10)
+    assert env.log
+    assert capsys.readouterr() == ('', '')
+
+
+def test_log_keeps_last_events():
+    env = WumpusEnvironment(5, 5, display=False, log_size=5)
+    agent = Agent()
+    agent.program = lambda percept: 'TurnRight'
+    env.add_object(agent, (1, 1))
+    env.run(20)
+    assert list(env.log) == [(step, 'Agent', 'acted', 'TurnRight')
+                             for step in range(15, 20)]
+    assert WumpusEnvironment(5, 5, display=False).log.maxlen == 1000
+
+
+def test_snapshot_copies_nested_values():
+    env = small_world()
+    [pit] = env.objects_at((2, 1))
+    [wumpus] = env.objects_at((3, 3))
+    pit.history = [[1], {'a': [2]}]
+    pit.neighbour = wumpus
+    env.notes = {'pits': [pit]}
+    snap = env.snapshot()
+    pit.history[0].append(3)
+    pit.history[1]['a'].append(4)
+    wumpus.alive = True
+    for clone in (restore_environment(snap), restore_environment(snap)):
+        [pit2] = clone.objects_at((2, 1))
+        [wumpus2] = clone.objects_at((3, 3))
+        assert pit2.history == [[1], {'a': [2]}]
+        assert pit2.neighbour is wumpus2 and wumpus2.alive is False
+        assert clone.notes['pits'][0] is pit2
+        pit2.history[0].append(5)
+    numpy = pytest.importorskip('numpy')
+    env.grid = numpy.zeros(3)
+    snap = env.snapshot()
+    env.grid[0] = 1
+    clone = restore_environment(snap)
+    assert clone.grid.tolist() == [0, 0, 0]
+    clone.grid[1] = 1
+    assert restore_environment(snap).grid.tolist() == [0, 0, 0]
+
+
+class TallyingVacuumEnvironment(TrivialVacuumEnvironment):
+    def __init__(self):
+        TrivialVacuumEnvironment.__init__(self)
+        self.tally = {'actions': []}
+
+    def execute_action(self, agent, action):
+        self.tally['actions'].append(action)
+        TrivialVacuumEnvironment.execute_action(self, agent, action)
+
+
+def test_runs_in_copies_share_nothing():
+    envs = [TallyingVacuumEnvironment() for i in range(3)]
+    first = run_test_agent(RandomVacuumAgent, 10, envs, seed=3, copies=True)
+    assert all(env.tally == {'actions': []} for env in envs)
+    assert first == run_test_agent(RandomVacuumAgent, 10, envs, seed=3,
+                                   copies=True)
+
+
+def test_snapshot_keeps_its_own_agents():
+    env = small_world()
+    agent = forward_agent()
+    env.add_object(agent)
+    snap = env.snapshot()
+    assert snap.agents == [agent] and not hasattr(env, 'snapshot_agents')
+    with pytest.raises(ValueError):
+        env.restore(pickle.loads(pickle.dumps(snap, 2)))
+    ref = weakref.ref(agent)
+    del env, agent
+    gc.collect()
+    assert ref() is not None
+    del snap
+    gc.collect()
+    assert ref() is None
+
+
+def test_batch_wumpus():
+    pytest.importorskip('numpy')
+    env = BatchWumpusEnvironment(2, 4, 4)
+    env.pits[1, 2, 1] = True
+    env.step([env.actions.index('Forward')] * 2)
+    assert list(env.x) == [2, 1]
+    assert list(env.alive) == [True, False]
+    assert list(env.score) == [-1, -1000]
+
+
+def test_seeded_runs_match_in_a_pool():
+    factories = [RandomVacuumAgent, ReflexVacuumAgent]
+    random.seed(1)
+    serial = compare_agents(TrivialVacuumEnvironment, factories, n=6,
+                            steps=20, seed=7, variance=True)
+    random.seed(1)
+    pooled = compare_agents(TrivialVacuumEnvironment, factories, n=6,
+                            steps=20, seed=7, variance=True, workers=2)
+    assert serial == pooled
+    envs = [TrivialVacuumEnvironment() for i in range(6)]
+    score = run_test_agent(RandomVacuumAgent, 20, envs, seed=7, copies=True)
+    assert score == run_test_agent(RandomVacuumAgent, 20, envs, seed=7,
+                                   workers=2, copies=True)
+    assert not any(env.agents for env in envs)
+    assert score == run_test_agent(RandomVacuumAgent, 20, envs, seed=7)
+    assert all(len(env.agents) == 1 for env in envs)
+
+
+def test_test_agent_runs_in_the_envs():
+    envs = [TrivialVacuumEnvironment() for i in range(3)]
+    score = run_test_agent(ReflexVacuumAgent, 10, envs)
+    assert score == sum(env.agents[0].performance for env in envs) / 3.0
+    assert all(env.status == {(0, 0): 'Clean', (1, 0): 'Clean'}
+               for env in envs)
+    with pytest.raises(ValueError):
+        run_test_agent(ReflexVacuumAgent, 10, envs, workers=2)
+
+
+def test_cells_against_brute_force():
+    rng = random.Random(0)
+    env = XYEnvironment(20, 20)
+    for i in range(60):
+        env.add_object(Object(), (rng.randint(0, 19), rng.randint(0, 19)))
+    for step in range(300):
+        obj = rng.choice(env.objects)
+        if rng.random() < 0.1:
+            env.delete_object(obj)
+            env.add_object(Object(), (rng.uniform(0, 20), rng.uniform(0, 20)))
+        else:
+            env.move_to(obj, (rng.choice([rng.randint(0, 19),
+                                          rng.uniform(0, 20)]),
+                              rng.randint(0, 19)))
+        location = rng.choice(env.objects).location
+        assert (sorted(map(id, env.objects_at(location))) ==
+                sorted(id(o) for o in env.objects if o.location == location))
+        radius = rng.choice([0.5, 1, 2.5, 30])
+        assert (sorted(map(id, env.objects_near(location, radius))) ==
+                sorted(id(o) for o in env.objects
+                       if distance2(location, o.location) <= radius ** 2))
+
+
+def random_wumpus_world(rng, n=7):
+    env = WumpusEnvironment(n, n, display=False)
+    agent = Agent()
+    moves = ['Forward'] * 3 + ['TurnLeft', 'TurnRight', 'Grab', 'Shoot']
+    agent.program = lambda percept: rng.choice(moves)
+    env.add_object(agent, (1, 1), rng.choice(BatchWumpusEnvironment.headings))
+    squares = rng.sample([(x, y) for x in range(1, n - 1)
+                          for y in range(1, n - 1) if (x, y) != (1, 1)], 6)
+    env.add_object(Wumpus(), squares[0])
+    for square in squares[1:3]:
+        env.add_object(Pit(), square)
+    for square in squares[3:]:
+        env.add_object(Gold(), square)
+    return env
+
+
+def test_batch_wumpus_matches_scalar_worlds():
+    pytest.importorskip('numpy')
+    rng = random.Random(1)
+    envs = [random_wumpus_world(rng) for i in range(40)]
+    batch = BatchWumpusEnvironment.from_environments(envs)
+    actions = BatchWumpusEnvironment.actions
+    for step in range(60):
+        batch.percept()
+        chosen = []
+        for env in envs:
+            if env.agents:
+                action = env.agents[0].program(env.percept(env.agents[0]))
+                env.execute_action(env.agents[0], action)
+                env.steps += 1
+                env.exogenous_change()
+            else:
+                action = 'Forward'
+            chosen.append(actions.index(action))
+        batch.step(chosen)
+        for i, env in enumerate(envs):
+            assert env.score == batch.score[i]
+            assert bool(env.agents) == batch.alive[i]
+            if env.agents:
+                assert env.agents[0].location == (batch.x[i], batch.y[i])
+
+
+if __name__ == '__main__':
+    pytest.main()
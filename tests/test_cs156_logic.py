@@ -0,0 +1,659 @@
+import itertools
+import math
+import operator
+import random
+import re
+import StringIO
+
+import pytest
+from cs156_logic import *  # noqa
+
+# Random small problems, checked against brute-force enumeration.
+
+SYMS = [Expr('X%d' % i) for i in range(1, 6)]
+
+
+def random_sentence(rng, depth=3):
+    if depth == 0 or rng.random() < 0.25:
+        p = rng.choice(SYMS)
+        return ~p if rng.random() < 0.3 else p
+    op = rng.choice(['&', '|', '>>', '<<', '<=>', '~'])
+    if op == '~':
+        return ~random_sentence(rng, depth - 1)
+    return Expr(op, random_sentence(rng, depth - 1),
+                random_sentence(rng, depth - 1))
+
+
+def all_models(symbols):
+    for values in itertools.product([False, True], repeat=len(symbols)):
+        yield dict(zip(symbols, values))
+
+
+def brute_count(s, symbols=None):
+    if symbols is None:
+        symbols = prop_symbols(s)
+    return sum(1 for m in all_models(list(symbols)) if pl_true(s, m))
+
+
+def brute_entails(kb, alpha):
+    return all(pl_true(alpha, m) for m in all_models(SYMS) if pl_true(kb, m))
+
+
+def random_int_cnf(rng, n, m):
+    return [tuple(rng.choice([v, -v])
+                  for v in rng.sample(range(1, n + 1), rng.randint(1, 3)))
+            for i in range(m)]
+
+
+def int_true(values, lit):
+    return values[abs(lit) - 1] == (lit > 0)
+
+
+def int_models(clauses, n):
+    return [values for values in itertools.product([False, True], repeat=n)
+            if all(any(int_true(values, lit) for lit in c) for c in clauses)]
+
+
+def satisfies(model, clauses):
+    return all(any(model[abs(lit)] == (lit > 0) for lit in c)
+               for c in clauses)
+
+
+def test_expr_interning():
+    assert Expr('P', 2) is Expr('P', 2)
+    assert Expr(2) is not Expr(2.0)
+    assert isinstance(Expr(2.0).op, float)
+    assert isinstance(Expr(2).op, int)
+    assert repr(expr('x / 2.0')) == '(x / 2.0)'
+
+
+def eval_expr(s):
+    # The eval-based expr that the parser replaced.
+    s = s.replace('==>', '>>').replace('<==', '<<')
+    s = s.replace('<=>', '%').replace('=/=', '^')
+    s = re.sub(r'([a-zA-Z0-9_.]+)', r'Expr("\1")', s)
+    return eval(s, {'Expr': Expr})
+
+
+def random_expr_string(rng, depth=3):
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice(['P', 'Q', 'x', 'F(x, 2)', '1', '2.5', 'TRUE'])
+    if rng.random() < 0.2:
+        return rng.choice(['~', '-', '- ']) + random_expr_string(rng, depth - 1)
+    if rng.random() < 0.1:
+        return '(%s)' % random_expr_string(rng, depth - 1)
+    op = rng.choice(['|', '^', '=/=', '&', '<<', '<==', '>>', '==>', '+', '-',
+                     '*', '/', '%', '<=>', '**', '<', '>', '<=', '>='])
+    return '%s %s %s' % (random_expr_string(rng, depth - 1), op,
+                         random_expr_string(rng, depth - 1))
+
+
+def test_expr_parser_against_eval():
+    for s in ['P & Q | ~R(x, F(x))', 'P <=> Q(1)', 'P & Q ==> R & S',
+              'a - b - c', 'a / b / c', 'a ** b ** c', '-a ** b',
+              '~P ** Q', '2 ** -x', 'x < y < z', 'F()', 'F(G(x), y)',
+              'P ==> Q <=> R', 'P ^ Q & R | S', '((P))', 'P, Q',
+              'F(P, (Q))', '1.5 * x']:
+        assert expr(s) == eval_expr(s), s
+    rng = random.Random(15)
+    for trial in range(500):
+        s = random_expr_string(rng)
+        assert expr(s) == eval_expr(s), s
+        assert ExprParser(s).parse() == eval_expr(s), s
+
+
+def test_expr_parser_uses_interned_symbols(monkeypatch):
+    p = Expr('Interned')
+    calls = []
+    new = Expr.__new__
+
+    def counting_new(cls, op, *args):
+        calls.append(op)
+        return new(cls, op, *args)
+    monkeypatch.setattr(Expr, '__new__', staticmethod(counting_new))
+    assert ExprParser('Interned').tokens[0][1] is p
+    assert calls == []
+    assert ExprParser('NotYetInterned').tokens[0][1].op == 'NotYetInterned'
+    assert calls == ['NotYetInterned']
+    monkeypatch.undo()
+    assert ExprParser('42').tokens[0][1].op == 42
+    assert ExprParser('2.0').tokens[0][1].op == 2.0
+    assert type(ExprParser('2.0').tokens[0][1].op) is float
+
+
+def test_expr_cache_hits(monkeypatch):
+    calls = []
+    parse = ExprParser.parse
+
+    def counting_parse(self):
+        calls.append(self.s)
+        return parse(self)
+    monkeypatch.setattr(ExprParser, 'parse', counting_parse)
+    s = 'Cached & (Hit | ~Miss)'
+    first = expr(s)
+    assert expr(s) is first
+    assert calls == [s]
+
+
+def test_to_cnf_nested_iff():
+    s = expr('R & (R >> (Q <=> (T <=> R)))')
+    t = SymbolTable()
+    for c in conjuncts(to_cnf(s)):
+        t.clause(c)  # raises ValueError unless c is a clause of literals
+    assert PropKB(s).count_models() == 2
+
+
+def test_symbol_table_literal():
+    t = SymbolTable()
+    assert t.literal(expr('~P')) == -t.literal(expr('P'))
+    with pytest.raises(ValueError):
+        t.literal(expr('B & C'))
+    with pytest.raises(ValueError):
+        t.clause(expr('A | (B & C)'))
+    for constant in (TRUE, FALSE, ~TRUE, ~FALSE):
+        with pytest.raises(ValueError):
+            t.literal(constant)
+    assert t.clause(expr('A | ~TRUE')) == (t.var(expr('A')),)
+    assert t.clause(expr('A | ~FALSE')) is None
+    assert t.clause(~TRUE) == ()
+
+
+def test_int_prop_kb_constant_queries():
+    for q in ['TRUE', 'A & TRUE', '~FALSE', 'A | FALSE', 'FALSE', '~TRUE',
+              'A & ~TRUE']:
+        q = expr(q)
+        assert IntPropKB(expr('A')).ask(q) == PropKB(expr('A')).ask(q)
+
+
+def test_cdcl_nested_iff():
+    s = expr('(((P <=> S) <=> (S | Q)) | Q) & '
+             '(((T >> Q) >> (S >> Q)) | (~Q << ~P))')
+    model = dpll_satisfiable(s, engine='cdcl')
+    assert model and pl_true(s, model)
+
+
+def test_cdcl_constants_against_dpll():
+    rng = random.Random(9)
+    sentences = [expr(s) for s in ['~TRUE', '~FALSE', 'A & ~TRUE',
+                                   'A | ~TRUE', 'A | ~FALSE',
+                                   '(A | ~FALSE) & (B | FALSE) & ~B']]
+    for trial in range(40):
+        constant = rng.choice([TRUE, FALSE, ~TRUE, ~FALSE])
+        s = random_sentence(rng)
+        sentences.append(rng.choice([s & constant, s | constant]))
+    for s in sentences:
+        dpll = dpll_satisfiable(s)
+        cdcl = dpll_satisfiable(s, engine='cdcl')
+        sat = brute_count(s) > 0
+        assert (cdcl is not False) == (dpll is not False) == sat
+        if sat:
+            assert TRUE not in cdcl and FALSE not in cdcl
+            assert pl_true(s, dict((p, cdcl.get(p, False))
+                                   for p in prop_symbols(s))) is True
+
+
+def test_read_dimacs_comments():
+    import StringIO
+    kb = read_dimacs(StringIO.StringIO(
+        'c var is great\nc var 2 Q\np cnf 2 2\n1 0\n-2 0\n'))
+    assert kb.clauses == [expr('V1'), expr('~Q')]
+
+
+def test_bddkb_counts_tautology_symbols():
+    s = expr('A & (T | ~T)')
+    assert BDDKB(s).count_models() == PropKB(s).count_models() == 2
+    kb = BDDKB(expr('A'))
+    kb.tell(expr('B | ~B'))
+    assert kb.count_models() == 2
+
+
+def test_pl_wumpus_agent_board_size():
+    import agents
+
+    def explored(env, agent):
+        env.add_object(agent, location=(1, 1), direction=(1, 0))
+        env.run(300)
+        return len(agent.KB.visited)
+    # A KB for 8x8 squares on a 4x4 board: bumps rule out the walls.
+    env = agents.WumpusEnvironment(6, 6, display=False)
+    assert explored(env, PLWumpusAgent()) == 16
+    env = agents.WumpusEnvironment(7, 7, display=False)
+    assert explored(env, PLWumpusAgent.for_environment(env)) == 25
+
+
+def test_pl_wumpus_agent_2_prints_only_if_verbose(capsys):
+    import agents
+    for verbose in (False, True):
+        env = agents.WumpusEnvironment(6, 6, display=False)
+        agent = PLWumpusAgent_2(verbose=verbose)
+        env.add_object(agent, location=(1, 1), direction=(1, 0))
+        env.run(3)
+        out = capsys.readouterr()[0]
+        assert ('kb: ' in out) == verbose
+
+
+def test_folkb_renamings_are_bounded():
+    kb = FolKB(map(expr, ['Farmer(Mac)', 'Rabbit(Pete)',
+                          '(Rabbit(r) & Farmer(f)) ==> Hates(f, r)']))
+    assert kb.ask(expr('Hates(Mac, x)')) == {expr('x'): expr('Pete')}
+    assert kb.renamings
+    kb.retract(expr('(Rabbit(r) & Farmer(f)) ==> Hates(f, r)'))
+    assert not kb.renamings
+    assert kb.ask(expr('Hates(Mac, x)')) is False
+    kb.renamings_size = 2
+    kb.tell(expr('(Rabbit(r) & Farmer(f)) ==> Hates(f, r)'))
+    kb.tell(expr('Hates(f, r) ==> Chases(f, r)'))
+    assert kb.ask(expr('Chases(Mac, x)')) == {expr('x'): expr('Pete')}
+    assert len(kb.renamings) <= 2
+
+
+def test_tseitin_retract_adds_definitions_once():
+    for KB in (PropKB, IntPropKB):
+        kb = KB(cnf='tseitin')
+        s = expr('(A & B) | (C & D)')
+        kb.retract(s)
+        n = len(kb.clauses)
+        for i in range(3):
+            kb.tell(s)
+            kb.retract(s)
+            assert len(kb.clauses) == n
+        kb.tell(s)
+        assert kb.ask(expr('A | C')) == {}
+
+
+def random_horn_clause(rng, symbols):
+    head = rng.choice(symbols)
+    if rng.random() < 0.3:
+        return head
+    body = rng.sample(symbols, rng.randint(1, 3))
+    return Expr('>>', NaryExpr('&', *body), head)
+
+
+def test_prop_horn_kb_retract_matches_chaining_afresh():
+    import random
+    rng = random.Random(0)
+    symbols = [Expr('H%d' % i) for i in range(8)]
+    for trial in range(20):
+        kb = PropHornKB()
+        for step in range(30):
+            if kb.clauses and rng.random() < 0.4:
+                kb.retract(rng.choice(kb.clauses))
+            else:
+                kb.tell(random_horn_clause(rng, symbols))
+            fresh = PropHornKB()
+            for c in kb.clauses:
+                fresh.tell(c)
+            for p in symbols:
+                expected = pl_fc_entails(kb, p)
+                assert bool(kb.ask(p) == {}) == expected
+                assert bool(fresh.ask(p) == {}) == expected
+                assert tt_entails(Expr('&', *kb.clauses) if kb.clauses
+                                  else TRUE, p) == expected
+
+
+def test_cdcl_against_brute_force():
+    rng = random.Random(1)
+    n = 6
+    for trial in range(150):
+        clauses = random_int_cnf(rng, n, rng.randint(1, 30))
+        models = int_models(clauses, n)
+        solver = CDCLSolver(seed=trial)
+        for c in clauses:
+            solver.add_clause(list(c))
+        assert solver.solve() == bool(models)
+        if models:
+            assert satisfies(solver.model, clauses)
+        for k in range(3):
+            assumptions = [rng.choice([v, -v])
+                           for v in rng.sample(range(1, n + 1), 2)]
+            expected = any(all(int_true(values, lit) for lit in assumptions)
+                           for values in models)
+            assert solver.solve(assumptions) == expected
+            if expected:
+                assert satisfies(solver.model,
+                                 clauses + [(lit,) for lit in assumptions])
+
+
+def test_satisfiable_against_brute_force():
+    rng = random.Random(2)
+    for trial in range(100):
+        s = random_sentence(rng)
+        sat = brute_count(s) > 0
+        for cnf in ('distribute', 'tseitin', 'pg'):
+            for engine in ('dpll', 'cdcl'):
+                model = dpll_satisfiable(s, engine=engine, cnf=cnf)
+                assert bool(model) == sat
+                if model:
+                    assert pl_true(s, model) is True
+
+
+def test_walksat_models_against_brute_force():
+    rng = random.Random(3)
+    n = 6
+    for trial in range(100):
+        clauses = random_int_cnf(rng, n, rng.randint(1, 25))
+        models = int_models(clauses, n)
+        for strategy in ('walksat', 'probsat'):
+            solver = WalkSATSolver(clauses, n, seed=trial)
+            found = solver.solve(max_flips=5000, strategy=strategy)
+            assert found == bool(models)
+            if found:
+                assert satisfies(solver.model, clauses)
+    for trial in range(50):
+        s = random_sentence(rng)
+        model = WalkSAT(conjuncts(to_cnf(s)), max_flips=5000, seed=trial)
+        assert bool(model) == (brute_count(s) > 0)
+        if model:
+            assert pl_true(s, dict((p, model.get(p, False))
+                                   for p in prop_symbols(s))) is True
+
+
+def test_walksat_constants():
+    assert WalkSAT([expr('~TRUE')], seed=0) is None
+    assert WalkSAT([expr('A & ~TRUE')], seed=0) is None
+    assert WalkSAT([expr('~FALSE')], seed=0) == {}
+    assert WalkSAT([expr('A | ~TRUE')], seed=0) == {expr('A'): True}
+    model = WalkSAT([expr('(A | ~FALSE) & (B | FALSE)')], seed=0)
+    assert set(model) == set([expr('A'), expr('B')]) and model[expr('B')]
+
+
+def test_tseitin_and_pg_against_brute_force():
+    # Fixing the original symbols, the encoding is satisfiable just when
+    # the sentence is true; Tseitin also keeps the number of models.
+    rng = random.Random(4)
+    for trial in range(80):
+        s = random_sentence(rng)
+        symbols = list(prop_symbols(s))
+        for method in ('tseitin', 'pg'):
+            symtab = SymbolTable()
+            for p in symbols:
+                symtab.var(p)
+            solver = CDCLSolver()
+            for c in conjuncts(to_cnf(s, method)):
+                c = symtab.clause(c)
+                if c is not None:
+                    solver.add_clause(list(c))
+            for m in all_models(symbols):
+                assumptions = [symtab.var(p) * (1 if m[p] else -1)
+                               for p in symbols]
+                assert solver.solve(assumptions) == pl_true(s, m)
+        assert (PropKB(s, cnf='tseitin').count_models() ==
+                PropKB(s).count_models() == brute_count(s))
+
+
+def test_model_counter_against_brute_force():
+    rng = random.Random(5)
+    n = 7
+    for trial in range(100):
+        clauses = random_int_cnf(rng, n, rng.randint(0, 20))
+        weights = dict((lit, rng.randint(1, 3))
+                       for v in range(1, n + 1) for lit in (v, -v)
+                       if rng.random() < 0.5)
+        expected = 0
+        for values in int_models(clauses, n):
+            w = 1
+            for v in range(1, n + 1):
+                w *= weights.get(v if values[v - 1] else -v, 1)
+            expected += w
+        assert (ModelCounter().count(clauses, range(1, n + 1)) ==
+                len(int_models(clauses, n)))
+        assert ModelCounter(weights).count(clauses, range(1, n + 1)) == expected
+
+
+def test_bddkb_against_brute_force():
+    rng = random.Random(6)
+    for trial in range(60):
+        s = random_sentence(rng)
+        for order in ('force', 'given'):
+            kb = BDDKB(s, order=order)
+            assert kb.count_models() == brute_count(s)
+            for k in range(4):
+                q = random_sentence(rng, 2)
+                assert (kb.ask(q) == {}) == brute_entails(s, q)
+            fact = rng.choice(SYMS)
+            assert (kb.condition(fact).count_models() ==
+                    brute_count(s & fact))
+        for q in (TRUE, FALSE, ~TRUE, ~FALSE, rng.choice(SYMS) & TRUE,
+                  rng.choice(SYMS) & ~TRUE, rng.choice(SYMS) | FALSE):
+            assert (kb.ask(q) == {}) == brute_entails(s, q)
+        kb = BDDKB()
+        for c in conjuncts(s):
+            kb.tell(c)
+        assert kb.consistent() == (brute_count(s) > 0)
+
+
+def test_ask_many_and_backbone_against_brute_force():
+    rng = random.Random(7)
+    for trial in range(60):
+        s = random_sentence(rng)
+        kb = IntPropKB(s)
+        queries = ([p for p in SYMS] + [~p for p in SYMS] +
+                   [rng.choice(SYMS) & ~rng.choice(SYMS) for k in range(3)] +
+                   [random_sentence(rng, 2) for k in range(3)] +
+                   [TRUE, FALSE, ~TRUE, ~FALSE, rng.choice(SYMS) & TRUE,
+                    rng.choice(SYMS) & ~TRUE, rng.choice(SYMS) | FALSE])
+        answers = kb.ask_many(queries)
+        assert ([a == {} for a in answers] ==
+                [brute_entails(s, q) for q in queries])
+        implied = kb.implied_literals([kb.symtab.var(p) for p in SYMS])
+        if brute_count(s) == 0:
+            assert implied is None
+            continue
+        for p in SYMS:
+            v = kb.symtab.var(p)
+            if brute_entails(s, p):
+                assert implied[v] == v
+            elif brute_entails(s, ~p):
+                assert implied[v] == -v
+            else:
+                assert implied[v] == 0
+
+
+def test_int_prop_kb_tell_retract_against_brute_force():
+    rng = random.Random(8)
+    for trial in range(20):
+        kb, reference = IntPropKB(), PropKB()
+        told = []
+        for step in range(12):
+            if told and rng.random() < 0.3:
+                s = told.pop(rng.randrange(len(told)))
+                kb.retract(s)
+                reference.retract(s)
+            else:
+                s = random_sentence(rng, 2)
+                told.append(s)
+                kb.tell(s)
+                reference.tell(s)
+            whole = Expr('&', *reference.clauses) if reference.clauses else TRUE
+            for q in [random_sentence(rng, 2) for k in range(3)]:
+                assert (kb.ask(q) == {}) == brute_entails(whole, q)
+
+
+def test_tt_entails_and_pl_true_many_against_brute_force():
+    rng = random.Random(9)
+    for trial in range(100):
+        s, q = random_sentence(rng), random_sentence(rng, 2)
+        assert tt_entails(s, q) == brute_entails(s, q)
+        models = [dict((p, rng.choice([True, False]))
+                       for p in SYMS if rng.random() < 0.8)
+                  for k in range(10)]
+        assert pl_true_many(s, models) == [pl_true(s, m) for m in models]
+
+
+def test_resolution_against_brute_force():
+    rng = random.Random(10)
+    for trial in range(60):
+        s, q = random_sentence(rng, 2), random_sentence(rng, 2)
+        assert pl_resolution(PropKB(s), q, engine='sos') == brute_entails(s, q)
+
+
+def test_folkb_against_transitive_closure():
+    rng = random.Random(11)
+    nodes = [Expr('N%d' % i) for i in range(7)]
+    for trial in range(10):
+        edges = [(i, j) for i in range(7) for j in range(i + 1, 7)
+                 if rng.random() < 0.3]
+        clauses = [expr('Edge(%s, %s)' % (nodes[i], nodes[j]))
+                   for (i, j) in edges]
+        clauses += map(expr, ['Edge(x, y) ==> Path(x, y)',
+                              '(Edge(x, y) & Path(y, z)) ==> Path(x, z)'])
+        reach = set(edges)
+        for k in nodes:
+            reach |= set((i, l) for (i, j) in reach for (j2, l) in reach
+                         if j == j2)
+        expected = set(nodes[j] for (i, j) in reach if i == 0)
+        w = expr('w')
+        for occur_check in (True, False):
+            kb = FolKB(clauses, occur_check)
+            answers = set(a[w] for a in kb.ask_generator(expr('Path(N0, w)')))
+            assert answers == expected
+        forward = set(a[w] for a in fol_fc_ask(FolKB(clauses),
+                                               expr('Path(N0, w)')))
+        assert forward == expected
+
+
+def test_portfolio_against_brute_force():
+    rng = random.Random(12)
+    for trial in range(5):
+        s = random_sentence(rng)
+        model = portfolio_satisfiable(s, workers=2)
+        assert bool(model) == (brute_count(s) > 0)
+        if model:
+            assert pl_true(s, model) is True
+
+
+def clause_sets(kb):
+    return sorted(sorted(map(repr, disjuncts(c))) for c in kb.clauses)
+
+
+def test_dimacs_round_trip():
+    rng = random.Random(13)
+    for trial in range(30):
+        kb = IntPropKB(random_sentence(rng))
+        for names in (True, False):
+            out = StringIO.StringIO()
+            write_dimacs(kb, out, names)
+            copy = read_dimacs(StringIO.StringIO(out.getvalue()))
+            assert copy.count_models() == kb.count_models()
+            if names:
+                assert clause_sets(copy) == clause_sets(kb)
+
+
+def tree_diff(y, x):
+    # The recursive diff that the memoized one replaced.
+    if y == x: return ONE
+    elif not y.args: return ZERO
+    u, op, v = y.args[0], y.op, y.args[-1]
+    if op == '+': return tree_diff(u, x) + tree_diff(v, x)
+    elif op == '-' and len(y.args) == 1: return -tree_diff(u, x)
+    elif op == '-': return tree_diff(u, x) - tree_diff(v, x)
+    elif op == '*': return u * tree_diff(v, x) + v * tree_diff(u, x)
+    elif op == '/':
+        return (v * tree_diff(u, x) - u * tree_diff(v, x)) / (v * v)
+    elif op == '**': return (v * u ** (v - 1) * tree_diff(u, x)
+                             + u ** v * Expr('log')(u) * tree_diff(v, x))
+    elif op == 'log': return tree_diff(u, x) / u
+
+
+def tree_simp(x):
+    # The recursive simp that the memoized one replaced, with u - (-u),
+    # u / (-u) and 0 ** 0 no longer simplified to 0.
+    if not x.args: return x
+    args = map(tree_simp, x.args)
+    u, op, v = args[0], x.op, args[-1]
+    if op == '+':
+        if v == ZERO: return u
+        if u == ZERO: return v
+        if u == v: return TWO * u
+        if u == -v or v == -u: return ZERO
+    elif op == '-' and len(args) == 1:
+        if u.op == '-' and len(u.args) == 1: return u.args[0]
+    elif op == '-':
+        if v == ZERO: return u
+        if u == ZERO: return -v
+        if u == v: return ZERO
+    elif op == '*':
+        if u == ZERO or v == ZERO: return ZERO
+        if u == ONE: return v
+        if v == ONE: return u
+        if u == v: return u ** 2
+    elif op == '/':
+        if u == ZERO: return ZERO
+        if v == ZERO: return Expr('Undefined')
+        if u == v: return ONE
+        if u == -v or v == -u: return Expr(-1)
+    elif op == '**':
+        if v == ZERO: return ONE
+        if u == ZERO: return ZERO
+        if u == ONE: return ONE
+        if v == ONE: return u
+    elif op == 'log':
+        if u == ONE: return ZERO
+    return Expr(op, *args)
+
+
+def evaluate(y, values):
+    # Evaluate an arithmetic Expr tree directly, in floats.
+    if isinstance(y.op, (int, long, float)): return float(y.op)
+    if not y.args: return values[y]
+    args = [evaluate(arg, values) for arg in y.args]
+    if y.op == '-' and len(args) == 1: return -args[0]
+    if y.op == 'log': return math.log(args[0])
+    return {'+': operator.add, '-': operator.sub, '*': operator.mul,
+            '/': operator.truediv, '**': operator.pow}[y.op](*args)
+
+
+def random_arith(rng, variables, depth=3):
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice(variables + [Expr(rng.randint(-3, 3))])
+    op = rng.choice(['+', '-', '*', '/', '**', 'neg', 'log'])
+    u = random_arith(rng, variables, depth - 1)
+    if op == 'neg':
+        return -u
+    if op == 'log':
+        return Expr('log')(u)
+    if op == '**' and rng.random() < 0.5:
+        return u ** Expr(rng.randint(-2, 3))
+    return Expr(op, u, random_arith(rng, variables, depth - 1))
+
+
+def close(a, b):
+    return abs(a - b) <= 1e-6 * max(1.0, abs(a))
+
+
+def test_compile_expr_parenthesizes_constants():
+    x = Expr('x')
+    assert compile_expr(Expr('**', Expr(-2), x), [x])(2) == 4
+    assert compile_expr(Expr('-', Expr(-2)), [x])(2) == 2
+    assert compile_expr(Expr('-', Expr(3), Expr(-2)), [x])(0) == 5
+
+
+def test_diff_simp_and_compile_against_tree_versions():
+    rng = random.Random(14)
+    x, y = Expr('x'), Expr('y')
+    values = {x: 1.3, y: 0.7}
+    memo, simp_memo = {}, {}
+    checked = 0
+    for trial in range(300):
+        e = random_arith(rng, [x, y])
+        try:
+            value = evaluate(e, values)
+            expected = evaluate(tree_simp(tree_diff(e, x)), values)
+            h = 1e-6
+            slope = (evaluate(e, {x: 1.3 + h, y: 0.7}) -
+                     evaluate(e, {x: 1.3 - h, y: 0.7})) / (2 * h)
+        except (ZeroDivisionError, ValueError, OverflowError, KeyError):
+            continue
+        if complex in map(type, (value, expected, slope)):
+            continue
+        assert abs(slope - expected) <= 1e-3 * max(1.0, abs(expected))
+        checked += 1
+        assert close(value, compile_expr(e, [x, y])(1.3, 0.7))
+        for derivative in (d(e, x), simp(diff(e, x, memo), simp_memo)):
+            assert close(expected, evaluate(derivative, values))
+            assert close(expected, compile_expr(derivative, [x, y])(1.3, 0.7))
+    assert checked > 100
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,81 @@
+import json
+import StringIO
+import time
+
+import pytest
+import logic_bench
+
+
+def sleep_procedure(clauses, query):
+    time.sleep(0.05)
+    return True, dict(naps=1)
+
+
+def hang_procedure(clauses, query):
+    time.sleep(30)
+    return True, {}
+
+
+@pytest.fixture
+def tiny_suite(monkeypatch):
+    # The workers are forked, so they see the patched tables too.
+    monkeypatch.setattr(logic_bench, 'SUITE',
+                        [('cdcl', 'horn', [3]), ('pl_fc_entails', 'horn', [3]),
+                         ('sleep', 'horn', [1]), ('hang', 'horn', [1])])
+    monkeypatch.setitem(logic_bench.procedures, 'sleep', sleep_procedure)
+    monkeypatch.setitem(logic_bench.procedures, 'hang', hang_procedure)
+
+
+def test_run_writes_json(tiny_suite, tmpdir):
+    out = str(tmpdir.join('results.json'))
+    assert logic_bench.main(['-o', out, '-r', '2', '-k', 'horn-3']) == 0
+    report = json.load(open(out))
+    results = report['results']
+    assert [r['name'] for r in results] == ['cdcl/horn-3',
+                                            'pl_fc_entails/horn-3']
+    for r in results:
+        assert r['answer'] == 'True'
+        assert len(r['times']) == 2 and r['seconds'] == min(r['times'])
+        assert r['peak_kb'] > 0
+    assert results[1]['stats'] == {'clauses': 8, 'inferred': 8}
+    assert results[1]['rates']['inferred_per_second'] > 0
+
+
+def test_run_times_out(tiny_suite):
+    start = time.time()
+    [result] = logic_bench.run('hang', repeat=1, timeout=0.5, out=None)
+    assert result == dict(name='hang/horn-1', procedure='hang',
+                          instance='horn', size=1, timeout=0.5)
+    assert time.time() - start < 10
+    assert 'timeout after 0.5s' in logic_bench.format_result(result)
+
+
+def result(name, seconds, answer='True'):
+    return dict(name=name, seconds=seconds, answer=answer)
+
+
+def test_compare_finds_regressions():
+    old = [result('a', 0.1), result('b', 0.1), result('c', 0.001),
+           result('d', 0.1), dict(name='e', timeout=1), result('f', 0.1)]
+    new = [result('a', 0.2), result('b', 0.11), result('c', 0.005),
+           result('d', 0.1, 'False'), result('e', 5.0), result('g', 5.0),
+           dict(name='f', timeout=1)]
+    out = StringIO.StringIO()
+    assert logic_bench.compare(old, new, out=out) == ['a']
+    assert logic_bench.compare(old, new, factor=1.05, out=out) == ['a', 'b']
+    assert logic_bench.compare(old, new, floor=0.001, out=out) == ['a', 'c']
+    lines = out.getvalue().splitlines()
+    assert lines[0].endswith('SLOWER')
+    assert lines[3].endswith('ANSWER CHANGED')
+
+
+def test_main_exits_1_on_a_regression(tiny_suite, tmpdir):
+    old = tmpdir.join('old.json')
+    old.write(json.dumps(dict(results=[result('sleep/horn-1', 0.01)])))
+    assert logic_bench.main(['-k', 'sleep', '-r', '1', '-c', str(old)]) == 1
+    old.write(json.dumps(dict(results=[result('sleep/horn-1', 1.0)])))
+    assert logic_bench.main(['-k', 'sleep', '-r', '1', '-c', str(old)]) == 0
+
+
+if __name__ == '__main__':
+    pytest.main()